@@ -0,0 +1,176 @@
+from datetime import datetime, timezone
+from functools import partial
+from sqlalchemy import select, delete
+from extensions import db, scheduler
+from models import (
+    User,
+    Expense,
+    ExpenseHistory,
+    RecurringExpense,
+    PasswordResetToken,
+    NotificationSetting,
+    ReminderLog,
+    FCMToken,
+    MonthlySpend,
+    CategoryStats,
+    ImportJob,
+    AccountDeletion,
+    ReminderMonthlyCount,
+    ExpenseHistoryArchive,
+    IdempotencyRecord,
+    RefreshToken,
+    OutboxMessage
+)
+from storage import get_storage
+from metrics import metrics
+from revocation import revoke_user_tokens
+
+
+# Children before parents: history rows reference expenses, so they go first
+# even where the database would cascade them (SQLite runs without FK enforcement)
+DELETION_ORDER = (
+    ExpenseHistory,
+    ExpenseHistoryArchive,
+    Expense,
+    RecurringExpense,
+    ReminderLog,
+    ReminderMonthlyCount,
+    FCMToken,
+    PasswordResetToken,
+    NotificationSetting,
+    MonthlySpend,
+    CategoryStats,
+    ImportJob,
+    IdempotencyRecord,
+    RefreshToken,
+    OutboxMessage,
+)
+
+
+def _delete_in_chunks(deletion, model, chunk_size):
+    """
+    Delete one table's rows for the user chunk_size at a time, committing after
+    each chunk so no transaction holds locks on more than a chunk of rows.
+    """
+    deletion.current_table = model.__tablename__
+    db.session.commit()
+
+    while True:
+        ids = db.session.scalars(
+            select(model.id).where(model.user_id == deletion.user_id).limit(chunk_size)
+        ).all()
+        if not ids:
+            return
+        db.session.execute(delete(model).where(model.id.in_(ids)))
+        deletion.deleted_rows += len(ids)
+        db.session.commit()
+
+
+def _remove_files(user_id):
+    removed = 0
+    uploads = get_storage("uploads")
+    for prefix in (f"user_{user_id}_", f"thumbnails/user_{user_id}_"):
+        for key in uploads.list(prefix):
+            removed += uploads.delete(key)
+    reports = get_storage("reports")
+    for key in reports.list(f"expenses_{user_id}_"):
+        removed += reports.delete(key)
+    return removed
+
+
+def run_account_deletion(deletion_id, app):
+    """
+    Background job: remove everything a disabled user owns table by table in
+    bounded batched DELETEs, then the user row itself. Core deletes never load
+    the rows into the session, unlike the ORM cascades. Progress is committed
+    as it goes, so a failed run can be picked up again by rescheduling it.
+    """
+    with app.app_context():
+        deletion = db.session.get(AccountDeletion, deletion_id)
+        if deletion is None or deletion.status == "completed":
+            return
+
+        chunk_size = app.config.get("ACCOUNT_DELETE_CHUNK_SIZE", 1000)
+        deletion.status = "running"
+        deletion.error = None
+        db.session.commit()
+
+        try:
+            for model in DELETION_ORDER:
+                _delete_in_chunks(deletion, model, chunk_size)
+
+            deletion.current_table = User.__tablename__
+            db.session.execute(delete(User).where(User.id == deletion.user_id))
+            db.session.commit()
+
+            _remove_files(deletion.user_id)
+            deletion.status = "completed"
+            deletion.current_table = None
+            metrics.incr("accounts.deleted")
+            metrics.observe("accounts.deleted_rows", deletion.deleted_rows)
+        except Exception as e:
+            db.session.rollback()
+            deletion = db.session.get(AccountDeletion, deletion_id)
+            deletion.status = "failed"
+            deletion.error = str(e)
+            print(f"Account deletion {deletion_id} failed: {e}")
+        finally:
+            deletion.finished_at = datetime.now(timezone.utc)
+            db.session.commit()
+
+
+def schedule_account_deletion(user, app):
+    """
+    Disable the account right away and queue the actual deletion. Returns the
+    AccountDeletion tracking it.
+    """
+    user.disabled_at = datetime.now(timezone.utc)
+    revoke_user_tokens(user.id, reason="account_deletion")
+    deletion = AccountDeletion(user_id=user.id)
+    db.session.add(deletion)
+    db.session.commit()
+
+    # Nothing should be sent to an account that is going away
+    if scheduler.get_job(f"daily_push_{user.id}"):
+        scheduler.remove_job(f"daily_push_{user.id}")
+
+    _queue_deletion(deletion.id, app)
+    return deletion
+
+
+def _queue_deletion(deletion_id, app):
+    scheduler.add_job(
+        partial(run_account_deletion, deletion_id, app),
+        trigger="date",
+        id=f"account_deletion_{deletion_id}",
+        replace_existing=True
+    )
+
+
+def resume_account_deletions(app):
+    """
+    Requeue deletions a restart interrupted. The jobs only live in scheduler
+    memory, and a disabled user cannot log in to ask again. Failed ones are
+    retried too, for the same reason. Every step is safe to repeat.
+    """
+    with app.app_context():
+        unfinished = db.session.scalars(
+            select(AccountDeletion.id).where(AccountDeletion.status.in_(("pending", "running", "failed")))
+        ).all()
+    for deletion_id in unfinished:
+        _queue_deletion(deletion_id, app)
+    if unfinished:
+        print(f"Resumed {len(unfinished)} account deletions")
+    return len(unfinished)
+
+
+def deletion_progress(deletion):
+    return {
+        "id": deletion.id,
+        "status": deletion.status,
+        "current_table": deletion.current_table,
+        "deleted_rows": deletion.deleted_rows,
+        "error": deletion.error,
+        "created_at": deletion.created_at.isoformat(),
+        "finished_at": deletion.finished_at.isoformat() if deletion.finished_at else None,
+    }
@@ -0,0 +1,192 @@
+import threading
+from datetime import datetime, timezone, timedelta
+from dateutil.relativedelta import relativedelta
+from cachetools import TTLCache
+from sqlalchemy import func, case, select, update
+from flask import current_app
+from extensions import db
+from models import Expense, User
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; pure Python fallback below
+    np = None
+
+
+DAYS_OF_WEEK = ["Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat"]
+COMPARE_PERIODS = ("week", "month", "year")
+
+
+class AnalyticsCache:
+    """
+    Per-process result cache keyed on the user's analytics_version. Writes
+    bump that column instead of scanning keys, so every worker stops
+    addressing stale entries at once and they age out via the TTL. A result
+    computed while a write lands is stored under the old version, which
+    nothing asks for again.
+    """
+
+    def __init__(self, maxsize=2048, ttl=300):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, user_id, version, name, params, compute):
+        key = (user_id, version, name, params)
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+
+        result = compute()
+
+        with self._lock:
+            self._entries[key] = result
+        return result
+
+
+def _cache():
+    cache = current_app.extensions.get("analytics_cache")
+    if cache is None:
+        cache = AnalyticsCache(
+            maxsize=current_app.config.get("ANALYTICS_CACHE_SIZE", 2048),
+            ttl=current_app.config.get("ANALYTICS_CACHE_TTL", 300)
+        )
+        current_app.extensions["analytics_cache"] = cache
+    return cache
+
+
+def invalidate_analytics(user_id):
+    """
+    Drop cached analytics for a user, in every worker, when their expenses
+    change. Call it before committing the change: the version bump is part of
+    the same transaction, so the two land, or fail, together.
+    """
+    db.session.execute(
+        update(User).where(User.id == user_id).values(analytics_version=User.analytics_version + 1)
+    )
+
+
+def _pivot(rows, row_labels, col_labels):
+    """Scatter (row, col, value) triples into a len(row_labels) x len(col_labels) grid."""
+    row_index = {label: i for i, label in enumerate(row_labels)}
+    col_index = {label: i for i, label in enumerate(col_labels)}
+
+    if np is not None:
+        grid = np.zeros((len(row_labels), len(col_labels)))
+        if rows:
+            r = np.fromiter((row_index[row[0]] for row in rows), dtype=np.intp, count=len(rows))
+            c = np.fromiter((col_index[row[1]] for row in rows), dtype=np.intp, count=len(rows))
+            v = np.fromiter((row[2] for row in rows), dtype=float, count=len(rows))
+            np.add.at(grid, (r, c), v)
+        return np.round(grid, 2).tolist()
+
+    grid = [[0.0] * len(col_labels) for _ in row_labels]
+    for row_label, col_label, value in rows:
+        grid[row_index[row_label]][col_index[col_label]] += value
+    return [[round(v, 2) for v in line] for line in grid]
+
+
+def monthly_trends(user_id, months=12):
+    now = datetime.now(timezone.utc)
+    start = datetime(now.year, now.month, 1, tzinfo=timezone.utc) - relativedelta(months=months - 1)
+
+    year = func.extract("year", Expense.date)
+    month = func.extract("month", Expense.date)
+    rows = db.session.query(
+        year, month, Expense.category, func.sum(Expense.amount)
+    ).filter(
+        Expense.user_id == user_id,
+        Expense.date >= start,
+        # Expenses dated in a future month have no column to go in
+        Expense.date < start + relativedelta(months=months)
+    ).group_by(year, month, Expense.category).all()
+
+    labels = [(start + relativedelta(months=i)).strftime("%Y-%m") for i in range(months)]
+    categories = sorted({r[2] for r in rows})
+    triples = [
+        (r[2], f"{int(r[0]):04d}-{int(r[1]):02d}", float(r[3] or 0))
+        for r in rows
+    ]
+    grid = _pivot(triples, categories, labels)
+
+    return {
+        "months": labels,
+        "categories": dict(zip(categories, grid)),
+        "totals": [round(sum(col), 2) for col in zip(*grid)] if grid else [0.0] * months
+    }
+
+
+def spending_heatmap(user_id):
+    dow = func.extract("dow", Expense.date)
+    hour = func.extract("hour", Expense.date)
+    rows = db.session.query(
+        dow, hour, func.sum(Expense.amount), func.count(Expense.id)
+    ).filter(Expense.user_id == user_id).group_by(dow, hour).all()
+
+    days, hours = range(7), range(24)
+    amounts = _pivot([(int(r[0]), int(r[1]), float(r[2] or 0)) for r in rows], days, hours)
+    counts = _pivot([(int(r[0]), int(r[1]), r[3]) for r in rows], days, hours)
+
+    return {
+        "days": DAYS_OF_WEEK,
+        "hours": list(hours),
+        "amounts": amounts,
+        "counts": [[int(v) for v in line] for line in counts]
+    }
+
+
+def _period_start(now, period):
+    today = datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
+    if period == "week":
+        current = today - timedelta(days=today.weekday())
+        return current, current - timedelta(weeks=1)
+    if period == "month":
+        current = today.replace(day=1)
+        return current, current - relativedelta(months=1)
+    current = today.replace(month=1, day=1)
+    return current, current - relativedelta(years=1)
+
+
+def period_comparison(user_id, period="month"):
+    now = datetime.now(timezone.utc)
+    current_start, previous_start = _period_start(now, period)
+
+    in_current = Expense.date >= current_start
+    rows = db.session.query(
+        Expense.category,
+        func.sum(case((in_current, Expense.amount), else_=0.0)),
+        func.sum(case((in_current, 0.0), else_=Expense.amount))
+    ).filter(
+        Expense.user_id == user_id,
+        Expense.date >= previous_start,
+        Expense.date <= now
+    ).group_by(Expense.category).all()
+
+    current = {r[0]: round(float(r[1] or 0), 2) for r in rows if r[1]}
+    previous = {r[0]: round(float(r[2] or 0), 2) for r in rows if r[2]}
+    current_total = round(sum(current.values()), 2)
+    previous_total = round(sum(previous.values()), 2)
+
+    return {
+        "period": period,
+        "current": {
+            "start": current_start.date().isoformat(),
+            "total": current_total,
+            "by_category": current
+        },
+        "previous": {
+            "start": previous_start.date().isoformat(),
+            "end": (current_start - timedelta(days=1)).date().isoformat(),
+            "total": previous_total,
+            "by_category": previous
+        },
+        "change": {
+            "amount": round(current_total - previous_total, 2),
+            "percent": round((current_total - previous_total) / previous_total * 100, 2) if previous_total else None
+        }
+    }
+
+
+def cached(user_id, name, params, compute):
+    # One primary key lookup, so a write in any worker is seen at once
+    version = db.session.execute(select(User.analytics_version).where(User.id == user_id)).scalar() or 0
+    return _cache().get_or_compute(user_id, version, name, params, compute)
@@ -0,0 +1,128 @@
+import math
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, func, and_, insert
+from extensions import db, upsert_insert
+from models import CategoryStats, Expense
+from config import ANOMALY_Z_THRESHOLD, ANOMALY_MIN_SAMPLES
+
+
+def _stats_for(user_id, category, create=False):
+    if create:
+        # Two first expenses in a category would both find no row to lock and
+        # both insert one; seed it so the loser locks the winner's row instead
+        db.session.execute(
+            upsert_insert(CategoryStats).values(
+                user_id=user_id, category=category, count=0, mean=0.0, m2=0.0
+            ).on_conflict_do_nothing(index_elements=["user_id", "category"])
+        )
+    return CategoryStats.query.filter_by(
+        user_id=user_id, category=category
+    ).with_for_update().first()
+
+
+def _add_sample(stats, amount):
+    stats.count += 1
+    delta = amount - stats.mean
+    stats.mean += delta / stats.count
+    stats.m2 += delta * (amount - stats.mean)
+
+
+def _remove_sample(stats, amount):
+    if stats.count <= 1:
+        stats.count, stats.mean, stats.m2 = 0, 0.0, 0.0
+        return
+    old_mean = stats.mean
+    stats.count -= 1
+    stats.mean = (old_mean * (stats.count + 1) - amount) / stats.count
+    stats.m2 = max(stats.m2 - (amount - stats.mean) * (amount - old_mean), 0.0)
+
+
+def score_expense(stats, amount):
+    """Return the anomaly verdict for amount against the stats as they stand."""
+    if stats is None or stats.count < ANOMALY_MIN_SAMPLES:
+        return {"flagged": False, "z_score": None}
+
+    std = math.sqrt(stats.m2 / (stats.count - 1))
+    if std == 0:
+        # Every past amount was identical, a z-score is undefined
+        return {"flagged": False, "z_score": None}
+
+    z_score = (amount - stats.mean) / std
+    return {"flagged": z_score > ANOMALY_Z_THRESHOLD, "z_score": round(z_score, 2)}
+
+
+def record_expense(user_id, category, amount):
+    """Score a new expense against prior history, then fold it into the stats."""
+    amount = float(amount)
+    with db.session.no_autoflush:
+        stats = _stats_for(user_id, category, create=True)
+        verdict = score_expense(stats, amount)
+        _add_sample(stats, amount)
+    return verdict
+
+
+def forget_expense(user_id, category, amount):
+    """Remove a deleted or edited expense from the running stats."""
+    with db.session.no_autoflush:
+        stats = _stats_for(user_id, category)
+        if stats is not None:
+            _remove_sample(stats, float(amount))
+
+
+def reset_stats(user_id):
+    CategoryStats.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+
+def backfill_category_stats(user_id=None):
+    """
+    Rebuild the stats table from the expenses table in one set-based pass:
+    a grouped mean per (user, category) joined back to compute M2 exactly.
+    """
+    filters = [Expense.user_id == user_id] if user_id is not None else []
+
+    means = select(
+        Expense.user_id,
+        Expense.category,
+        func.count(Expense.id).label("count"),
+        func.avg(Expense.amount).label("mean")
+    ).where(*filters).group_by(Expense.user_id, Expense.category).subquery()
+
+    deviation = Expense.amount - means.c.mean
+    rows = db.session.execute(
+        select(
+            means.c.user_id,
+            means.c.category,
+            means.c.count,
+            means.c.mean,
+            func.sum(deviation * deviation)
+        ).join(
+            Expense,
+            and_(Expense.user_id == means.c.user_id, Expense.category == means.c.category)
+        ).group_by(means.c.user_id, means.c.category, means.c.count, means.c.mean)
+    ).all()
+
+    stale = CategoryStats.query
+    if user_id is not None:
+        stale = stale.filter_by(user_id=user_id)
+    stale.delete(synchronize_session=False)
+
+    if rows:
+        db.session.execute(insert(CategoryStats), [{
+            "user_id": r[0],
+            "category": r[1],
+            "count": r[2],
+            "mean": float(r[3]),
+            "m2": float(r[4] or 0.0)
+        } for r in rows])
+    db.session.commit()
+    return len(rows)
+
+
+@click.command("backfill-category-stats")
+@click.option("--user-id", type=int, default=None, help="Only rebuild stats for this user.")
+@with_appcontext
+def backfill_category_stats_command(user_id):
+    """Build anomaly detection stats for existing expenses."""
+    count = backfill_category_stats(user_id)
+    click.echo(f"Rebuilt stats for {count} user categories")
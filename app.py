@@ -1,4 +1,5 @@
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from extensions import db, migrate, jwt, cors, scheduler
 from routes import register_blueprints
 import yagmail
@@ -7,18 +8,33 @@ from models import User, Expense, ExpenseHistory, RecurringExpense
 from dotenv import load_dotenv
 load_dotenv()
 from config import Config
-from scheduler import load_all_user_jobs
+from scheduler import load_all_user_jobs, schedule_maintenance_jobs
+from account_deletion import resume_account_deletions
+from importer import fail_orphaned_imports
+from anomaly import backfill_category_stats_command
+from json_provider import FastJSONProvider
+from compression import init_compression
+from media import CappedRequest
 
 
 
 def create_app(test_config=None):
     app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    app.request_class = CappedRequest
     
     if test_config:
         app.config.update(test_config)
     else:
         app.config.from_object(Config)
 
+    # Behind a router remote_addr is the router's address; trust as many
+    # X-Forwarded-For / X-Forwarded-Proto hops as there are proxies in front
+    x_for = app.config.get("PROXY_FIX_X_FOR", 0)
+    x_proto = app.config.get("PROXY_FIX_X_PROTO", 0)
+    if x_for or x_proto:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=x_for, x_proto=x_proto)
+
     db.init_app(app)
     migrate.init_app(app, db)
     jwt.init_app(app)
@@ -27,15 +43,21 @@ def create_app(test_config=None):
         app,
         resources={r"/*": {"origins": [app.config["FRONTEND_URL"]]}},
         supports_credentials=True,
-        allow_headers=["Content-Type", "Authorization"]
+        allow_headers=["Content-Type", "Authorization", "Idempotency-Key"],
+        expose_headers=["Idempotent-Replayed"]
     )
 
     register_blueprints(app)
+    init_compression(app)
+    app.cli.add_command(backfill_category_stats_command)
 
     if not test_config:
         scheduler.start()
         with app.app_context():
             load_all_user_jobs(app)
+        schedule_maintenance_jobs(app)
+        resume_account_deletions(app)
+        fail_orphaned_imports(app)
     
     return app
 
@@ -0,0 +1,110 @@
+"""
+Registration benchmark: signups per second through POST /register, the cost
+of the old three-query uniqueness check against the single query, and a
+race where several threads register the same username at once (exactly one
+may win, the rest must get a field error rather than a 500).
+
+Hashing is made cheap and inline so the numbers are about the database
+round trips, not scrypt.
+
+    python benchmarks/bench_registration.py [signups] [threads]
+"""
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("FRONTEND_URL", "http://localhost")
+
+from app import create_app
+from extensions import db
+from models import User
+from routes.auth import registration_conflicts
+
+
+def make_app(path):
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{path}",
+        "SQLALCHEMY_ENGINE_OPTIONS": {"connect_args": {"timeout": 30}},
+        "JWT_SECRET_KEY": "bench",
+        "FRONTEND_URL": "http://localhost",
+        "RATELIMIT_ENABLED": False,
+        "PASSWORD_HASH_WORKERS": 0,
+        "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1",
+    })
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def signup(client, i, name=None):
+    return client.post("/register", json={
+        "name": name or f"user{i}",
+        "email": f"user{i}@example.com",
+        "password": "password123",
+        "number": f"{i:010d}",
+    })
+
+
+def legacy_conflicts(name, email, number):
+    errors = {}
+    if User.query.filter_by(name=name).first():
+        errors["name"] = "Username already exists"
+    if User.query.filter_by(email=email).first():
+        errors["email"] = "Email already registered"
+    if User.query.filter_by(number=number).first():
+        errors["number"] = "Phone number already registered"
+    return errors
+
+
+def bench_signups(app, n):
+    client = app.test_client()
+    started = time.perf_counter()
+    for i in range(n):
+        assert signup(client, i).status_code == 201
+    elapsed = time.perf_counter() - started
+    print(f"signups       {n:>6}  {n / elapsed:>8.1f} /s")
+
+
+def bench_checks(app, n):
+    with app.app_context():
+        for label, check in (("3 queries", legacy_conflicts), ("1 query", registration_conflicts)):
+            started = time.perf_counter()
+            for i in range(n):
+                check(f"new{i}", f"new{i}@example.com", f"9{i:09d}")
+            elapsed = time.perf_counter() - started
+            print(f"check {label:<9} {n:>6}  {elapsed / n * 1e6:>8.1f} us")
+
+
+def race(app, threads):
+    results = []
+    barrier = threading.Barrier(threads)
+
+    def worker(i):
+        client = app.test_client()
+        barrier.wait()
+        results.append(signup(client, 100000 + i, name="contended").status_code)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    print(f"race          {threads:>6}  {sorted(results)}")
+    assert results.count(201) == 1 and results.count(400) == threads - 1
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(os.path.join(tmp, "bench.db"))
+        bench_signups(app, n)
+        bench_checks(app, n)
+        race(app, threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Report rendering benchmark: ms per 1k rows and output size for the table
+layout, inline and in the worker pool, against the one cell/multi_cell per
+expense list that generate_pdf used to write. "cells" is the table without
+the PyFPDF 1.7 hooks (see report_renderer.FPDF_INTERNALS), as rendered on
+any other FPDF version.
+
+    python benchmarks/bench_report_render.py [rows ...]
+
+Each figure is the best of REPEATS runs; timings on a shared machine are
+noisy, so compare runs rather than single figures.
+"""
+import os
+import sys
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+
+from fpdf import FPDF
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import report_renderer
+from config import ALLOWED_CATEGORIES
+from report_renderer import render_pdf, render_pdf_isolated, _latin1
+
+REPEATS = 5
+
+
+def make_rows(n, seed=42):
+    rnd = random.Random(seed)
+    start = date(2024, 1, 1)
+    return [(
+        start + timedelta(days=rnd.randrange(365)),
+        f"Expense {i} " + "x" * rnd.randrange(40),
+        rnd.choice(ALLOWED_CATEGORIES),
+        round(rnd.uniform(1, 500), 2),
+        "USD",
+        "Note " * rnd.randrange(12) if rnd.random() < 0.6 else None
+    ) for i in range(n)]
+
+
+def render_legacy(rows, file_path):
+    """The layout generate_pdf wrote before report_renderer, kept as the reference."""
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", "B", 12)
+    pdf.cell(0, 10, "Expense Report", ln=True, align="C")
+    pdf.ln(10)
+
+    pdf.set_font("Arial", "", 10)
+    for row in rows:
+        pdf.cell(0, 6, _latin1(f"{row[0]} | {row[1]} | {row[2]} | {row[3]} {row[4]}"), ln=True)
+        if row[5]:
+            pdf.multi_cell(0, 6, _latin1(f"Description: {row[5]}"))
+    pdf.output(file_path, "F")
+
+
+def render_cells(rows, file_path):
+    internals, report_renderer.FPDF_INTERNALS = report_renderer.FPDF_INTERNALS, False
+    try:
+        render_pdf(rows, file_path)
+    finally:
+        report_renderer.FPDF_INTERNALS = internals
+
+
+def measure(label, fn, rows, file_path):
+    timings = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        fn(rows, file_path)
+        timings.append(time.perf_counter() - started)
+    per_1k = min(timings) * 1000 / len(rows) * 1000
+    size = os.path.getsize(file_path)
+    print(f"{label:<10} {len(rows):>7} rows  {per_1k:>8.1f} ms/1k rows  {size / 1024:>8.0f} KiB")
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "report.pdf")
+        # Warm the worker pool so process start-up is not billed to the first size
+        render_pdf_isolated(make_rows(10), out)
+        for n in sizes:
+            rows = make_rows(n)
+            measure("legacy", render_legacy, rows, out)
+            measure("table", render_pdf, rows, out)
+            measure("cells", render_cells, rows, out)
+            measure("pooled", render_pdf_isolated, rows, out)
+
+
+if __name__ == "__main__":
+    main()
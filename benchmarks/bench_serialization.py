@@ -0,0 +1,81 @@
+"""
+List serialization benchmark: encode time and payload size for the old
+dict-per-row stdlib JSON path versus serializers.Rows through the app's JSON
+provider (orjson when installed) and as MessagePack.
+
+    python benchmarks/bench_serialization.py [rows ...]
+"""
+import os
+import sys
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask import Flask
+from config import ALLOWED_CATEGORIES
+from serializers import Rows, to_msgpack
+from json_provider import FastJSONProvider
+
+FIELDS = ("id", "title", "currency", "amount", "date", "category", "description")
+
+
+def make_rows(n, seed=42):
+    rnd = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [(
+        i,
+        f"Expense {i}",
+        "USD",
+        round(rnd.uniform(1, 500), 2),
+        start + timedelta(minutes=rnd.randrange(525600)),
+        rnd.choice(ALLOWED_CATEGORIES),
+        "Note " * rnd.randrange(6) if rnd.random() < 0.6 else None
+    ) for i in range(n)]
+
+
+def legacy_json(rows):
+    return json.dumps({"expenses": [{
+        "id": r[0],
+        "title": r[1],
+        "currency": r[2],
+        "amount": r[3],
+        "date": r[4].isoformat(),
+        "category": r[5],
+        "description": r[6]
+    } for r in rows]}).encode()
+
+
+provider = FastJSONProvider(Flask(__name__))
+
+
+def rows_json(rows):
+    return provider.dumps({"expenses": Rows(FIELDS, rows)}).encode()
+
+
+def rows_msgpack(rows):
+    return to_msgpack({"expenses": Rows(FIELDS, rows)})
+
+
+def measure(label, fn, rows, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = fn(rows)
+        best = min(best, time.perf_counter() - started)
+    print(f"{label:<13} {len(rows):>7} rows  {best * 1000:>8.2f} ms  {len(body) / 1024:>8.1f} KiB")
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+    for n in sizes:
+        rows = make_rows(n)
+        measure("json (dicts)", legacy_json, rows)
+        measure("json provider", rows_json, rows)
+        measure("msgpack", rows_msgpack, rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+from datetime import datetime, timezone
+from collections import defaultdict
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import select, func
+from extensions import db, upsert_insert
+from models import MonthlySpend, Expense, User
+from config import BUDGET_ALERT_THRESHOLDS
+from outbox import enqueue_push, enqueue_email
+
+
+def month_key(value):
+    """Return the YYYY-MM bucket a date or datetime belongs to."""
+    return value.strftime("%Y-%m")
+
+
+def spend_deltas():
+    """Accumulator of month -> amount changes for a single write."""
+    return defaultdict(float)
+
+
+def _month_total_from_expenses(user_id, month):
+    start = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+    end = start + relativedelta(months=1)
+    return db.session.query(func.coalesce(func.sum(Expense.amount), 0.0)).filter(
+        Expense.user_id == user_id,
+        Expense.date >= start,
+        Expense.date < end
+    ).scalar()
+
+
+def _increment_month(user_id, month, delta):
+    return MonthlySpend.query.filter_by(user_id=user_id, month=month).update(
+        {MonthlySpend.total: MonthlySpend.total + delta},
+        synchronize_session=False
+    )
+
+
+def _seed_months(user_id, deltas):
+    """
+    First write of a month: seed its total once from the expenses already
+    stored, every later write is a single increment. The stored rows must
+    not include the pending write yet, so all seeds are read before anything
+    is flushed; otherwise an edit moving an expense between two unseeded
+    months would be counted twice.
+    """
+    seeds = {month: _month_total_from_expenses(user_id, month) for month in deltas}
+    for month, total in seeds.items():
+        # A concurrent first write may seed the month between our update
+        # and this insert; then its row stands and we add our delta to it
+        inserted = db.session.execute(
+            upsert_insert(MonthlySpend).values(
+                user_id=user_id, month=month, total=total + deltas[month], alert_level=0
+            ).on_conflict_do_nothing(index_elements=["user_id", "month"])
+        ).rowcount
+        if not inserted:
+            _increment_month(user_id, month, deltas[month])
+
+
+def _crossed_threshold(user_id, month):
+    row = db.session.execute(
+        select(MonthlySpend.total, MonthlySpend.alert_level, User.monthly_budget)
+        .join(User, User.id == MonthlySpend.user_id)
+        .where(MonthlySpend.user_id == user_id, MonthlySpend.month == month)
+    ).first()
+    if not row or not row.monthly_budget or row.monthly_budget <= 0:
+        return None
+
+    percent = row.total / row.monthly_budget * 100
+    reached = [t for t in BUDGET_ALERT_THRESHOLDS if percent >= t and t > row.alert_level]
+    if not reached:
+        return None
+
+    threshold = max(reached)
+    # Conditional update so concurrent writers cannot both claim the same alert
+    claimed = MonthlySpend.query.filter(
+        MonthlySpend.user_id == user_id,
+        MonthlySpend.month == month,
+        MonthlySpend.alert_level < threshold
+    ).update({MonthlySpend.alert_level: threshold}, synchronize_session=False)
+    if not claimed:
+        return None
+
+    return {
+        "user_id": user_id,
+        "threshold": threshold,
+        "total": row.total,
+        "budget": row.monthly_budget
+    }
+
+
+def apply_spend(user_id, deltas):
+    """
+    Apply month -> amount deltas to the user's running totals and return the
+    budget alerts that became due. Must run in the same transaction as the
+    expense write, before the write is flushed (month seeds are read from
+    the stored rows); pass the result to enqueue_budget_alerts before commit.
+    """
+    alerts = []
+    current_month = month_key(datetime.now(timezone.utc))
+
+    with db.session.no_autoflush:
+        unseen = [
+            month for month, delta in deltas.items()
+            if delta and not _increment_month(user_id, month, delta)
+        ]
+        _seed_months(user_id, {month: deltas[month] for month in unseen})
+
+        if deltas.get(current_month, 0) > 0:
+            alert = _crossed_threshold(user_id, current_month)
+            if alert:
+                alerts.append(alert)
+
+    return alerts
+
+
+def reset_spend(user_id):
+    """Zero the running totals after all of a user's expenses are removed."""
+    MonthlySpend.query.filter_by(user_id=user_id).update(
+        {MonthlySpend.total: 0.0},
+        synchronize_session=False
+    )
+
+
+def enqueue_budget_alerts(alerts):
+    """
+    Queue the push and email for each alert in the outbox. Call before
+    committing the expense write, so the alerts are saved with it.
+    """
+    for alert in alerts:
+        user = db.session.get(User, alert["user_id"])
+        if not user:
+            continue
+
+        currency = user.currency or ""
+        threshold = alert["threshold"]
+        if threshold >= 100:
+            title = "Monthly budget exceeded"
+        else:
+            title = f"{threshold}% of monthly budget used"
+        body = (
+            f"You have spent {alert['total']:.2f} {currency} of your "
+            f"{alert['budget']:.2f} {currency} budget this month."
+        )
+
+        enqueue_push(user.id, title, body)
+        if user.email:
+            enqueue_email(user.email, title, body, user.id)
@@ -0,0 +1,136 @@
+from datetime import datetime, timezone, timedelta
+from sqlalchemy import select, insert, update, delete, or_
+from extensions import db
+from models import Expense, ExpenseHistory, ExpenseHistoryArchive
+from config import ALLOWED_CATEGORIES, ALLOWED_CURRENCIES
+from budget import spend_deltas, month_key, apply_spend
+from analytics import invalidate_analytics
+from anomaly import backfill_category_stats
+from history import history_row
+
+
+# Fields a bulk update may set, with the values each accepts
+BULK_UPDATE_FIELDS = {
+    "category": ALLOWED_CATEGORIES,
+    "currency": ALLOWED_CURRENCIES,
+}
+
+
+def _parse_day(value, end=False):
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    # A bare date as end_date covers that whole day
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+
+def bulk_filter(user_id, spec):
+    """
+    Turn a filter object from the request body into WHERE clauses on the
+    user's expenses. Raises ValueError for unknown keys or bad values, and
+    for an empty filter: wiping everything is what DELETE /expenses is for.
+    """
+    if not isinstance(spec, dict) or not spec:
+        raise ValueError("filter must be a non-empty object")
+    unknown = set(spec) - {"ids", "category", "currency", "start_date", "end_date", "min_amount", "max_amount"}
+    if unknown:
+        raise ValueError(f"Unknown filter keys: {', '.join(sorted(unknown))}")
+
+    conditions = [Expense.user_id == user_id]
+    if "ids" in spec:
+        ids = spec["ids"]
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            raise ValueError("ids must be a list of integers")
+        conditions.append(Expense.id.in_(ids))
+    if "category" in spec:
+        conditions.append(Expense.category == spec["category"])
+    if "currency" in spec:
+        conditions.append(Expense.currency == spec["currency"])
+    if "start_date" in spec:
+        conditions.append(Expense.date >= _parse_day(spec["start_date"]))
+    if "end_date" in spec:
+        conditions.append(Expense.date < _parse_day(spec["end_date"], end=True))
+    if "min_amount" in spec:
+        conditions.append(Expense.amount >= float(spec["min_amount"]))
+    if "max_amount" in spec:
+        conditions.append(Expense.amount <= float(spec["max_amount"]))
+    return conditions
+
+
+def _next_chunk(conditions, chunk_size, *columns):
+    return db.session.execute(
+        select(Expense.id, *columns).where(*conditions).order_by(Expense.id).limit(chunk_size)
+    ).all()
+
+
+def bulk_delete(user_id, conditions, chunk_size=500):
+    """
+    Delete the matching expenses chunk_size rows per transaction, keeping the
+    monthly totals in step. Returns the number of deleted expenses.
+    """
+    deleted = 0
+    while True:
+        rows = _next_chunk(conditions, chunk_size, Expense.date, Expense.amount)
+        if not rows:
+            break
+        ids = [row.id for row in rows]
+
+        deltas = spend_deltas()
+        for row in rows:
+            deltas[month_key(row.date)] -= float(row.amount)
+        # Before the delete, so a first-seen month is seeded with these rows
+        apply_spend(user_id, deltas)
+
+        db.session.execute(delete(ExpenseHistory).where(ExpenseHistory.expense_id.in_(ids)))
+        db.session.execute(delete(ExpenseHistoryArchive).where(ExpenseHistoryArchive.expense_id.in_(ids)))
+        db.session.execute(delete(Expense).where(Expense.id.in_(ids)))
+        invalidate_analytics(user_id)
+        db.session.commit()
+        deleted += len(ids)
+
+    if deleted:
+        backfill_category_stats(user_id)
+    return deleted
+
+
+def bulk_update(user_id, conditions, values, chunk_size=500):
+    """
+    Set values on the matching expenses chunk_size rows per transaction. Each
+    chunk writes one history row per expense in a single executemany INSERT,
+    then changes the rows with a single UPDATE. Returns the number of changed
+    expenses.
+    """
+    # Rows already holding the new values would be picked again forever
+    pending = conditions + [or_(*(getattr(Expense, field) != value for field, value in values.items()))]
+
+    columns = [getattr(Expense, field) for field in values]
+    updated = 0
+    while True:
+        rows = _next_chunk(pending, chunk_size, *columns)
+        if not rows:
+            break
+        ids = [row.id for row in rows]
+
+        now = datetime.now(timezone.utc)
+        history = []
+        for row in rows:
+            changes = {
+                field: (getattr(row, field), value)
+                for field, value in values.items()
+                if getattr(row, field) != value
+            }
+            history.append(history_row(row.id, user_id, changes, now))
+        db.session.execute(insert(ExpenseHistory), history)
+        db.session.execute(
+            update(Expense).where(Expense.id.in_(ids)).values(**values, last_modified=now),
+            execution_options={"synchronize_session": False}
+        )
+        invalidate_analytics(user_id)
+        db.session.commit()
+        updated += len(ids)
+
+    if updated and "category" in values:
+        backfill_category_stats(user_id)
+    return updated
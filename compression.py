@@ -0,0 +1,98 @@
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+
+# Formats that are already compressed; running them through gzip again only costs CPU
+SKIP_MIMETYPES = {
+    "application/gzip",
+    "application/zip",
+    "application/pdf",
+    "application/octet-stream",
+}
+SKIP_PREFIXES = ("image/", "video/", "audio/")
+
+
+def _gzip_compressor(level):
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+def _choose_encoding(request):
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(offered)
+
+
+def _compressible(response, min_size):
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        return False
+    mimetype = response.mimetype or ""
+    if mimetype in SKIP_MIMETYPES or mimetype.startswith(SKIP_PREFIXES):
+        return False
+    if response.is_streamed:
+        return True
+    return response.content_length is not None and response.content_length >= min_size
+
+
+def _stream(chunks, encoding, config):
+    """Compress a streamed body chunk by chunk, flushing so clients see rows as they arrive."""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=config.get("COMPRESS_BR_QUALITY", 4))
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+        return
+
+    compressor = _gzip_compressor(config.get("COMPRESS_LEVEL", 6))
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def compress_response(response, request, config):
+    if not _compressible(response, config.get("COMPRESS_MIN_SIZE", 500)):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = _choose_encoding(request)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _stream(response.response, encoding, config)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if encoding == "br":
+            body = brotli.compress(data, quality=config.get("COMPRESS_BR_QUALITY", 4))
+        else:
+            compressor = _gzip_compressor(config.get("COMPRESS_LEVEL", 6))
+            body = compressor.compress(data) + compressor.flush()
+        response.set_data(body)
+
+    response.headers["Content-Encoding"] = encoding
+    if response.headers.get("ETag"):
+        # The representation changed, a strong validator no longer matches it
+        etag, weak = response.get_etag()
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    """Compress responses in an after_request hook unless COMPRESS_ENABLED is False."""
+
+    @app.after_request
+    def _compress(response):
+        if not app.config.get("COMPRESS_ENABLED", True):
+            return response
+        return compress_response(response, request, app.config)
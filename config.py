@@ -35,6 +35,14 @@ ALLOWED_RECURRING_FREQUENCIES = {
     "yearly": relativedelta(years=1),
 }
 
+# Percentages of monthly_budget that trigger a one-off alert per month
+BUDGET_ALERT_THRESHOLDS = (80, 100)
+
+# An expense is flagged when it sits this many standard deviations above the
+# user's mean for the category, once the category has enough history
+ANOMALY_Z_THRESHOLD = 3.0
+ANOMALY_MIN_SAMPLES = 5
+
 
 class Config:
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL")
@@ -44,7 +52,87 @@ class Config:
     UPLOAD_FOLDER = UPLOAD_FOLDER
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=30)
     JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=7)
+    # Seconds between a worker picking up tokens revoked by other workers
+    JWT_BLOCKLIST_SYNC_INTERVAL = int(os.getenv("JWT_BLOCKLIST_SYNC_INTERVAL", 5))
     FRONTEND_URL = os.getenv("FRONTEND_URL")
+    REPORT_RENDER_WORKERS = int(os.getenv("REPORT_RENDER_WORKERS", 2))
+    REPORT_RENDER_MEMORY_MB = int(os.getenv("REPORT_RENDER_MEMORY_MB", 512))
+    REPORT_RENDER_TIMEOUT = 120
+    REPORT_CACHE_DIR = os.getenv("REPORT_CACHE_DIR")
+    REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", 500 * 1024 * 1024))
+    REPORT_CACHE_TTL = 7 * 24 * 3600
+    REPORT_CSV_COMPRESSION = os.getenv("REPORT_CSV_COMPRESSION", "gzip")
+    REPORT_ATTACHMENT_MAX_BYTES = int(os.getenv("REPORT_ATTACHMENT_MAX_BYTES", 10 * 1024 * 1024))
+    REPORT_LINK_TTL = 72 * 3600
+    IMPORT_UPLOAD_DIR = os.getenv("IMPORT_UPLOAD_DIR")
+    IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 500))
+    # An unfinished import without progress for this long died with its worker
+    IMPORT_STALE_AFTER = int(os.getenv("IMPORT_STALE_AFTER", 600))
+    BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", 500))
+    ACCOUNT_DELETE_CHUNK_SIZE = int(os.getenv("ACCOUNT_DELETE_CHUNK_SIZE", 1000))
+    # How long the status link returned by DELETE /user/delete keeps working
+    ACCOUNT_DELETION_STATUS_TTL = int(os.getenv("ACCOUNT_DELETION_STATUS_TTL", 7 * 24 * 3600))
+    # Per table overrides of retention.DEFAULT_POLICIES
+    RETENTION_POLICIES = {
+        "password_reset_tokens": {"grace_hours": int(os.getenv("RETENTION_RESET_TOKEN_GRACE_HOURS", 24))},
+        "reminder_logs": {"keep_days": int(os.getenv("RETENTION_REMINDER_LOG_DAYS", 90))},
+        "expense_history": {"keep_months": int(os.getenv("RETENTION_HISTORY_MONTHS", 12))},
+        "fcm_tokens": {"stale_days": int(os.getenv("FCM_TOKEN_STALE_DAYS", 60))},
+    }
+    IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 24 * 3600))
+    # A request still unanswered after this long is taken to have died with
+    # its worker and is run again; one that is only slow loses its write.
+    # Keep it above the gunicorn worker timeout
+    IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", 60))
+    RATELIMIT_ENABLED = os.getenv("RATELIMIT_ENABLED", "True") == "True"
+    # e.g. redis://localhost:6379/0 to share the counters between workers
+    RATELIMIT_STORAGE_URL = os.getenv("RATELIMIT_STORAGE_URL")
+    # Overrides of ratelimit.DEFAULT_RULES: {"login": {"ip": (20, 60)}}
+    RATELIMIT_RULES = {}
+    # Number of proxies in front of the app whose X-Forwarded-For and
+    # X-Forwarded-Proto are trusted (1 for the platform router); 0 when
+    # clients connect directly, or they could spoof their address
+    PROXY_FIX_X_FOR = int(os.getenv("PROXY_FIX_X_FOR", 1))
+    PROXY_FIX_X_PROTO = int(os.getenv("PROXY_FIX_X_PROTO", 1))
+    # Werkzeug hash method with its cost parameters; changing it rehashes
+    # passwords as their owners log in
+    PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+    PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", 32))
+    PASSWORD_HASH_TIMEOUT = int(os.getenv("PASSWORD_HASH_TIMEOUT", 10))
+    RETENTION_CHUNK_SIZE = int(os.getenv("RETENTION_CHUNK_SIZE", 1000))
+    # Outbox delivery: poll every OUTBOX_POLL_INTERVAL seconds, retry after
+    # about 30s, 60s, 120s ... capped at OUTBOX_RETRY_MAX, give up after
+    # OUTBOX_MAX_ATTEMPTS. A claimed message is retried by any worker once
+    # OUTBOX_LEASE seconds pass without a result.
+    OUTBOX_POLL_INTERVAL = int(os.getenv("OUTBOX_POLL_INTERVAL", 5))
+    OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+    OUTBOX_RETRY_BASE = int(os.getenv("OUTBOX_RETRY_BASE", 30))
+    OUTBOX_RETRY_MAX = int(os.getenv("OUTBOX_RETRY_MAX", 3600))
+    OUTBOX_LEASE = int(os.getenv("OUTBOX_LEASE", 300))
+    # Shared secret for GET /metrics (X-Metrics-Token header); unset hides it
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+    COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "True") == "True"
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_LEVEL = 6
+    COMPRESS_BR_QUALITY = 4
+    # Let the front end server send upload bytes: Flask's own X-Sendfile switch,
+    # or an nginx internal location for X-Accel-Redirect
+    USE_X_SENDFILE = os.getenv("USE_X_SENDFILE") == "True"
+    MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv("MEDIA_ACCEL_REDIRECT_PREFIX")
+    # Whole request body cap, enforced by Werkzeug before the form is parsed.
+    # Sized for statement imports; the picture upload route lowers it to
+    # UPLOAD_MAX_BYTES (plus multipart overhead) for its own requests
+    MAX_CONTENT_LENGTH = int(os.getenv("MAX_CONTENT_LENGTH", 60 * 1024 * 1024))
+    UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 5 * 1024 * 1024))
+    # "local" keeps uploads and reports on disk, "s3" puts them in S3_BUCKET
+    # (any S3 compatible endpoint, needs boto3) and serves presigned URLs
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+    S3_BUCKET = os.getenv("S3_BUCKET")
+    S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+    S3_REGION = os.getenv("S3_REGION")
+    UPLOAD_URL_TTL = int(os.getenv("UPLOAD_URL_TTL", 3600))
 
 if __name__ == "__main__":
 
@@ -3,9 +3,18 @@ from flask_migrate import Migrate
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy.dialects import postgresql, sqlite
 
 db = SQLAlchemy()
 migrate = Migrate()
 jwt = JWTManager()
 cors = CORS()
 scheduler = BackgroundScheduler()
+
+# Dialects whose insert() supports ON CONFLICT
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def upsert_insert(model):
+    """insert(model) for the engine in use, with on_conflict_do_nothing / _do_update."""
+    return UPSERT_INSERTS[db.engine.dialect.name](model)
@@ -0,0 +1,107 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+from metrics import metrics
+
+
+class HashingBusy(Exception):
+    """Every hashing slot is taken; the request should fail fast with a 503."""
+
+
+class PasswordHasher:
+    """
+    Runs password hashing in a small process pool so a burst of logins costs
+    at most `workers` cores instead of tying up every request thread, and
+    keeps other endpoints responsive. At most `queue_limit` hashes are in
+    flight; beyond that callers get HashingBusy immediately rather than
+    queueing behind work that will outlive their request. workers=0 hashes
+    inline, still under the same limit.
+    """
+
+    def __init__(self, method, workers=2, queue_limit=32, timeout=10):
+        self.method = method
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._pool = ProcessPoolExecutor(max_workers=workers) if workers else None
+        self._prefix = None
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            metrics.incr("password_hash.rejected")
+            raise HashingBusy()
+        if self._pool is None:
+            try:
+                return fn(*args)
+            finally:
+                self._slots.release()
+
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is held until the work is really over, not just until the
+        # caller stops waiting, so abandoned hashes still count against the
+        # limit and the pool's backlog stays bounded by it
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # Drops it if still queued; a hash already running finishes
+            future.cancel()
+            metrics.incr("password_hash.timeouts")
+            raise HashingBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True when pwhash was made with other parameters than the configured ones."""
+        if self._prefix is None:
+            # Werkzeug fills in defaults ("scrypt" -> "scrypt:32768:8:1"), so
+            # learn the full prefix from a hash of our own
+            self._prefix = generate_password_hash("", self.method).split("$", 1)[0]
+        return pwhash.split("$", 1)[0] != self._prefix
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def get_hasher(app=None):
+    app = app or current_app._get_current_object()
+    hasher = app.extensions.get("password_hasher")
+    if hasher is None:
+        hasher = app.extensions["password_hasher"] = PasswordHasher(
+            app.config.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1"),
+            workers=app.config.get("PASSWORD_HASH_WORKERS", 2),
+            queue_limit=app.config.get("PASSWORD_HASH_QUEUE_LIMIT", 32),
+            timeout=app.config.get("PASSWORD_HASH_TIMEOUT", 10)
+        )
+    return hasher
+
+
+def hash_password(password):
+    return get_hasher().hash(password)
+
+
+def verify_password(user, password):
+    """
+    Check password against user.password, upgrading the stored hash when it
+    was made with older parameters. The caller commits.
+    """
+    hasher = get_hasher()
+    if not hasher.check(user.password, password):
+        return False
+    if hasher.needs_rehash(user.password):
+        try:
+            user.password = hasher.hash(password)
+            metrics.incr("password_hash.rehashed")
+        except HashingBusy:
+            # The login is still good; upgrade next time
+            pass
+    return True
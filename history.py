@@ -0,0 +1,105 @@
+import json
+import zlib
+from datetime import date, datetime
+from sqlalchemy import select, func
+from extensions import db
+from models import ExpenseHistory, ExpenseHistoryArchive
+
+
+# The expense fields an edit can change, in the order versions list them
+TRACKED_FIELDS = ("title", "currency", "amount", "date", "category", "description")
+
+
+def history_value(value):
+    """JSON friendly form of a field value as stored in a diff."""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def expense_state(expense):
+    return {field: history_value(getattr(expense, field)) for field in TRACKED_FIELDS}
+
+
+def history_row(expense_id, user_id, changes, timestamp=None):
+    """Column values for one edit, ready for insert(ExpenseHistory)."""
+    row = {
+        "expense_id": expense_id,
+        "user_id": user_id,
+        "changes": {field: [history_value(old), history_value(new)] for field, (old, new) in changes.items()},
+    }
+    if timestamp is not None:
+        row["timestamp"] = timestamp
+    return row
+
+
+def pack_history(rows):
+    """Compress history rows (id, changes, timestamp) for the archive table."""
+    data = [[row.id, row.changes, history_value(row.timestamp)] for row in rows]
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode(), 9)
+
+
+def unpack_history(payload):
+    return json.loads(zlib.decompress(payload))
+
+
+def edit_count(expense_id):
+    """Edits of an expense, archived ones included."""
+    archived = db.session.query(func.coalesce(func.sum(ExpenseHistoryArchive.row_count), 0)).filter(
+        ExpenseHistoryArchive.expense_id == expense_id
+    ).scalar()
+    live = db.session.query(func.count(ExpenseHistory.id)).filter(
+        ExpenseHistory.expense_id == expense_id
+    ).scalar()
+    return archived + live
+
+
+def _changes_after(expense_id, version):
+    """The diffs of every edit after the version-th one, oldest first."""
+    archives = db.session.execute(
+        select(ExpenseHistoryArchive.row_count, ExpenseHistoryArchive.payload)
+        .where(ExpenseHistoryArchive.expense_id == expense_id)
+        .order_by(ExpenseHistoryArchive.first_id)
+    ).all()
+    skip = version
+    for row_count, payload in archives:
+        if skip >= row_count:
+            # Never decompressed: the whole batch is before the version
+            skip -= row_count
+            continue
+        for _, changes, _ in unpack_history(payload)[skip:]:
+            yield changes
+        skip = 0
+
+    live = db.session.execute(
+        select(ExpenseHistory.changes)
+        .where(ExpenseHistory.expense_id == expense_id)
+        .order_by(ExpenseHistory.id)
+        .offset(skip)
+        .execution_options(yield_per=100)
+    ).scalars()
+    try:
+        yield from live
+    finally:
+        live.close()
+
+
+def reconstruct_version(expense, version):
+    """
+    The expense as it was after its version-th edit (0 is as created).
+    Walking forward from that edit, the first diff touching a field holds the
+    field's value at that point; fields no later edit touched are unchanged.
+    The walk stops as soon as every field is accounted for, so only the edits
+    up to the last change of each field are read.
+    """
+    state = expense_state(expense)
+    pending = set(TRACKED_FIELDS)
+    later = _changes_after(expense.id, version)
+    for changes in later:
+        for field in pending.intersection(changes):
+            state[field] = changes[field][0]
+            pending.discard(field)
+        if not pending:
+            break
+    later.close()
+    return state
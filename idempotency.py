@@ -0,0 +1,195 @@
+import hashlib
+from datetime import datetime, timezone, timedelta
+from functools import wraps
+from flask import request, jsonify, make_response, current_app, g
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import update, delete
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+from models import IdempotencyRecord
+from metrics import metrics
+
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+
+def _request_hash():
+    digest = hashlib.sha256()
+    digest.update(f"{request.method} {request.path}\n".encode())
+    digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+
+def _replay(record):
+    response = current_app.response_class(record.body, status=record.status_code, mimetype=record.mimetype)
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _aware(value):
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def _in_progress():
+    return jsonify({"error": "A request with this Idempotency-Key is still in progress"}), 409
+
+
+def _owned(claim):
+    """
+    Match the record while this request still holds it. created_at doubles
+    as the claim token: a takeover moves it, after which the request that
+    was taken over can no longer store its response.
+    """
+    user_id, key, claimed_at = claim
+    return (
+        (IdempotencyRecord.user_id == user_id)
+        & (IdempotencyRecord.key == key)
+        & (IdempotencyRecord.created_at == claimed_at)
+        & IdempotencyRecord.status_code.is_(None)
+    )
+
+
+def _take_over(record, now, ttl):
+    """
+    Reclaim an in-progress record whose request has held it longer than
+    IDEMPOTENCY_LOCK_TIMEOUT. A response is stored in the same transaction
+    as the write it answers, so an unanswered record means no write was
+    committed and the view can run again. The update only matches while the
+    claim is still stale, so of two retries taking over at once exactly one
+    wins.
+    """
+    timeout = current_app.config.get("IDEMPOTENCY_LOCK_TIMEOUT", 60)
+    if _aware(record.created_at) > now - timedelta(seconds=timeout):
+        return False
+    claimed = db.session.execute(
+        update(IdempotencyRecord).where(
+            IdempotencyRecord.id == record.id,
+            IdempotencyRecord.status_code.is_(None),
+            IdempotencyRecord.created_at < now - timedelta(seconds=timeout)
+        ).values(created_at=now, expires_at=now + timedelta(seconds=ttl)),
+        execution_options={"synchronize_session": False}
+    ).rowcount
+    db.session.commit()
+    if claimed:
+        metrics.incr("idempotency.reclaimed")
+    return bool(claimed)
+
+
+def _claim(user_id, key, request_hash):
+    """
+    Insert the in-progress record for key. Returns None when this request
+    owns the key, otherwise the response to send instead. The claim is kept
+    on g for commit_response.
+    """
+    now = datetime.now(timezone.utc)
+    ttl = current_app.config.get("IDEMPOTENCY_TTL", 24 * 3600)
+    record = IdempotencyRecord.query.filter_by(user_id=user_id, key=key).first()
+    if record is not None:
+        if _aware(record.expires_at) > now:
+            if record.request_hash != request_hash:
+                return jsonify({"error": f"{IDEMPOTENCY_HEADER} was already used for a different request"}), 422
+            if record.status_code is None:
+                if _take_over(record, now, ttl):
+                    g.idempotency_claim = (user_id, key, now)
+                    return None
+                return _in_progress()
+            metrics.incr("idempotency.replayed")
+            return _replay(record)
+        db.session.delete(record)
+
+    db.session.add(IdempotencyRecord(
+        user_id=user_id,
+        key=key,
+        request_hash=request_hash,
+        created_at=now,
+        expires_at=now + timedelta(seconds=ttl)
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent retry claimed the key between our read and insert
+        db.session.rollback()
+        return _in_progress()
+    g.idempotency_claim = (user_id, key, now)
+    return None
+
+
+def _store(claim, response):
+    return db.session.execute(update(IdempotencyRecord).where(_owned(g.idempotency_claim)).values(
+        status_code=response.status_code,
+        mimetype=response.mimetype,
+        body=response.get_data()
+    ), execution_options={"synchronize_session": False}).rowcount
+
+
+def commit_response(rv):
+    """
+    Commit the session along with the response an idempotent view returns.
+    Views behind @idempotent call this in place of db.session.commit() for
+    their write, so the write and the stored response land in one
+    transaction: a retry either replays the response or finds that nothing
+    was written. When the claim was taken over while the view ran, the
+    write is rolled back and the client is told the key is in use.
+    """
+    response = make_response(rv)
+    claim = g.get("idempotency_claim")
+    if claim is not None and response.status_code < 500:
+        if not _store(claim, response):
+            db.session.rollback()
+            return _in_progress()
+        db.session.commit()
+        g.idempotency_stored = True
+        return response
+    db.session.commit()
+    return response
+
+
+def idempotent(view):
+    """
+    Make a JWT protected write endpoint safe to retry. A request carrying an
+    Idempotency-Key header runs once per user and key; retries within
+    IDEMPOTENCY_TTL get the stored response back instead of running again.
+    Responses with a 5xx status are not stored, so those can be retried.
+    A claim left behind by a crashed worker blocks retries with a 409 for
+    IDEMPOTENCY_LOCK_TIMEOUT seconds at most.
+
+    The view must commit its write through commit_response. Responses of
+    views that return without committing, such as validation errors, are
+    stored here afterwards.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({"error": f"{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters"}), 400
+
+        user_id = int(get_jwt_identity())
+        request_hash = _request_hash()
+        conflict = _claim(user_id, key, request_hash)
+        if conflict is not None:
+            return conflict
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            db.session.execute(delete(IdempotencyRecord).where(_owned(g.idempotency_claim)),
+                               execution_options={"synchronize_session": False})
+            db.session.commit()
+            raise
+
+        if g.get("idempotency_stored"):
+            return response
+        if response.status_code >= 500:
+            db.session.execute(delete(IdempotencyRecord).where(_owned(g.idempotency_claim)),
+                               execution_options={"synchronize_session": False})
+        else:
+            _store(g.idempotency_claim, response)
+        db.session.commit()
+        return response
+
+    return wrapper
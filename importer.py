@@ -0,0 +1,334 @@
+import os
+import re
+import time
+import csv
+import json
+from datetime import datetime, timezone, timedelta
+from sqlalchemy import insert, select, update, func, tuple_
+from flask import current_app
+from extensions import db
+from models import Expense, ImportJob
+from config import ALLOWED_CATEGORIES, ALLOWED_CURRENCIES
+from budget import spend_deltas, month_key, apply_spend, enqueue_budget_alerts
+from analytics import invalidate_analytics
+from anomaly import backfill_category_stats
+from metrics import metrics
+
+
+IMPORT_FORMATS = ("csv", "ofx")
+
+# Expense field -> column header expected in the uploaded CSV
+DEFAULT_COLUMN_MAPPING = {
+    "date": "date",
+    "title": "title",
+    "amount": "amount",
+    "currency": "currency",
+    "category": "category",
+    "description": "description",
+}
+
+MAX_STORED_ERRORS = 50
+
+
+class _ByteCounter:
+    """Iterate a binary file as decoded lines while tracking how far we have read."""
+
+    def __init__(self, file):
+        self.file = file
+        self.bytes_read = 0
+
+    def __iter__(self):
+        for raw in self.file:
+            self.bytes_read += len(raw)
+            yield raw.decode("utf-8-sig", errors="replace")
+
+
+def iter_csv_rows(lines, mapping):
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, {field: row.get(column) for field, column in mapping.items()}
+
+
+_OFX_TAG = re.compile(r"<(/?)([A-Z0-9.]+)>([^<\r\n]*)")
+
+
+def iter_ofx_rows(lines):
+    """
+    Stream STMTTRN records out of an OFX 1.x (SGML) or 2.x (XML) statement.
+    Only debits are yielded; credits are not expenses.
+    """
+    currency = None
+    txn = None
+    line_num = 0
+    for line in lines:
+        line_num += 1
+        for closing, tag, value in _OFX_TAG.findall(line):
+            value = value.strip()
+            if tag == "CURDEF" and not closing:
+                currency = value
+            elif tag == "STMTTRN":
+                if not closing:
+                    txn = {}
+                elif txn is not None:
+                    yield line_num, _ofx_row(txn, currency)
+                    txn = None
+            elif txn is not None and not closing and value:
+                txn[tag] = value
+
+
+def _ofx_row(txn, currency):
+    amount = txn.get("TRNAMT")
+    posted = txn.get("DTPOSTED", "")
+    return {
+        "date": f"{posted[:4]}-{posted[4:6]}-{posted[6:8]}" if len(posted) >= 8 else posted,
+        "title": txn.get("NAME") or txn.get("MEMO"),
+        "amount": amount,
+        "currency": currency,
+        "category": None,
+        "description": txn.get("MEMO") if txn.get("NAME") else None,
+        "debit": amount is not None and amount.strip().startswith("-"),
+    }
+
+
+def _parse_amount(value):
+    cleaned = str(value).strip().replace(",", "").lstrip("$€£")
+    if cleaned.startswith("(") and cleaned.endswith(")"):
+        cleaned = "-" + cleaned[1:-1]
+    return round(abs(float(cleaned)), 2)
+
+
+def _parse_date(value, date_format):
+    value = str(value).strip()
+    parsed = datetime.strptime(value, date_format) if date_format else datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def validate_row(raw, defaults, date_format=None):
+    """Turn a mapped raw row into Expense column values, raising ValueError when invalid."""
+    if raw.get("debit") is False:
+        raise ValueError("not a debit")
+
+    title = (raw.get("title") or "").strip()
+    if not title:
+        raise ValueError("missing title")
+    if not raw.get("amount"):
+        raise ValueError("missing amount")
+    if not raw.get("date"):
+        raise ValueError("missing date")
+
+    try:
+        amount = _parse_amount(raw["amount"])
+    except ValueError:
+        raise ValueError(f"invalid amount {raw['amount']!r}")
+    try:
+        date = _parse_date(raw["date"], date_format)
+    except ValueError:
+        raise ValueError(f"invalid date {raw['date']!r}")
+
+    currency = (raw.get("currency") or defaults["currency"] or "").strip().upper()
+    if currency not in ALLOWED_CURRENCIES:
+        raise ValueError(f"invalid currency {currency!r}")
+    category = (raw.get("category") or defaults["category"] or "").strip()
+    if category not in ALLOWED_CATEGORIES:
+        raise ValueError(f"invalid category {category!r}")
+
+    return {
+        "title": title[:100],
+        "amount": amount,
+        "currency": currency,
+        "category": category,
+        "date": date,
+        "description": (raw.get("description") or "").strip()[:255] or None,
+    }
+
+
+def _dedupe_key(date, amount, title):
+    # SQLite hands back naive UTC datetimes, Postgres aware ones
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date, round(amount, 2), title
+
+
+def _existing_keys(user_id, rows):
+    keys = {(row["date"], row["amount"], row["title"]) for row in rows}
+    existing = db.session.execute(
+        select(Expense.date, Expense.amount, Expense.title).where(
+            Expense.user_id == user_id,
+            tuple_(Expense.date, Expense.amount, Expense.title).in_(keys)
+        )
+    )
+    return {_dedupe_key(*row) for row in existing}
+
+
+def import_chunk(user_id, rows):
+    """
+    Insert one validated chunk as a batched INSERT, skipping rows
+    that already exist. Earlier chunks are already in the table, so only
+    repeats within this chunk need tracking in memory.
+    Returns (inserted, duplicates, budget alerts).
+    """
+    existing = _existing_keys(user_id, rows)
+    seen = set()
+    fresh = []
+    deltas = spend_deltas()
+    for row in rows:
+        key = _dedupe_key(row["date"], row["amount"], row["title"])
+        if key in existing or key in seen:
+            continue
+        seen.add(key)
+        fresh.append(dict(row, user_id=user_id))
+        deltas[month_key(row["date"])] += row["amount"]
+
+    if not fresh:
+        return 0, len(rows), []
+
+    # Totals first: a month seeded from the table must not already include this chunk
+    alerts = apply_spend(user_id, deltas)
+    # executemany of one cached statement; the Postgres driver sends it as
+    # multi-row VALUES batches, which avoids compiling a 500-row VALUES clause
+    db.session.execute(insert(Expense), fresh)
+    return len(fresh), len(rows) - len(fresh), alerts
+
+
+def _save_progress(job, reader, errors):
+    job.updated_at = datetime.now(timezone.utc)
+    job.bytes_read = reader.bytes_read
+    job.errors = json.dumps(errors) if errors else None
+    db.session.commit()
+
+
+def run_import(job_id, file_path, options, app):
+    """
+    Background job: stream the uploaded file, validate and insert it chunk by
+    chunk, committing progress after each chunk so the status endpoint can
+    report it while the import runs.
+    """
+    with app.app_context():
+        job = db.session.get(ImportJob, job_id)
+        if job is None:
+            return
+
+        chunk_size = app.config.get("IMPORT_CHUNK_SIZE", 500)
+        defaults = {"currency": options.get("currency"), "category": options.get("category") or "Others"}
+        job.status = "running"
+        job.updated_at = datetime.now(timezone.utc)
+        db.session.commit()
+
+        errors = []
+        chunk = []
+        started = time.monotonic()
+        try:
+            with open(file_path, "rb") as f:
+                reader = _ByteCounter(f)
+                if job.file_format == "ofx":
+                    rows = iter_ofx_rows(reader)
+                else:
+                    rows = iter_csv_rows(reader, options.get("mapping") or DEFAULT_COLUMN_MAPPING)
+
+                for line_num, raw in rows:
+                    job.processed_rows += 1
+                    try:
+                        chunk.append(validate_row(raw, defaults, options.get("date_format")))
+                    except ValueError as e:
+                        job.invalid_rows += 1
+                        if len(errors) < MAX_STORED_ERRORS:
+                            errors.append(f"line {line_num}: {e}")
+
+                    if len(chunk) >= chunk_size:
+                        _flush_chunk(job, chunk)
+                        chunk = []
+                        _save_progress(job, reader, errors)
+
+                if chunk:
+                    _flush_chunk(job, chunk)
+                _save_progress(job, reader, errors)
+
+            if job.imported_rows:
+                # One set-based rebuild is far cheaper than scoring every imported row
+                backfill_category_stats(job.user_id)
+
+            job.status = "completed"
+        except Exception as e:
+            db.session.rollback()
+            job = db.session.get(ImportJob, job_id)
+            job.status = "failed"
+            errors.append(f"import failed: {e}")
+            job.errors = json.dumps(errors[-MAX_STORED_ERRORS:])
+        finally:
+            job.finished_at = datetime.now(timezone.utc)
+            db.session.commit()
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+        elapsed = time.monotonic() - started
+        metrics.observe("import.rows", job.processed_rows)
+        metrics.observe("import.seconds", elapsed)
+        print(
+            f"Import {job.id} {job.status}: {job.imported_rows} imported, "
+            f"{job.duplicate_rows} duplicates, {job.invalid_rows} invalid in {elapsed:.1f}s"
+        )
+
+
+def fail_orphaned_imports(app):
+    """
+    Fail imports whose worker went away. A job only lives in the scheduler
+    memory of the process that took the upload, so after a restart nothing
+    will finish it. One that has not committed progress for
+    IMPORT_STALE_AFTER seconds is taken to be lost; the user uploads again,
+    and rows it already imported are skipped as duplicates.
+    """
+    with app.app_context():
+        now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(seconds=app.config.get("IMPORT_STALE_AFTER", 600))
+        failed = db.session.execute(
+            update(ImportJob)
+            .where(
+                ImportJob.status.in_(("pending", "running")),
+                func.coalesce(ImportJob.updated_at, ImportJob.created_at) < cutoff
+            )
+            .values(
+                status="failed",
+                finished_at=now,
+                errors=json.dumps(["import interrupted by a restart, please upload the file again"])
+            ),
+            execution_options={"synchronize_session": False}
+        ).rowcount
+        db.session.commit()
+    if failed:
+        print(f"Marked {failed} orphaned imports as failed")
+    return failed
+
+
+def _flush_chunk(job, chunk):
+    inserted, duplicates, alerts = import_chunk(job.user_id, chunk)
+    job.imported_rows += inserted
+    job.duplicate_rows += duplicates
+    enqueue_budget_alerts(alerts)
+    if inserted:
+        invalidate_analytics(job.user_id)
+    db.session.commit()
+
+
+def job_progress(job):
+    return {
+        "id": job.id,
+        "status": job.status,
+        "filename": job.filename,
+        "format": job.file_format,
+        "progress": round(job.bytes_read / job.bytes_total * 100, 1) if job.bytes_total else 0.0,
+        "processed_rows": job.processed_rows,
+        "imported_rows": job.imported_rows,
+        "duplicate_rows": job.duplicate_rows,
+        "invalid_rows": job.invalid_rows,
+        "errors": json.loads(job.errors) if job.errors else [],
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def import_dir():
+    path = current_app.config.get("IMPORT_UPLOAD_DIR") or os.path.join(current_app.root_path, "uploads", "imports")
+    os.makedirs(path, exist_ok=True)
+    return path
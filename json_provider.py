@@ -0,0 +1,54 @@
+from datetime import date, datetime
+from flask.json.provider import DefaultJSONProvider
+from serializers import Rows
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; falls back to the stdlib encoder
+    orjson = None
+
+
+def _default(o):
+    if isinstance(o, Rows):
+        return o.to_json()
+    if isinstance(o, (date, datetime)):
+        # ISO 8601 like orjson, rather than Flask's RFC 822 HTTP dates
+        return o.isoformat()
+    return DefaultJSONProvider.default(o)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson when it is installed. orjson encodes
+    datetime and date natively and returns bytes, which response() hands to
+    the response object without a str round trip.
+    """
+
+    default = staticmethod(_default)
+
+    def _options(self, pretty=False):
+        option = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        pretty = (self.compact is None and self._app.debug) or self.compact is False
+        body = orjson.dumps(obj, default=self.default, option=self._options(pretty))
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
@@ -0,0 +1,163 @@
+import os
+import re
+import hashlib
+import tempfile
+import mimetypes
+from flask import Request, request, current_app, send_from_directory, redirect, abort
+from werkzeug.exceptions import RequestEntityTooLarge
+
+
+# One year, the longest lifetime caches are asked to honour
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# user_<id>_<content hash>[_<thumbnail size>].<ext>
+_VERSIONED_NAME = re.compile(r"^user_\d+_[0-9a-f]{16}(_\d+)?\.[a-z]+$")
+
+# Leading bytes of the image formats we accept -> extension to store them under
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+)
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Room for the multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD = 16 * 1024
+
+
+class InvalidUpload(ValueError):
+    pass
+
+
+class CappedRequest(Request):
+    """
+    Request whose body cap a view can lower below MAX_CONTENT_LENGTH (Flask
+    2.3 only has the app wide one). Werkzeug checks the cap before parsing
+    the form: a declared Content-Length over it is refused unread, and a
+    body without one stops being read at the cap.
+    """
+
+    body_limit = None
+
+    @property
+    def max_content_length(self):
+        app_limit = super().max_content_length
+        if self.body_limit is None:
+            return app_limit
+        return min(self.body_limit, app_limit) if app_limit else self.body_limit
+
+
+def limit_upload_body(max_bytes):
+    """Cap the current request at one file of max_bytes; call before touching request.files."""
+    if max_bytes and isinstance(request, CappedRequest):
+        request.body_limit = max_bytes + MULTIPART_OVERHEAD
+
+
+def hashed_filename(user_id, digest, extension):
+    """Name an upload after its content so a new picture always gets a new URL."""
+    return f"user_{user_id}_{digest[:16]}.{extension.lower().lstrip('.')}"
+
+
+def sniff_image(head):
+    for signature, extension in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return None
+
+
+def save_upload(stream, storage, user_id, max_bytes=None):
+    """
+    Copy an uploaded image into storage in fixed size chunks, checking its
+    magic bytes on the first chunk and its size as it goes, hashing it on the
+    way. The data lands in a temp file that is moved into place only when
+    complete, so readers never see a partial picture. Returns the key.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=f"user_{user_id}_", suffix=".part", dir=storage.temp_dir())
+    digest = hashlib.sha256()
+    written = 0
+    extension = None
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+                if extension is None:
+                    extension = sniff_image(chunk)
+                    if extension is None:
+                        raise InvalidUpload("File content is not a PNG or JPEG image")
+                written += len(chunk)
+                if max_bytes and written > max_bytes:
+                    raise RequestEntityTooLarge()
+                digest.update(chunk)
+                out.write(chunk)
+        if extension is None:
+            raise InvalidUpload("Empty file")
+
+        filename = hashed_filename(user_id, digest.hexdigest(), extension)
+        storage.put_file(tmp_path, filename, move=True)
+        return filename
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def remove_previous_uploads(storage, user_id, keep, folders=("", "thumbnails/")):
+    """Delete a user's earlier pictures (and their thumbnails) other than keep."""
+    keep_stem = os.path.splitext(keep)[0]
+    removed = 0
+    for folder in folders:
+        for key in storage.list(f"{folder}user_{user_id}_"):
+            if not os.path.basename(key).startswith(keep_stem):
+                removed += storage.delete(key)
+    return removed
+
+
+def is_versioned(filename):
+    return bool(_VERSIONED_NAME.match(filename))
+
+
+def _accel_redirect(storage, key):
+    """Hand the transfer to nginx: an empty response naming an internal location."""
+    if not storage.exists(key):
+        abort(404)
+    prefix = current_app.config["MEDIA_ACCEL_REDIRECT_PREFIX"].rstrip("/")
+
+    response = current_app.response_class()
+    response.headers["X-Accel-Redirect"] = f"{prefix}/{key}"
+    response.mimetype = mimetypes.guess_type(key)[0] or "application/octet-stream"
+    return response
+
+
+def send_media(storage, key, cacheable=True):
+    """
+    Serve an uploaded file. Content-hashed names never change content, so they
+    are cached for a year as immutable; anything else must be revalidated with
+    its ETag / Last-Modified, as must a stand-in served with cacheable=False.
+
+    The worker never pushes the bytes itself if it can avoid it: object
+    storage answers with a redirect to a presigned URL, MEDIA_ACCEL_REDIRECT_PREFIX
+    hands local files to nginx (X-Accel-Redirect) and Flask's USE_X_SENDFILE
+    to any X-Sendfile capable front end server.
+    """
+    versioned = cacheable and is_versioned(os.path.basename(key))
+
+    if storage.presigns:
+        expires = current_app.config.get("UPLOAD_URL_TTL", 3600)
+        response = redirect(storage.url(key, expires=expires))
+        # The redirect must not outlive the signature it points at
+        response.cache_control.private = True
+        response.cache_control.max_age = expires // 2
+        return response
+
+    if current_app.config.get("MEDIA_ACCEL_REDIRECT_PREFIX"):
+        response = _accel_redirect(storage, key)
+    else:
+        path = storage.path(key)
+        response = send_from_directory(os.path.dirname(path), os.path.basename(path))
+
+    if versioned:
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = None
+        response.cache_control.no_cache = True
+    return response
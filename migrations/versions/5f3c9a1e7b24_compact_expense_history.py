@@ -0,0 +1,132 @@
+"""Compact expense history to one row per edit
+
+Revision ID: 5f3c9a1e7b24
+Revises: e4b27c90f1d3
+Create Date: 2026-10-19 15:31:12.448901
+
+"""
+from datetime import datetime, timezone
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f3c9a1e7b24'
+down_revision = 'e4b27c90f1d3'
+branch_labels = None
+depends_on = None
+
+
+BATCH_SIZE = 1000
+
+history = sa.table(
+    'expense_history',
+    sa.column('id', sa.Integer),
+    sa.column('expense_id', sa.Integer),
+    sa.column('user_id', sa.Integer),
+    sa.column('field', sa.String),
+    sa.column('old_value', sa.String),
+    sa.column('new_value', sa.String),
+    sa.column('changes', sa.JSON),
+    sa.column('timestamp', sa.DateTime(timezone=True)),
+)
+
+
+def _typed(field, value):
+    """
+    Old rows stored str() of each value; turn it back into what history_value
+    writes for the column now, so diffs don't mix "50.0" with 50.0.
+    """
+    if value is None or (field == 'description' and value == 'None'):
+        return None
+    try:
+        if field == 'amount':
+            return float(value)
+        if field == 'date':
+            moment = datetime.fromisoformat(value)
+            if moment.tzinfo is None:
+                moment = moment.replace(tzinfo=timezone.utc)
+            return moment.isoformat()
+    except ValueError:
+        pass
+    return value
+
+
+def _flush(bind, updates, deletes):
+    if updates:
+        bind.execute(
+            history.update().where(history.c.id == sa.bindparam('row_id')).values(changes=sa.bindparam('diff')),
+            updates
+        )
+    if deletes:
+        bind.execute(history.delete().where(history.c.id.in_(deletes)))
+    updates.clear()
+    deletes.clear()
+
+
+def upgrade():
+    with op.batch_alter_table('expense_history', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('changes', sa.JSON(), nullable=True))
+
+    # Rows written by one edit were inserted in one flush, so they form a run
+    # of consecutive ids for an expense; a field showing up twice means a new
+    # edit began. Timestamps can't tell edits apart: the old column default
+    # was evaluated once per process, so every row from a worker shares it.
+    bind = op.get_bind()
+    rows = bind.execute(
+        sa.select(history.c.id, history.c.expense_id, history.c.field, history.c.old_value, history.c.new_value)
+        .order_by(history.c.expense_id, history.c.id)
+    ).all()
+
+    updates, deletes = [], []
+    head = prev = None
+    for row in rows:
+        if prev is None or row.expense_id != prev.expense_id or row.id != prev.id + 1 or row.field in diff:
+            if head is not None:
+                updates.append({'row_id': head.id, 'diff': diff})
+            head, diff = row, {}
+        else:
+            deletes.append(row.id)
+        diff[row.field] = [_typed(row.field, row.old_value), _typed(row.field, row.new_value)]
+        prev = row
+        if len(updates) + len(deletes) >= BATCH_SIZE:
+            _flush(bind, updates, deletes)
+    if head is not None:
+        updates.append({'row_id': head.id, 'diff': diff})
+    _flush(bind, updates, deletes)
+
+    with op.batch_alter_table('expense_history', schema=None) as batch_op:
+        batch_op.alter_column('changes', existing_type=sa.JSON(), nullable=False)
+        batch_op.drop_column('new_value')
+        batch_op.drop_column('old_value')
+        batch_op.drop_column('field')
+        batch_op.create_index('ix_expense_history_expense_id', ['expense_id', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('expense_history', schema=None) as batch_op:
+        batch_op.drop_index('ix_expense_history_expense_id')
+        batch_op.add_column(sa.Column('field', sa.String(length=100), nullable=True))
+        batch_op.add_column(sa.Column('old_value', sa.String(length=255), nullable=True))
+        batch_op.add_column(sa.Column('new_value', sa.String(length=255), nullable=True))
+
+    # Expand every diff back into one row per field
+    bind = op.get_bind()
+    rows = bind.execute(
+        sa.select(history.c.id, history.c.expense_id, history.c.user_id, history.c.changes, history.c.timestamp)
+    ).all()
+    for row in rows:
+        items = [(field, *(None if v is None else str(v) for v in values)) for field, values in row.changes.items()]
+        (field, old, new), extra = items[0], items[1:]
+        bind.execute(
+            history.update().where(history.c.id == row.id).values(field=field, old_value=old, new_value=new)
+        )
+        if extra:
+            bind.execute(history.insert(), [{
+                'expense_id': row.expense_id, 'user_id': row.user_id, 'field': f,
+                'old_value': o, 'new_value': n, 'changes': {}, 'timestamp': row.timestamp
+            } for f, o, n in extra])
+
+    with op.batch_alter_table('expense_history', schema=None) as batch_op:
+        batch_op.alter_column('field', existing_type=sa.String(length=100), nullable=False)
+        batch_op.drop_column('changes')
@@ -6,7 +6,8 @@ class User(db.Model):
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=True, nullable=False)
-    password = db.Column(db.String(120), nullable=False)
+    # Werkzeug hashes are "method$salt$hash"; scrypt ones run to ~160 characters
+    password = db.Column(db.String(255), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     number = db.Column(db.String(15), unique=True, nullable=False)
     report_frequency = db.Column(db.String(20), nullable=True, default=None)
@@ -14,6 +15,10 @@ class User(db.Model):
     currency = db.Column(db.String(3), default="USD", nullable=True)
     profile_picture = db.Column(db.String(255), nullable=True)
     theme = db.Column(db.String(10), nullable=False, default="light" )
+    # Set when the account is scheduled for deletion; the user can no longer log in
+    disabled_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    # Bumped whenever the user's expenses change; part of every analytics cache key
+    analytics_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     expense = db.relationship("Expense", backref="user", lazy=True, cascade="all, delete-orphan", passive_deletes=True )
     recurring_expense = db.relationship("RecurringExpense", backref="user", lazy=True, cascade="all, delete-orphan", passive_deletes=True )
     expense_history = db.relationship("ExpenseHistory", backref="user", lazy=True, cascade="all, delete-orphan", passive_deletes=True )
@@ -23,6 +28,10 @@ class User(db.Model):
 
 class Expense(db.Model):
     __tablename__ = "expenses"
+    __table_args__ = (
+        db.Index("ix_expenses_user_date", "user_id", "date"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     currency = db.Column(db.String(10), nullable=False)
@@ -31,8 +40,8 @@ class Expense(db.Model):
     category = db.Column(db.String(50), nullable=False)
     description = db.Column(db.String(255), nullable=True)
     last_modified = db.Column(DateTime(timezone=True), nullable=False,
-                              default=datetime.now(timezone.utc),
-                              onupdate=datetime.now(timezone.utc))
+                              default=lambda: datetime.now(timezone.utc),
+                              onupdate=lambda: datetime.now(timezone.utc))
     user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     expense_history = db.relationship("ExpenseHistory", backref="expense", lazy=True, cascade="all, delete-orphan", passive_deletes=True )
 
@@ -50,13 +59,16 @@ class RecurringExpense(db.Model):
 
 class ExpenseHistory(db.Model):
     __tablename__ = "expense_history"
+    __table_args__ = (
+        db.Index("ix_expense_history_expense_id", "expense_id", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     expense_id = db.Column(db.Integer, db.ForeignKey("expenses.id", ondelete="CASCADE"), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
-    field = db.Column(db.String(100), nullable=False)
-    old_value = db.Column(db.String(255), nullable=True)
-    new_value = db.Column(db.String(255), nullable=True)
-    timestamp = db.Column(db.DateTime(timezone=True), default=datetime.now(timezone.utc))
+    # One row per edit: {field: [old value, new value]} for every changed field
+    changes = db.Column(db.JSON, nullable=False)
+    timestamp = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     
 class PasswordResetToken(db.Model):
     __tablename__ = "password_reset_tokens"
@@ -154,6 +166,8 @@ class FCMToken(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     token = db.Column(db.String(255), nullable=False, unique=True)
     created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    # Refreshed every time the app registers the token on launch
+    last_seen_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True, default=lambda: datetime.now(timezone.utc))
     user = db.relationship(
         "User",
         backref=db.backref(
@@ -163,3 +177,218 @@ class FCMToken(db.Model):
             passive_deletes=True
         )
     )
+
+
+class MonthlySpend(db.Model):
+    __tablename__ = "monthly_spend"
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "month", name="uq_monthly_spend_user_month"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    month = db.Column(db.String(7), nullable=False)
+    total = db.Column(db.Float, nullable=False, default=0.0)
+    # Highest threshold (percent of budget) already alerted for this month
+    alert_level = db.Column(db.Integer, nullable=False, default=0)
+
+    user = db.relationship(
+        "User",
+        backref=db.backref("monthly_spend", lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    )
+
+    def __repr__(self):
+        return f"<MonthlySpend user_id={self.user_id} month={self.month} total={self.total}>"
+
+
+class CategoryStats(db.Model):
+    __tablename__ = "category_stats"
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "category", name="uq_category_stats_user_category"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    # Welford running statistics over expense amounts
+    count = db.Column(db.Integer, nullable=False, default=0)
+    mean = db.Column(db.Float, nullable=False, default=0.0)
+    m2 = db.Column(db.Float, nullable=False, default=0.0)
+
+    user = db.relationship(
+        "User",
+        backref=db.backref("category_stats", lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    )
+
+    def __repr__(self):
+        return f"<CategoryStats user_id={self.user_id} category={self.category} count={self.count}>"
+
+
+class ImportJob(db.Model):
+    __tablename__ = "import_jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    file_format = db.Column(db.String(10), nullable=False)
+    # pending, running, completed or failed
+    status = db.Column(db.String(20), nullable=False, default="pending")
+    bytes_total = db.Column(db.BigInteger, nullable=False, default=0)
+    bytes_read = db.Column(db.BigInteger, nullable=False, default=0)
+    processed_rows = db.Column(db.Integer, nullable=False, default=0)
+    imported_rows = db.Column(db.Integer, nullable=False, default=0)
+    duplicate_rows = db.Column(db.Integer, nullable=False, default=0)
+    invalid_rows = db.Column(db.Integer, nullable=False, default=0)
+    # JSON list of the first few row errors
+    errors = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    # Last progress commit; an unfinished job that stops moving died with its worker
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    finished_at = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    user = db.relationship(
+        "User",
+        backref=db.backref("import_jobs", lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    )
+
+    def __repr__(self):
+        return f"<ImportJob id={self.id} user_id={self.user_id} status={self.status}>"
+
+
+class AccountDeletion(db.Model):
+    __tablename__ = "account_deletions"
+
+    id = db.Column(db.Integer, primary_key=True)
+    # Deliberately not a foreign key: the record outlives the user it deletes
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    # pending, running, completed or failed
+    status = db.Column(db.String(20), nullable=False, default="pending")
+    current_table = db.Column(db.String(50), nullable=True)
+    deleted_rows = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    finished_at = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return f"<AccountDeletion id={self.id} user_id={self.user_id} status={self.status}>"
+
+
+class ReminderMonthlyCount(db.Model):
+    """Old ReminderLog rows rolled up by the retention job."""
+    __tablename__ = "reminder_monthly_counts"
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "month", name="uq_reminder_monthly_counts_user_month"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    month = db.Column(db.String(7), nullable=False)
+    pushes_sent = db.Column(db.Integer, nullable=False, default=0)
+    emails_sent = db.Column(db.Integer, nullable=False, default=0)
+
+    user = db.relationship(
+        "User",
+        backref=db.backref("reminder_monthly_counts", lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    )
+
+
+class ExpenseHistoryArchive(db.Model):
+    """A batch of old ExpenseHistory rows of one expense, zlib compressed JSON."""
+    __tablename__ = "expense_history_archive"
+    __table_args__ = (
+        db.Index("ix_expense_history_archive_expense_id", "expense_id", "first_id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    expense_id = db.Column(db.Integer, db.ForeignKey("expenses.id", ondelete="CASCADE"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    # ids of the first and last archived history rows, to keep edits in order
+    first_id = db.Column(db.Integer, nullable=False)
+    last_id = db.Column(db.Integer, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    oldest = db.Column(db.DateTime(timezone=True), nullable=True)
+    newest = db.Column(db.DateTime(timezone=True), nullable=True)
+    # [[id, changes, timestamp], ...]
+    payload = db.Column(db.LargeBinary, nullable=False)
+
+
+class IdempotencyRecord(db.Model):
+    """The response to a request sent with an Idempotency-Key header."""
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "key", name="uq_idempotency_keys_user_key"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    key = db.Column(db.String(255), nullable=False)
+    # sha256 of method, path and body; a reused key must come with the same request
+    request_hash = db.Column(db.String(64), nullable=False)
+    # NULL while the first request is still being handled
+    status_code = db.Column(db.Integer, nullable=True)
+    mimetype = db.Column(db.String(100), nullable=True)
+    body = db.Column(db.LargeBinary, nullable=True)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+    user = db.relationship(
+        "User",
+        backref=db.backref("idempotency_keys", lazy=True, cascade="all, delete-orphan", passive_deletes=True)
+    )
+
+
+class RevokedToken(db.Model):
+    """
+    One revocation: a single token (kind "jti"), every token of a login
+    session (kind "family"), or every token of a user issued before
+    revoked_at (kind "user", value is the user id). Kept until expires_at,
+    when the tokens it covers would have expired anyway.
+    """
+    __tablename__ = "revoked_tokens"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)
+    value = db.Column(db.String(64), nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    reason = db.Column(db.String(50), nullable=True)
+    revoked_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True, default=lambda: datetime.now(timezone.utc))
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+
+class RefreshToken(db.Model):
+    """An issued refresh token. Using it replaces it with the next one of its family."""
+    __tablename__ = "refresh_tokens"
+
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(36), nullable=False, unique=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    # Shared by every token rotated from one login
+    family = db.Column(db.String(36), nullable=False, index=True)
+    issued_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+    used_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    revoked_at = db.Column(db.DateTime(timezone=True), nullable=True)
+
+
+class OutboxMessage(db.Model):
+    """
+    An email or push waiting to be sent, written in the same transaction as
+    the change that caused it and delivered by outbox.deliver_outbox.
+    """
+    __tablename__ = "outbox_messages"
+    __table_args__ = (
+        db.Index("ix_outbox_messages_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(20), nullable=False)  # "email" or "push"
+    user_id = db.Column(db.Integer, nullable=True, index=True)
+    payload = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default="pending")  # pending, sent, dead
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # While pending: when the message is next due. A claimed message is
+    # pushed one lease into the future, so it comes back if its worker dies
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    sent_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
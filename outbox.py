@@ -0,0 +1,158 @@
+import random
+from datetime import datetime, timezone, timedelta
+from sqlalchemy import select, update, func
+from extensions import db
+from models import OutboxMessage
+from utils import send_email
+from metrics import metrics
+
+
+class PushDeliveryError(Exception):
+    """No device got the push and at least one send may work on a retry."""
+
+
+def enqueue(channel, payload, user_id=None):
+    """
+    Add a message to the outbox. The caller commits, together with whatever
+    change the message announces, so the two are saved or lost as one.
+    """
+    message = OutboxMessage(channel=channel, payload=payload, user_id=user_id)
+    db.session.add(message)
+    return message
+
+
+def enqueue_email(to, subject, contents, user_id=None):
+    return enqueue("email", {"to": to, "subject": subject, "contents": contents}, user_id)
+
+
+def enqueue_push(user_id, title, body):
+    return enqueue("push", {"user_id": user_id, "title": title, "body": body}, user_id)
+
+
+def _send_email(payload, app):
+    send_email(user_email=payload["to"], subject=payload["subject"], contents=payload["contents"])
+
+
+def _send_push(payload, app):
+    # scheduler enqueues through this module, so it is imported on use
+    from scheduler import send_push_notification
+    reached, errors = send_push_notification(payload["user_id"], app, title=payload["title"], body=payload["body"])
+    # Once any device has it, a retry would only send duplicates to that one
+    if errors and not reached:
+        raise PushDeliveryError(f"{len(errors)} sends failed: {errors[0]}")
+
+
+TRANSPORTS = {
+    "email": _send_email,
+    "push": _send_push,
+}
+
+
+def _aware(value):
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def retry_delay(attempts, base, cap):
+    """Exponential backoff with jitter: about base, 2 * base, 4 * base ... up to cap."""
+    delay = min(cap, base * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def claim_batch(batch_size, lease, now):
+    """
+    Claim up to batch_size due messages. SKIP LOCKED lets several workers
+    claim at once without waiting on, or taking, each other's rows (SQLite
+    has no row locks and serialises writers instead). The claim moves
+    next_attempt_at one lease ahead and commits, so the rows are not locked
+    while they are sent.
+    """
+    rows = db.session.execute(
+        select(OutboxMessage.id, OutboxMessage.channel, OutboxMessage.payload,
+               OutboxMessage.attempts, OutboxMessage.created_at)
+        .where(OutboxMessage.status == "pending", OutboxMessage.next_attempt_at <= now)
+        .order_by(OutboxMessage.next_attempt_at, OutboxMessage.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if rows:
+        db.session.execute(
+            update(OutboxMessage)
+            .where(OutboxMessage.id.in_([row.id for row in rows]))
+            .values(attempts=OutboxMessage.attempts + 1, next_attempt_at=now + timedelta(seconds=lease))
+        )
+    db.session.commit()
+    return rows
+
+
+def _deliver(row, app, settings):
+    attempts = row.attempts + 1
+    try:
+        TRANSPORTS[row.channel](row.payload, app)
+    except Exception as e:
+        now = datetime.now(timezone.utc)
+        values = {"last_error": str(e)[:2000]}
+        if attempts >= settings["max_attempts"]:
+            values["status"] = "dead"
+            metrics.incr(f"outbox.{row.channel}.dead")
+            print(f"Outbox message {row.id} dead after {attempts} attempts: {e}")
+        else:
+            delay = retry_delay(attempts, settings["retry_base"], settings["retry_max"])
+            values["next_attempt_at"] = now + timedelta(seconds=delay)
+            metrics.incr(f"outbox.{row.channel}.retried")
+        db.session.execute(update(OutboxMessage).where(OutboxMessage.id == row.id).values(**values))
+        db.session.commit()
+        return False
+
+    now = datetime.now(timezone.utc)
+    db.session.execute(
+        update(OutboxMessage).where(OutboxMessage.id == row.id).values(status="sent", sent_at=now, last_error=None)
+    )
+    db.session.commit()
+    metrics.incr(f"outbox.{row.channel}.sent")
+    metrics.observe(f"outbox.{row.channel}.latency_seconds", (now - _aware(row.created_at)).total_seconds())
+    return True
+
+
+def deliver_outbox(flask_app):
+    """
+    Background job: send due messages in batches of OUTBOX_BATCH_SIZE until
+    none are left. A failed send is retried with exponential backoff; after
+    OUTBOX_MAX_ATTEMPTS the message is marked dead and kept for inspection.
+    Delivery is at least once: a worker dying between sending and recording
+    it means the message goes out again once its lease runs out.
+    """
+    with flask_app.app_context():
+        config = flask_app.config
+        batch_size = config.get("OUTBOX_BATCH_SIZE", 50)
+        lease = config.get("OUTBOX_LEASE", 300)
+        settings = {
+            "max_attempts": config.get("OUTBOX_MAX_ATTEMPTS", 8),
+            "retry_base": config.get("OUTBOX_RETRY_BASE", 30),
+            "retry_max": config.get("OUTBOX_RETRY_MAX", 3600),
+        }
+
+        sent = failed = 0
+        while True:
+            rows = claim_batch(batch_size, lease, datetime.now(timezone.utc))
+            for row in rows:
+                if _deliver(row, flask_app, settings):
+                    sent += 1
+                else:
+                    failed += 1
+            if len(rows) < batch_size:
+                return {"sent": sent, "failed": failed}
+
+
+def outbox_stats():
+    """Queue depth per status, how many are due now, and the age of the oldest due message."""
+    now = datetime.now(timezone.utc)
+    depth = dict(db.session.query(OutboxMessage.status, func.count()).group_by(OutboxMessage.status).all())
+    due = OutboxMessage.query.filter(OutboxMessage.status == "pending", OutboxMessage.next_attempt_at <= now)
+    oldest = due.with_entities(func.min(OutboxMessage.created_at)).scalar()
+    return {
+        "pending": depth.get("pending", 0),
+        "dead": depth.get("dead", 0),
+        "sent": depth.get("sent", 0),
+        "due": due.count(),
+        "oldest_due_seconds": (now - _aware(oldest)).total_seconds() if oldest else 0,
+    }
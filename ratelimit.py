@@ -0,0 +1,206 @@
+import math
+import time
+import threading
+from functools import wraps
+from flask import request, jsonify, current_app
+from metrics import metrics
+
+try:
+    import redis
+except ImportError:  # redis is only needed for a shared RATELIMIT_STORAGE_URL
+    redis = None
+
+
+# endpoint -> key kind -> (requests, seconds). "ip" is the client address,
+# "user" the username or email in the JSON body
+DEFAULT_RULES = {
+    "login": {"ip": (20, 60), "user": (5, 60)},
+    "register": {"ip": (5, 3600)},
+    "forgot_password": {"ip": (5, 3600), "user": (3, 3600)},
+    "reset_password": {"ip": (10, 3600)},
+}
+
+
+def _estimate(previous, current, elapsed, period):
+    """Sliding window count: the previous window weighted by how much of it still overlaps."""
+    return previous * (1 - elapsed / period) + current
+
+
+def _retry_after(previous, current, elapsed, limit, period):
+    """Seconds until one more request fits under limit."""
+    if current < limit and previous:
+        # Wait for enough of the previous window to slide out
+        overlap = (limit - current) / previous
+        wait = (1 - overlap) * period - elapsed
+    else:
+        wait = period - elapsed
+    return max(1, math.ceil(wait))
+
+
+class LocalWindow:
+    """
+    In-process sliding window counters: two integers per key (this window and
+    the last) instead of a timestamp per request. Exact per worker; with
+    several workers each one only sees its own share of the traffic.
+    """
+
+    def __init__(self, clock=time.time, max_keys=100_000):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._counts = {}
+        self.max_keys = max_keys
+
+    def hit(self, key, limit, period):
+        now = self._clock()
+        window, elapsed = divmod(now, period)
+        with self._lock:
+            if len(self._counts) >= self.max_keys:
+                self._purge(now)
+            start, previous, current = self._counts.get(key, (window, 0, 0))
+            if start != window:
+                previous = current if start == window - 1 else 0
+                current = 0
+            if _estimate(previous, current, elapsed, period) + 1 > limit:
+                self._counts[key] = (window, previous, current)
+                return False, _retry_after(previous, current, elapsed, limit, period)
+            self._counts[key] = (window, previous, current + 1)
+            return True, 0
+
+    def undo(self, key, period):
+        """Take back a hit the shared budget refused, if its window is still current."""
+        window = self._clock() // period
+        with self._lock:
+            start, previous, current = self._counts.get(key, (window, 0, 0))
+            if start == window and current:
+                self._counts[key] = (start, previous, current - 1)
+
+    def _purge(self, now):
+        """Drop keys idle for two windows or more; they count as zero anyway."""
+        for key, (start, _, _) in list(self._counts.items()):
+            period = key[-1]
+            if start < now // period - 1:
+                del self._counts[key]
+
+
+class SharedWindow:
+    """
+    The same counters in Redis (or anything speaking its INCR / GET / EXPIRE
+    commands), one key per window, so every worker enforces one budget.
+    """
+
+    def __init__(self, client, prefix="ratelimit", clock=time.time):
+        self._client = client
+        self._prefix = prefix
+        self._clock = clock
+
+    def hit(self, key, limit, period):
+        now = self._clock()
+        window, elapsed = divmod(now, period)
+        name = f"{self._prefix}:{':'.join(map(str, key))}"
+        current_key, previous_key = f"{name}:{int(window)}", f"{name}:{int(window) - 1}"
+
+        pipe = self._client.pipeline()
+        pipe.incr(current_key)
+        pipe.expire(current_key, int(period * 2))
+        pipe.get(previous_key)
+        current, _, previous = pipe.execute()
+        previous = int(previous or 0)
+
+        if _estimate(previous, current, elapsed, period) > limit:
+            # A refused request does not use up any of the budget
+            self._client.decr(current_key)
+            return False, _retry_after(previous, current - 1, elapsed, limit, period)
+        return True, 0
+
+
+class RateLimiter:
+    """
+    Checks the local counters first, so a burst from one client is refused
+    without a network round trip, then the shared ones when configured. A
+    request the shared check refuses is taken back from the local count as
+    well, so a worker only counts requests every worker counted and the
+    local check never refuses anything the shared one would allow. If the
+    shared backend fails, the local decision stands (and its hit is kept).
+    """
+
+    def __init__(self, rules, shared=None):
+        self.rules = rules
+        self.local = LocalWindow()
+        self.shared = shared
+
+    def hit(self, endpoint, kind, value):
+        limit, period = self.rules[endpoint][kind]
+        key = (endpoint, kind, value, period)
+        allowed, retry_after = self.local.hit(key, limit, period)
+        if not allowed or self.shared is None:
+            return allowed, retry_after
+        try:
+            allowed, retry_after = self.shared.hit(key, limit, period)
+        except Exception as e:
+            metrics.incr("ratelimit.shared_errors")
+            current_app.logger.warning(f"Shared rate limit backend failed: {e}")
+            return allowed, retry_after
+        if not allowed:
+            self.local.undo(key, period)
+        return allowed, retry_after
+
+
+def _build(app):
+    rules = {endpoint: dict(kinds) for endpoint, kinds in DEFAULT_RULES.items()}
+    for endpoint, kinds in (app.config.get("RATELIMIT_RULES") or {}).items():
+        rules.setdefault(endpoint, {}).update(kinds)
+
+    shared = None
+    url = app.config.get("RATELIMIT_STORAGE_URL")
+    if url:
+        if redis is None:
+            raise RuntimeError("RATELIMIT_STORAGE_URL needs the redis package")
+        shared = SharedWindow(redis.Redis.from_url(url, socket_timeout=0.2))
+    return RateLimiter(rules, shared)
+
+
+def get_limiter(app=None):
+    app = app or current_app._get_current_object()
+    limiter = app.extensions.get("ratelimit")
+    if limiter is None:
+        limiter = app.extensions["ratelimit"] = _build(app)
+    return limiter
+
+
+def rate_limit(endpoint, user_field=None):
+    """
+    Refuse requests to endpoint over its RATELIMIT_RULES budget with a 429
+    and Retry-After, counted per client IP and, with user_field, per value of
+    that JSON field (so one account can't be hammered from many addresses).
+    The IP is remote_addr, which is the proxy's address unless create_app
+    trusts its X-Forwarded-For (PROXY_FIX_X_FOR).
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config.get("RATELIMIT_ENABLED", True):
+                return view(*args, **kwargs)
+
+            limiter = get_limiter()
+            keys = [("ip", request.remote_addr or "unknown")]
+            if user_field and "user" in limiter.rules[endpoint]:
+                value = ((request.get_json(silent=True) or {}).get(user_field) or "")
+                if isinstance(value, str) and value.strip():
+                    keys.append(("user", value.strip().lower()))
+
+            for kind, value in keys:
+                if kind not in limiter.rules[endpoint]:
+                    continue
+                allowed, retry_after = limiter.hit(endpoint, kind, value)
+                if not allowed:
+                    metrics.incr(f"ratelimit.{endpoint}.refused")
+                    response = jsonify({"error": "Too many requests, try again later"})
+                    response.status_code = 429
+                    response.headers["Retry-After"] = str(retry_after)
+                    return response
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,141 @@
+import os
+import time
+import hashlib
+from flask import current_app as app
+from sqlalchemy import func
+from extensions import db
+from models import Expense
+from utils import csv_extension
+from storage import get_storage
+
+
+REPORT_PREFIX = "expenses_"
+
+
+def report_extension(file_format):
+    if file_format.upper() == "CSV":
+        return csv_extension(app.config.get("REPORT_CSV_COMPRESSION", "gzip"))
+    return ".pdf"
+
+
+def reports_dir(flask_app=None):
+    flask_app = flask_app or app
+    return os.path.join(flask_app.root_path, "static", "reports")
+
+
+def _range_filter(query, user_id, start_date, end_date):
+    query = query.filter(Expense.user_id == user_id)
+    if start_date is not None:
+        query = query.filter(Expense.date >= start_date)
+    if end_date is not None:
+        query = query.filter(Expense.date <= end_date)
+    return query
+
+
+def data_version(user_id, start_date=None, end_date=None):
+    """
+    (row count, latest last_modified, id checksum) for the expenses in range.
+    The id sum catches a delete paired with an insert that would leave both
+    the count and the latest modification time unchanged.
+    """
+    count, last_modified, id_sum = _range_filter(
+        db.session.query(
+            func.count(Expense.id),
+            func.max(Expense.last_modified),
+            func.coalesce(func.sum(Expense.id), 0)
+        ),
+        user_id, start_date, end_date
+    ).one()
+    return count, last_modified, id_sum
+
+
+def report_key(user_id, start_date, end_date, file_format, version):
+    parts = [
+        str(user_id),
+        start_date.isoformat() if start_date else "",
+        end_date.isoformat() if end_date else "",
+        file_format.upper(),
+        *(str(v) for v in version)
+    ]
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+
+def report_name(user_id, key, file_format):
+    """Storage key of the artifact for a report key."""
+    return f"{REPORT_PREFIX}{user_id}_{key[:24]}{report_extension(file_format)}"
+
+
+def cached_report(user_id, key, file_format):
+    """Return the storage key of the cached artifact, refreshing its LRU position, or None."""
+    storage = get_storage("reports")
+    name = report_name(user_id, key, file_format)
+    stat = storage.stat(name)
+    if stat is None:
+        return None
+    if time.time() - stat[1] > app.config.get("REPORT_CACHE_TTL", 7 * 24 * 3600):
+        return None
+    storage.touch(name)
+    return name
+
+
+def _owned(file_path, flask_app=None):
+    """Whether file_path is generation scratch under reports_dir, which the cache may consume."""
+    directory = os.path.abspath(reports_dir(flask_app))
+    return os.path.commonpath([directory, os.path.abspath(file_path)]) == directory
+
+
+def store_report(user_id, key, file_format, file_path):
+    """
+    Put a freshly generated report into the reports storage and return its
+    key. Files generated under reports_dir are moved; any other path belongs
+    to the caller and is copied.
+    """
+    storage = get_storage("reports")
+    name = report_name(user_id, key, file_format)
+    storage.put_file(file_path, name, move=_owned(file_path))
+    evict_reports(app.config.get("REPORT_CACHE_MAX_BYTES", 500 * 1024 * 1024))
+    return name
+
+
+def evict_reports(max_bytes, flask_app=None):
+    """Delete least recently used artifacts until the reports storage fits in max_bytes."""
+    storage = get_storage("reports", flask_app)
+    entries = storage.scan()
+    total = sum(size for _, size, _ in entries)
+
+    removed = 0
+    for key, size, _ in sorted(entries, key=lambda entry: entry[2]):
+        if total <= max_bytes:
+            break
+        if not storage.delete(key):
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def cleanup_reports(flask_app):
+    """Remove reports, cached or left over from generation, that nobody has used within the TTL."""
+    with flask_app.app_context():
+        ttl = flask_app.config.get("REPORT_CACHE_TTL", 7 * 24 * 3600)
+        cutoff = time.time() - ttl
+        removed = 0
+        # Generation scratch space is always local to this host
+        directory = reports_dir(flask_app)
+        if os.path.isdir(directory):
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        try:
+                            os.remove(entry.path)
+                            removed += 1
+                        except OSError:
+                            continue
+
+        storage = get_storage("reports", flask_app)
+        for key, _, modified in storage.scan():
+            if modified < cutoff and storage.delete(key):
+                removed += 1
+        removed += evict_reports(flask_app.config.get("REPORT_CACHE_MAX_BYTES", 500 * 1024 * 1024), flask_app)
+        print(f"Report cleanup removed {removed} files")
+        return removed
@@ -0,0 +1,459 @@
+import os
+import signal
+import multiprocessing
+from collections import namedtuple, defaultdict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+from functools import lru_cache
+from threading import Lock
+from fpdf import FPDF, FPDF_VERSION
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; the memory cap is skipped there
+    resource = None
+
+
+Column = namedtuple("Column", ["title", "width", "align"])
+Template = namedtuple("Template", [
+    "columns", "font", "row_height", "bar_colour", "stripe_colour", "char_widths", "max_char_width",
+    "width_bounds"
+])
+
+# Glyph widths are rounded up to this many units to fit in one byte each
+WIDTH_BOUND_STEP = 5
+
+# Row layout handed to the renderer: (date, title, category, amount, currency, description)
+ROW_FIELDS = ("date", "title", "category", "amount", "currency", "description")
+
+# The table is written through two PyFPDF 1.7 internals: the document
+# buffer (replaced by _ChunkBuffer) and _out() for raw page operators.
+# fpdf2 installs under the same module name with different internals, so
+# with anything but 1.7 both are left alone and rows go through cell(),
+# which benchmarks/bench_report_render.py shows to be slower (five times
+# at 50k rows) and about a third larger.
+FPDF_INTERNALS = FPDF_VERSION.startswith("1.7")
+
+# Seconds the caller waits past the worker's own deadline before giving up on it
+RENDER_TIMEOUT_GRACE = 5
+
+_pool = None
+_pool_lock = Lock()
+
+
+class RenderTimeout(Exception):
+    """Raised inside a render worker when its deadline passes."""
+
+
+@lru_cache(maxsize=None)
+def _template():
+    """Column layout and font metrics, built once per process."""
+    probe = FPDF()
+    probe.add_page()
+    probe.set_font("Arial", "", 8)
+    char_widths = tuple(probe.current_font["cw"].get(chr(i), 500) for i in range(256))
+    return Template(
+        columns=(
+            Column("Date", 22, "L"),
+            Column("Title", 54, "L"),
+            Column("Category", 32, "L"),
+            Column("Amount", 26, "R"),
+            Column("Cur.", 14, "C"),
+            Column("Description", 42, "L"),
+        ),
+        font=("Arial", "", 8),
+        row_height=5,
+        bar_colour=(52, 101, 164),
+        stripe_colour=(240, 243, 248),
+        # Glyph widths indexed by latin-1 byte so text can be measured with map()
+        char_widths=char_widths,
+        max_char_width=max(char_widths),
+        # The same widths rounded up to WIDTH_BOUND_STEP, as a bytes.translate()
+        # table: sum(raw.translate(...)) bounds a text's width without a
+        # Python-level loop over its bytes
+        width_bounds=bytes(-(-w // WIDTH_BOUND_STEP) for w in char_widths)
+    )
+
+
+def _latin1(text):
+    return str(text).encode("latin-1", "replace").decode("latin-1")
+
+
+@lru_cache(maxsize=None)
+def _fitter(width):
+    """
+    A function trimming text to a cell of the given width, built once per
+    width so the table loop pays no setup per cell. Text too short to
+    overflow even in the widest glyph is not measured at all, and text whose
+    rounded-up width fits is not measured exactly.
+    """
+    template = _template()
+    widths, bounds = template.char_widths, template.width_bounds
+    limit = (width - 2) * 1000 / template.font[2] * 72 / 25.4
+    always_fits = int(limit // template.max_char_width)
+
+    def fit(text):
+        raw = str(text).encode("latin-1", "replace")
+        if (len(raw) <= always_fits or sum(raw.translate(bounds)) * WIDTH_BOUND_STEP <= limit
+                or sum(map(widths.__getitem__, raw)) <= limit):
+            return raw.decode("latin-1")
+        used = 0
+        for i, byte in enumerate(raw):
+            used += widths[byte]
+            if used > limit:
+                return raw[:max(i - 1, 0)].decode("latin-1") + ".."
+        return raw.decode("latin-1")
+
+    return fit
+
+
+def _fit(text, width):
+    """Trim text so it fits in a cell of the given width without measuring through FPDF."""
+    return _fitter(width)(text)
+
+
+def summarise(rows):
+    """Category subtotals and per-currency totals from the row tuples."""
+    by_category = defaultdict(float)
+    by_currency = defaultdict(float)
+    for row in rows:
+        by_category[row[2]] += row[3]
+        by_currency[row[4]] += row[3]
+    return dict(by_category), dict(by_currency)
+
+
+class _ChunkBuffer:
+    """
+    Drop-in for FPDF's document buffer string. FPDF 1.7 appends with
+    `buffer += s`, which copies the whole document on every write.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+
+    def __iadd__(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+        return self
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return "".join(self.parts)
+
+    def encode(self, *args):
+        return str(self).encode(*args)
+
+
+class ReportPDF(FPDF):
+    def __init__(self, title):
+        super().__init__(orientation="P", unit="mm", format="A4")
+        if FPDF_INTERNALS:
+            self.buffer = _ChunkBuffer()
+        self.report_title = _latin1(title)
+        self.template = _template()
+        self.in_table = False
+        self.table_top = None
+        self.alias_nb_pages()
+        self.set_auto_page_break(auto=True, margin=15)
+        self.set_title(self.report_title)
+
+        x = self.l_margin
+        self.column_edges = []
+        for column in self.template.columns:
+            self.column_edges.append((x, column.width, column.align))
+            x += column.width
+        self.table_width = x - self.l_margin
+        # Where each cell's text starts (L), ends (R) or is centred (C), in points
+        k = self.k
+        self.cell_anchors = []
+        for x, width, align in self.column_edges:
+            if align == "R":
+                anchor = x + width - self.c_margin
+            elif align == "C":
+                anchor = x + width / 2
+            else:
+                anchor = x + self.c_margin
+            self.cell_anchors.append((anchor * k, align))
+
+        template = self.template
+        k, row_h = self.k, template.row_height
+        self.table_ops = []
+        self.row_baseline = (row_h / 2 + 0.3 * template.font[2] / k) * k
+        # Glyph width units to points at the table font size
+        self.text_scale = template.font[2] / 1000
+        r, g, b = (c / 255 for c in template.stripe_colour)
+        self.stripe_op = (
+            f"q {r:.3f} {g:.3f} {b:.3f} rg {self.l_margin * k:.2f} %.2f "
+            f"{self.table_width * k:.2f} {-row_h * k:.2f} re f Q"
+        )
+
+    def header(self):
+        self.set_font("Arial", "B", 12)
+        self.cell(0, 8, self.report_title, ln=1, align="C")
+        if self.in_table:
+            self.table_header()
+
+    def footer(self):
+        self.set_y(-12)
+        self.set_font("Arial", "I", 8)
+        self.cell(0, 8, f"Page {self.page_no()}/{{nb}}", align="C")
+
+    def table_header(self):
+        self.set_font("Arial", "B", 8)
+        self.set_fill_color(220, 224, 232)
+        for column in self.template.columns:
+            self.cell(column.width, 6, column.title, border=1, align=column.align, fill=1)
+        self.ln()
+        self.set_font(*self.template.font)
+        # Text is painted with the fill colour, keep it black for rows
+        self.set_fill_color(0)
+        self.table_top = self.y
+
+    def ensure_space(self, h):
+        if self.y + h > self.page_break_trigger:
+            self.close_table_page()
+            self.add_page()
+
+    def close_table_page(self):
+        """Flush queued rows and draw the column rules once per page instead of per cell."""
+        if self.table_ops:
+            self._out("\n".join(self.table_ops))
+            self.table_ops = []
+        for x, _, _ in self.column_edges:
+            self.line(x, self.table_top, x, self.y)
+        right = self.l_margin + self.table_width
+        self.line(right, self.table_top, right, self.y)
+        self.line(self.l_margin, self.y, right, self.y)
+
+    def table_row(self, values, striped):
+        """
+        Queue a row's drawing operators. Rows are written to the page in one
+        go by close_table_page; going through cell() rebuilds the page
+        buffer string several times per row.
+        """
+        if not FPDF_INTERNALS:
+            return self._cell_row(values, striped)
+
+        top = (self.h - self.y) * self.k
+        if striped:
+            self.table_ops.append(self.stripe_op % top)
+
+        # One text object per row, each cell positioned relative to the last
+        parts = ["BT 0 %.2f Td" % (top - self.row_baseline)]
+        line_x = 0
+        width_of = self.template.char_widths.__getitem__
+        for (x, align), text in zip(self.cell_anchors, values):
+            if not text:
+                continue
+            if align != "L":
+                width = sum(map(width_of, text.encode("latin-1", "replace"))) * self.text_scale
+                x -= width if align == "R" else width / 2
+            parts.append("%.2f 0 Td (%s) Tj" % (x - line_x, _escape(text)))
+            line_x = x
+        parts.append("ET")
+        self.table_ops.append(" ".join(parts))
+
+        self.y += self.template.row_height
+
+    def _cell_row(self, values, striped):
+        """The same row through the public API, for FPDF versions without the hooks."""
+        h = self.template.row_height
+        if striped:
+            self.set_fill_color(*self.template.stripe_colour)
+            self.rect(self.l_margin, self.y, self.table_width, h, "F")
+            self.set_fill_color(0)
+        for (x, width, align), text in zip(self.column_edges, values):
+            self.set_x(x)
+            self.cell(width, h, text, align=align)
+        self.ln(h)
+
+
+def _escape(text):
+    if "\\" in text or "(" in text or ")" in text or "\r" in text:
+        return text.replace("\\", "\\\\").replace(")", "\\)").replace("(", "\\(").replace("\r", "\\r")
+    return text
+
+
+def _draw_summary(pdf, rows, by_category, by_currency, generated_at):
+    pdf.set_font("Arial", "", 10)
+    pdf.cell(0, 6, f"Generated {generated_at:%Y-%m-%d %H:%M} UTC - {len(rows)} expenses", ln=1)
+    if rows:
+        dates = [row[0] for row in rows]
+        pdf.cell(0, 6, f"Period: {min(dates)} to {max(dates)}", ln=1)
+    for currency, total in sorted(by_currency.items()):
+        pdf.cell(0, 6, _latin1(f"Total ({currency}): {total:,.2f}"), ln=1)
+    pdf.ln(4)
+
+    if not by_category:
+        return
+
+    pdf.set_font("Arial", "B", 10)
+    pdf.cell(0, 6, "Spending by category", ln=1)
+    pdf.set_font("Arial", "", 8)
+
+    template = pdf.template
+    top = max(by_category.values()) or 1
+    label_w, bar_max = 40, 110
+    pdf.set_fill_color(*template.bar_colour)
+    for category, total in sorted(by_category.items(), key=lambda item: -item[1]):
+        y = pdf.get_y()
+        pdf.cell(label_w, 5, _fit(category, label_w))
+        pdf.rect(pdf.l_margin + label_w, y + 1, max(bar_max * total / top, 0.5), 3, "F")
+        pdf.set_x(pdf.l_margin + label_w + bar_max + 2)
+        pdf.cell(0, 5, f"{total:,.2f}", ln=1)
+    pdf.set_fill_color(0)
+    pdf.ln(4)
+
+
+def _draw_table(pdf, rows, by_category):
+    template = pdf.template
+    h = template.row_height
+    widths = [c.width for c in template.columns]
+    fit_title, fit_category, fit_description = _fitter(widths[1]), _fitter(widths[2]), _fitter(widths[5])
+
+    pdf.set_auto_page_break(False, margin=15)
+    pdf.ensure_space(6 + 2 * h)
+    pdf.in_table = True
+    pdf.table_header()
+
+    current = None
+    stripe = False
+    for row in sorted(rows, key=lambda r: (r[2], r[0])):
+        if row[2] != current:
+            if current is not None:
+                _draw_subtotal(pdf, current, by_category[current])
+            current = row[2]
+            category = fit_category(current)
+            pdf.ensure_space(2 * h)
+            pdf.set_font("Arial", "B", 8)
+            pdf.cell(pdf.table_width, h, _fit(current, pdf.table_width), ln=1)
+            pdf.set_font(*template.font)
+            stripe = False
+
+        pdf.ensure_space(h)
+        pdf.table_row((
+            str(row[0]),
+            fit_title(row[1]),
+            category,
+            f"{row[3]:,.2f}",
+            _latin1(row[4]),
+            fit_description(row[5] or ""),
+        ), stripe)
+        stripe = not stripe
+
+    if current is not None:
+        _draw_subtotal(pdf, current, by_category[current])
+    pdf.close_table_page()
+    pdf.in_table = False
+    pdf.set_auto_page_break(True, margin=15)
+
+
+def _draw_subtotal(pdf, category, total):
+    template = pdf.template
+    widths = [c.width for c in template.columns]
+    pdf.ensure_space(template.row_height)
+    pdf.set_font("Arial", "B", 8)
+    pdf.cell(sum(widths[:3]), template.row_height, _fit(f"Subtotal {category}", sum(widths[:3])), border="T", align="R")
+    pdf.cell(widths[3], template.row_height, f"{total:,.2f}", border="T", align="R")
+    pdf.cell(sum(widths[4:]), template.row_height, "", border="T", ln=1)
+    pdf.set_font(*template.font)
+
+
+def render_pdf(rows, file_path, title="Expense Report"):
+    """Render row tuples (see ROW_FIELDS) to a paginated PDF table with a summary page section."""
+    by_category, by_currency = summarise(rows)
+
+    pdf = ReportPDF(title)
+    pdf.add_page()
+    _draw_summary(pdf, rows, by_category, by_currency, datetime.now(timezone.utc))
+    if rows:
+        _draw_table(pdf, rows, by_category)
+    pdf.output(file_path, "F")
+    return file_path
+
+
+def _limit_memory(max_bytes):
+    if resource is not None and max_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+    _template()
+
+
+def _get_pool(workers, memory_mb):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=_limit_memory,
+                initargs=(memory_mb * 1024 * 1024,)
+            )
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _expire(signum, frame):
+    raise RenderTimeout()
+
+
+def _render_with_deadline(rows, file_path, title, timeout):
+    """
+    Worker side of render_pdf_isolated: stop rendering once timeout seconds
+    have passed, so an abandoned report does not keep its worker busy.
+    """
+    deadline = hasattr(signal, "setitimer")
+    if deadline:
+        previous = signal.signal(signal.SIGALRM, _expire)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return render_pdf(rows, file_path, title)
+    except RenderTimeout:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    finally:
+        if deadline:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+def render_pdf_isolated(rows, file_path, title="Expense Report", workers=2, memory_mb=512, timeout=120):
+    """
+    Render in a worker process with a hard address-space cap so one huge
+    report cannot take the web worker down, and a deadline of timeout
+    seconds. workers=0 renders inline.
+    """
+    if not workers:
+        return render_pdf(rows, file_path, title)
+
+    pool = _get_pool(workers, memory_mb)
+    future = pool.submit(_render_with_deadline, rows, file_path, title, timeout)
+    try:
+        return future.result(timeout=timeout + RENDER_TIMEOUT_GRACE)
+    except (BrokenProcessPool, MemoryError):
+        # A worker hit the memory cap and died; start clean next time
+        _reset_pool()
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise RuntimeError("Report is too large to render")
+    except (RenderTimeout, FutureTimeout):
+        if not future.cancel() and not future.done():
+            # Still queued behind, or stuck in, work that ignores its
+            # deadline: leave that pool to finish and use a fresh one
+            _reset_pool()
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise RuntimeError("Report took too long to render")
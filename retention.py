@@ -0,0 +1,229 @@
+import time
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import select, delete, insert
+from extensions import db
+from models import (
+    PasswordResetToken,
+    ReminderLog,
+    ReminderMonthlyCount,
+    ExpenseHistory,
+    ExpenseHistoryArchive,
+    IdempotencyRecord,
+    RevokedToken,
+    RefreshToken,
+    FCMToken,
+    OutboxMessage
+)
+from history import pack_history
+from metrics import metrics
+
+
+# Per table policies, overridden key by key with RETENTION_POLICIES
+DEFAULT_POLICIES = {
+    # Expired tokens are useless, the grace period only helps debugging
+    "password_reset_tokens": {"grace_hours": 24},
+    # Individual reminder rows are only needed for the same-day email check
+    "reminder_logs": {"keep_days": 90},
+    "expense_history": {"keep_months": 12},
+    # Records carry their own expiry, set from IDEMPOTENCY_TTL
+    "idempotency_keys": {},
+    # Revocations outlive the tokens they cover by nothing; both tables
+    # carry the expiry of those tokens
+    "revoked_tokens": {},
+    "refresh_tokens": {},
+    # Apps re-register their token on every launch; one not seen for this
+    # long belongs to an uninstalled app or a device that is gone
+    "fcm_tokens": {"stale_days": 60},
+    # Dead messages are kept longer, someone may want to look at them
+    "outbox_messages": {"sent_days": 7, "dead_days": 30},
+}
+
+
+def retention_policies(app):
+    configured = app.config.get("RETENTION_POLICIES") or {}
+    return {table: {**policy, **configured.get(table, {})} for table, policy in DEFAULT_POLICIES.items()}
+
+
+def _chunks(query, chunk_size):
+    """Yield the rows of query chunk_size at a time until it comes back empty."""
+    while True:
+        rows = db.session.execute(query.limit(chunk_size)).all()
+        if not rows:
+            return
+        yield rows
+
+
+def purge_reset_tokens(policy, chunk_size, now):
+    cutoff = now - timedelta(hours=policy["grace_hours"])
+    reclaimed = 0
+    for rows in _chunks(select(PasswordResetToken.id).where(PasswordResetToken.expires_at < cutoff), chunk_size):
+        ids = [row.id for row in rows]
+        db.session.execute(delete(PasswordResetToken).where(PasswordResetToken.id.in_(ids)))
+        db.session.commit()
+        reclaimed += len(ids)
+    return reclaimed
+
+
+def _purge_expired(model, chunk_size, now):
+    reclaimed = 0
+    for rows in _chunks(select(model.id).where(model.expires_at < now), chunk_size):
+        ids = [row.id for row in rows]
+        db.session.execute(delete(model).where(model.id.in_(ids)))
+        db.session.commit()
+        reclaimed += len(ids)
+    return reclaimed
+
+
+def purge_idempotency_keys(policy, chunk_size, now):
+    return _purge_expired(IdempotencyRecord, chunk_size, now)
+
+
+def purge_revoked_tokens(policy, chunk_size, now):
+    return _purge_expired(RevokedToken, chunk_size, now)
+
+
+def purge_refresh_tokens(policy, chunk_size, now):
+    return _purge_expired(RefreshToken, chunk_size, now)
+
+
+def prune_fcm_tokens(policy, chunk_size, now):
+    cutoff = stale_token_cutoff(policy, now)
+    reclaimed = 0
+    for rows in _chunks(select(FCMToken.id).where(FCMToken.last_seen_at < cutoff), chunk_size):
+        ids = [row.id for row in rows]
+        db.session.execute(delete(FCMToken).where(FCMToken.id.in_(ids)))
+        db.session.commit()
+        reclaimed += len(ids)
+    return reclaimed
+
+
+def stale_token_cutoff(policy, now):
+    """Device tokens last seen before this are not worth a push."""
+    return now - timedelta(days=policy["stale_days"])
+
+
+def purge_outbox(policy, chunk_size, now):
+    sent_cutoff = now - timedelta(days=policy["sent_days"])
+    dead_cutoff = now - timedelta(days=policy["dead_days"])
+    query = select(OutboxMessage.id).where(
+        ((OutboxMessage.status == "sent") & (OutboxMessage.created_at < sent_cutoff))
+        | ((OutboxMessage.status == "dead") & (OutboxMessage.created_at < dead_cutoff))
+    )
+    reclaimed = 0
+    for rows in _chunks(query, chunk_size):
+        ids = [row.id for row in rows]
+        db.session.execute(delete(OutboxMessage).where(OutboxMessage.id.in_(ids)))
+        db.session.commit()
+        reclaimed += len(ids)
+    return reclaimed
+
+
+def rollup_reminder_logs(policy, chunk_size, now):
+    """Fold reminder rows older than keep_days into per user monthly counters."""
+    cutoff = now - timedelta(days=policy["keep_days"])
+    query = select(
+        ReminderLog.id, ReminderLog.user_id, ReminderLog.push_sent_at, ReminderLog.email_sent
+    ).where(ReminderLog.push_sent_at < cutoff).order_by(ReminderLog.id)
+
+    reclaimed = 0
+    for rows in _chunks(query, chunk_size):
+        counts = defaultdict(lambda: [0, 0])
+        for row in rows:
+            key = (row.user_id, row.push_sent_at.strftime("%Y-%m"))
+            counts[key][0] += 1
+            counts[key][1] += int(row.email_sent)
+
+        users = {user_id for user_id, _ in counts}
+        existing = {
+            (c.user_id, c.month): c
+            for c in ReminderMonthlyCount.query.filter(ReminderMonthlyCount.user_id.in_(users))
+            if (c.user_id, c.month) in counts
+        }
+        for key, (pushes, emails) in counts.items():
+            counter = existing.get(key)
+            if counter is None:
+                counter = ReminderMonthlyCount(user_id=key[0], month=key[1], pushes_sent=0, emails_sent=0)
+                db.session.add(counter)
+            counter.pushes_sent += pushes
+            counter.emails_sent += emails
+
+        # Counters and the delete share a transaction, a row is never counted twice
+        db.session.execute(delete(ReminderLog).where(ReminderLog.id.in_([row.id for row in rows])))
+        db.session.commit()
+        reclaimed += len(rows)
+    return reclaimed
+
+
+def archive_expense_history(policy, chunk_size, now):
+    """
+    Move history older than keep_months into expense_history_archive, one
+    compressed row per expense per chunk.
+    """
+    cutoff = now - relativedelta(months=policy["keep_months"])
+    query = select(
+        ExpenseHistory.id, ExpenseHistory.expense_id, ExpenseHistory.user_id,
+        ExpenseHistory.changes, ExpenseHistory.timestamp
+    ).where(ExpenseHistory.timestamp < cutoff).order_by(ExpenseHistory.expense_id, ExpenseHistory.id)
+
+    reclaimed = 0
+    for rows in _chunks(query, chunk_size):
+        by_expense = defaultdict(list)
+        for row in rows:
+            by_expense[row.expense_id].append(row)
+
+        db.session.execute(insert(ExpenseHistoryArchive), [{
+            "expense_id": expense_id,
+            "user_id": group[0].user_id,
+            "first_id": group[0].id,
+            "last_id": group[-1].id,
+            "row_count": len(group),
+            "oldest": group[0].timestamp,
+            "newest": group[-1].timestamp,
+            "payload": pack_history(group),
+        } for expense_id, group in by_expense.items()])
+        db.session.execute(delete(ExpenseHistory).where(ExpenseHistory.id.in_([row.id for row in rows])))
+        db.session.commit()
+        reclaimed += len(rows)
+    return reclaimed
+
+
+POLICY_JOBS = {
+    "password_reset_tokens": purge_reset_tokens,
+    "reminder_logs": rollup_reminder_logs,
+    "expense_history": archive_expense_history,
+    "idempotency_keys": purge_idempotency_keys,
+    "revoked_tokens": purge_revoked_tokens,
+    "refresh_tokens": purge_refresh_tokens,
+    "fcm_tokens": prune_fcm_tokens,
+    "outbox_messages": purge_outbox,
+}
+
+
+def run_retention(flask_app, tables=None):
+    """
+    Background job: apply each table's policy in chunks of
+    RETENTION_CHUNK_SIZE rows, one transaction per chunk. Returns rows
+    reclaimed per table.
+    """
+    with flask_app.app_context():
+        chunk_size = flask_app.config.get("RETENTION_CHUNK_SIZE", 1000)
+        policies = retention_policies(flask_app)
+        now = datetime.now(timezone.utc)
+
+        reclaimed = {}
+        for table in tables or POLICY_JOBS:
+            started = time.monotonic()
+            try:
+                reclaimed[table] = POLICY_JOBS[table](policies[table], chunk_size, now)
+            except Exception as e:
+                db.session.rollback()
+                metrics.incr(f"retention.{table}.failed")
+                print(f"Retention for {table} failed: {e}")
+                continue
+            metrics.incr(f"retention.{table}.reclaimed", reclaimed[table])
+            metrics.observe(f"retention.{table}.seconds", time.monotonic() - started)
+
+        print(f"Retention reclaimed {reclaimed}")
+        return reclaimed
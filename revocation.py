@@ -0,0 +1,208 @@
+import time
+import uuid
+import threading
+from datetime import datetime, timezone, timedelta
+from flask import current_app
+from flask_jwt_extended import create_access_token, create_refresh_token
+from sqlalchemy import select, update
+from extensions import db, jwt
+from models import RevokedToken, RefreshToken
+from metrics import metrics
+
+
+FAMILY_CLAIM = "fam"
+# Rows committed this long after their revoked_at are still picked up
+SYNC_OVERLAP = timedelta(seconds=60)
+
+
+def _epoch(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _refresh_lifetime(app):
+    # JWTManager fills in its default; False means refresh tokens never expire
+    return app.config.get("JWT_REFRESH_TOKEN_EXPIRES") or timedelta(days=365)
+
+
+class Blocklist:
+    """
+    In-process mirror of revoked_tokens, so checking a token is three dict
+    lookups instead of a query. Each worker re-reads the rows revoked since
+    its last sync at most every `sync_interval` seconds; revocations made by
+    this worker apply here at once, those made by others within one
+    interval. Entries are dropped once the tokens they cover have expired.
+    """
+
+    def __init__(self, sync_interval=5):
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._entries = {"jti": {}, "family": {}, "user": {}}
+        self._synced_at = None
+        self._next_sync = 0
+
+    def _add(self, row):
+        # jti and family map to their expiry, user to the cutoff for iat
+        value = _epoch(row.revoked_at) if row.kind == "user" else _epoch(row.expires_at)
+        entries = self._entries[row.kind]
+        entries[row.value] = max(value, entries.get(row.value, 0))
+
+    def sync(self, force=False):
+        now = time.monotonic()
+        if not force and now < self._next_sync:
+            return
+        with self._lock:
+            if not force and now < self._next_sync:
+                return
+            started = datetime.now(timezone.utc)
+            query = select(RevokedToken.kind, RevokedToken.value, RevokedToken.revoked_at, RevokedToken.expires_at)
+            if self._synced_at is None:
+                query = query.where(RevokedToken.expires_at > started)
+            else:
+                query = query.where(RevokedToken.revoked_at > self._synced_at - SYNC_OVERLAP)
+            for row in db.session.execute(query):
+                self._add(row)
+            self._prune(started)
+            self._synced_at = started
+            self._next_sync = now + self.sync_interval
+        metrics.incr("revocation.syncs")
+
+    def _prune(self, now):
+        cutoff = now.timestamp()
+        for kind in ("jti", "family"):
+            entries = self._entries[kind]
+            for key in [key for key, expires in entries.items() if expires < cutoff]:
+                del entries[key]
+        # A user cutoff only matters while tokens issued before it live
+        oldest = cutoff - _refresh_lifetime(current_app).total_seconds()
+        users = self._entries["user"]
+        for key in [key for key, revoked in users.items() if revoked < oldest]:
+            del users[key]
+
+    def record(self, row):
+        with self._lock:
+            self._add(row)
+
+    def is_revoked(self, payload):
+        self.sync()
+        if payload.get("jti") in self._entries["jti"]:
+            return True
+        family = payload.get(FAMILY_CLAIM)
+        if family and family in self._entries["family"]:
+            return True
+        # iat has whole seconds, so the cutoff does too: tokens issued in the
+        # same second as the revocation (the fresh pair a password change
+        # hands back) stay valid
+        cutoff = self._entries["user"].get(str(payload.get("sub")))
+        return cutoff is not None and payload.get("iat", 0) < int(cutoff)
+
+
+def get_blocklist(app=None):
+    app = app or current_app._get_current_object()
+    blocklist = app.extensions.get("jwt_blocklist")
+    if blocklist is None:
+        blocklist = app.extensions["jwt_blocklist"] = Blocklist(
+            sync_interval=app.config.get("JWT_BLOCKLIST_SYNC_INTERVAL", 5)
+        )
+    return blocklist
+
+
+@jwt.token_in_blocklist_loader
+def token_revoked(jwt_header, jwt_payload):
+    return get_blocklist().is_revoked(jwt_payload)
+
+
+def _revoke(kind, value, user_id, expires_at, reason):
+    """Persist a revocation and apply it to this worker. The caller commits."""
+    row = RevokedToken(
+        kind=kind,
+        value=str(value),
+        user_id=user_id,
+        reason=reason,
+        revoked_at=datetime.now(timezone.utc),
+        expires_at=expires_at
+    )
+    db.session.add(row)
+    get_blocklist().record(row)
+    metrics.incr(f"revocation.{kind}")
+    return row
+
+
+def revoke_token(payload, reason="logout"):
+    expires_at = datetime.fromtimestamp(payload["exp"], timezone.utc) if "exp" in payload else \
+        datetime.now(timezone.utc) + _refresh_lifetime(current_app)
+    return _revoke("jti", payload["jti"], int(payload["sub"]), expires_at, reason)
+
+
+def revoke_family(family, user_id, reason="logout"):
+    """End one login session: its refresh tokens and the access tokens issued with them."""
+    now = datetime.now(timezone.utc)
+    db.session.execute(
+        update(RefreshToken).where(RefreshToken.family == family, RefreshToken.revoked_at.is_(None)).values(revoked_at=now)
+    )
+    return _revoke("family", family, user_id, now + _refresh_lifetime(current_app), reason)
+
+
+def revoke_user_tokens(user_id, reason):
+    """Revoke every token issued to user_id so far, e.g. after a password change."""
+    now = datetime.now(timezone.utc)
+    db.session.execute(
+        update(RefreshToken).where(RefreshToken.user_id == user_id, RefreshToken.revoked_at.is_(None)).values(revoked_at=now)
+    )
+    return _revoke("user", user_id, user_id, now + _refresh_lifetime(current_app), reason)
+
+
+def issue_tokens(user_id, family=None):
+    """
+    A new access and refresh token pair for user_id, both tagged with the
+    login session (family) they belong to. The refresh token is recorded so
+    it can be used exactly once. The caller commits.
+    """
+    family = family or str(uuid.uuid4())
+    jti = str(uuid.uuid4())
+    claims = {FAMILY_CLAIM: family}
+    access_token = create_access_token(identity=str(user_id), additional_claims=claims)
+    refresh_token = create_refresh_token(identity=str(user_id), additional_claims={**claims, "jti": jti})
+    db.session.add(RefreshToken(
+        jti=jti,
+        user_id=user_id,
+        family=family,
+        expires_at=datetime.now(timezone.utc) + _refresh_lifetime(current_app)
+    ))
+    return access_token, refresh_token
+
+
+def rotate_refresh(payload):
+    """
+    Exchange the refresh token described by payload for a new pair. Returns
+    None when the token was already used or revoked; a used one showing up
+    again means it leaked, so its whole family is revoked. The caller commits.
+    """
+    user_id = int(payload["sub"])
+    family = payload.get(FAMILY_CLAIM)
+    if family is None:
+        # Issued before rotation existed: retire it and start a family
+        revoke_token(payload, reason="rotated")
+        return issue_tokens(user_id)
+
+    now = datetime.now(timezone.utc)
+    # Claiming the token is one conditional update, so of two concurrent
+    # uses exactly one wins
+    claimed = db.session.execute(
+        update(RefreshToken).where(
+            RefreshToken.jti == payload["jti"],
+            RefreshToken.used_at.is_(None),
+            RefreshToken.revoked_at.is_(None)
+        ).values(used_at=now)
+    ).rowcount
+    if not claimed:
+        known = db.session.execute(
+            select(RefreshToken.used_at, RefreshToken.revoked_at).where(RefreshToken.jti == payload["jti"])
+        ).first()
+        if known is not None and known.revoked_at is None:
+            metrics.incr("revocation.refresh_reuse")
+            current_app.logger.warning(f"Refresh token reuse for user_id={user_id}, revoking its session")
+            revoke_family(family, user_id, reason="reuse")
+        return None
+    return issue_tokens(user_id, family)
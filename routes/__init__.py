@@ -6,6 +6,9 @@ from .user import user_bp
 from .reports import reports_bp
 from .uploads import uploads_bp
 from .notification import notification_bp
+from .analytics import analytics_bp
+from .imports import imports_bp
+from .metrics import metrics_bp
 
 def register_blueprints(app: Flask):
     app.register_blueprint(auth_bp)
@@ -15,4 +18,7 @@ def register_blueprints(app: Flask):
     app.register_blueprint(reports_bp)
     app.register_blueprint(uploads_bp)
     app.register_blueprint(notification_bp)
+    app.register_blueprint(analytics_bp)
+    app.register_blueprint(imports_bp)
+    app.register_blueprint(metrics_bp)
     
@@ -0,0 +1,43 @@
+from flask import Blueprint, request, jsonify
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from analytics import (
+    cached,
+    monthly_trends,
+    spending_heatmap,
+    period_comparison,
+    COMPARE_PERIODS
+)
+from serializers import respond
+
+analytics_bp = Blueprint("analytics", __name__)
+
+
+@analytics_bp.route("/analytics/trends", methods=["GET"])
+@jwt_required()
+def trends():
+    user_id = int(get_jwt_identity())
+
+    months = request.args.get("months", 12, type=int)
+    if months is None or not 1 <= months <= 60:
+        return jsonify({"error": "months must be between 1 and 60"}), 400
+
+    return respond(cached(user_id, "trends", months, lambda: monthly_trends(user_id, months)))
+
+
+@analytics_bp.route("/analytics/heatmap", methods=["GET"])
+@jwt_required()
+def heatmap():
+    user_id = int(get_jwt_identity())
+    return respond(cached(user_id, "heatmap", None, lambda: spending_heatmap(user_id)))
+
+
+@analytics_bp.route("/analytics/compare", methods=["GET"])
+@jwt_required()
+def compare():
+    user_id = int(get_jwt_identity())
+
+    period = request.args.get("period", "month").lower()
+    if period not in COMPARE_PERIODS:
+        return jsonify({"error": "Invalid period"}), 400
+
+    return respond(cached(user_id, "compare", period, lambda: period_comparison(user_id, period)))
@@ -1,21 +1,51 @@
 from flask import Blueprint, request, jsonify, current_app as app
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask_jwt_extended import (
-    create_access_token,
-    create_refresh_token,
-    jwt_required,
-    get_jwt_identity
-)
+from flask_jwt_extended import jwt_required, get_jwt_identity, get_jwt
 from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 import secrets
 
 from extensions import db
 from models import User, PasswordResetToken
-from utils import send_link
+from utils import reset_link_contents
+from outbox import enqueue_email
+from ratelimit import rate_limit
+from hashing import hash_password, verify_password, HashingBusy
+from revocation import issue_tokens, rotate_refresh, revoke_family, revoke_token, revoke_user_tokens, FAMILY_CLAIM
 
 auth_bp = Blueprint("auth", __name__)
 
+
+@auth_bp.app_errorhandler(HashingBusy)
+def hashing_busy(e):
+    response = jsonify({"error": "Server busy, try again shortly"})
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
+
+UNIQUE_FIELD_ERRORS = {
+    "name": "Username already exists",
+    "email": "Email already registered",
+    "number": "Phone number already registered",
+}
+
+
+def registration_conflicts(name, email, number):
+    """Field errors for the given values that already belong to a user."""
+    wanted = {field: value for field, value in (("name", name), ("email", email), ("number", number)) if value}
+    if not wanted:
+        return {}
+    rows = db.session.query(User.name, User.email, User.number).filter(
+        or_(*(getattr(User, field) == value for field, value in wanted.items()))
+    ).limit(len(wanted)).all()
+    return {
+        field: UNIQUE_FIELD_ERRORS[field]
+        for field, value in wanted.items()
+        if any(getattr(row, field) == value for row in rows)
+    }
+
 @auth_bp.route("/register", methods=["POST"])
+@rate_limit("register")
 def register():
     data = request.get_json() or {}
 
@@ -26,23 +56,12 @@ def register():
     password = data.get("password", "")
     number = data.get("number", "").strip()
 
-    # Name
     if not name:
         errors["name"] = "Username is required"
-    elif User.query.filter_by(name=name).first():
-        errors["name"] = "Username already exists"
-
-    # Email
     if not email:
         errors["email"] = "Email is required"
-    elif User.query.filter_by(email=email).first():
-        errors["email"] = "Email already registered"
-
-    # Number
     if not number:
         errors["number"] = "Phone number is required"
-    elif User.query.filter_by(number=number).first():
-        errors["number"] = "Phone number already registered"
 
     # Password
     if not password:
@@ -50,6 +69,9 @@ def register():
     elif len(password) < 7:
         errors["password"] = "Password must be at least 7 characters"
 
+    # Name, email and number taken, in one query
+    errors.update(registration_conflicts(name, email, number))
+
     if errors:
         return jsonify({ "errors": errors }), 400
 
@@ -58,14 +80,24 @@ def register():
         name=name,
         email=email,
         number=number,
-        password=generate_password_hash(password)
+        password=hash_password(password)
     )
     db.session.add(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent signup took one of the values after our check; the
+        # unique constraints caught it, the check now says which. Anything
+        # else is not a field the client can fix, so it is not blamed on one
+        db.session.rollback()
+        conflicts = registration_conflicts(name, email, number)
+        if not conflicts:
+            return jsonify({"error": "Registration conflicts with an existing account"}), 409
+        return jsonify({ "errors": conflicts }), 400
 
     # Generate tokens for immediate login
-    access_token = create_access_token(identity=str(user.id))
-    refresh_token = create_refresh_token(identity=str(user.id))
+    access_token, refresh_token = issue_tokens(user.id)
+    db.session.commit()
 
     return jsonify({
         "message": "User registered successfully",
@@ -78,6 +110,7 @@ def register():
 
 
 @auth_bp.route("/login", methods=["POST"])
+@rate_limit("login", user_field="name")
 def login():
     data = request.get_json() or {}
 
@@ -97,29 +130,60 @@ def login():
 
     user = User.query.filter_by(name=name).first()
 
-    if not user or not check_password_hash(user.password, password):
+    if not user or not verify_password(user, password):
         return jsonify({"message": "Invalid username or password"}), 401
+    if user.disabled_at is not None:
+        return jsonify({"message": "This account is being deleted"}), 403
+    access_token, refresh_token = issue_tokens(user.id)
+    # Also saves a hash upgraded to the current parameters, if any
+    db.session.commit()
 
     return jsonify({
         "message": "Login successful",
-        "access_token": create_access_token(identity=str(user.id)),
-        "refresh_token": create_refresh_token(identity=str(user.id))
+        "access_token": access_token,
+        "refresh_token": refresh_token
     }), 200
 
 
 
-# Refresh token
+# Refresh token, rotated on every use
 @auth_bp.route("/refresh", methods=["POST"])
 @jwt_required(refresh=True)
 def refresh():
     user_id = get_jwt_identity()
+    user = db.session.get(User, int(user_id))
+    if user is None or user.disabled_at is not None:
+        return jsonify({"message": "Account no longer active"}), 401
+
+    tokens = rotate_refresh(get_jwt())
+    # Commit the family revocation on reuse too
+    db.session.commit()
+    if tokens is None:
+        return jsonify({"message": "Refresh token already used, please log in again"}), 401
+
+    access_token, refresh_token = tokens
     return jsonify({
-        "access_token": create_access_token(identity=user_id)
+        "access_token": access_token,
+        "refresh_token": refresh_token
     }), 200
 
 
+# Logout: ends this session's access and refresh tokens
+@auth_bp.route("/logout", methods=["POST"])
+@jwt_required(verify_type=False)
+def logout():
+    payload = get_jwt()
+    if payload.get(FAMILY_CLAIM):
+        revoke_family(payload[FAMILY_CLAIM], int(payload["sub"]))
+    else:
+        revoke_token(payload)
+    db.session.commit()
+    return jsonify({"message": "Logged out"}), 200
+
+
 # Forgot password 
 @auth_bp.route("/forgot-password", methods=["POST"])
+@rate_limit("forgot_password", user_field="email")
 def forgot_password():
     data = request.get_json() or {}
     email = data.get("email")
@@ -139,15 +203,12 @@ def forgot_password():
         )
 
         db.session.add(reset_token)
-        db.session.commit()
 
         frontend_url = app.config.get("FRONTEND_URL")
         reset_link = f"{frontend_url}/reset-password?token={token}"
-
-        try:
-            send_link(user.email, reset_link, user.name)
-        except Exception as e:
-            app.logger.error(f"Password reset email failed: {e}")
+        # Sent by the outbox worker, committed with the token it links to
+        enqueue_email(user.email, "Reset Your Password", reset_link_contents(reset_link, user.name), user.id)
+        db.session.commit()
 
         app.logger.info(f"Reset link generated for user_id={user.id}")
 
@@ -156,6 +217,7 @@ def forgot_password():
 
 # Reset password
 @auth_bp.route("/reset-password", methods=["POST"])
+@rate_limit("reset_password")
 def reset_password():
     data = request.get_json() or {}
 
@@ -177,7 +239,8 @@ def reset_password():
     if not user:
         return jsonify({"error": "User not found"}), 404
 
-    user.password = generate_password_hash(new_password)
+    user.password = hash_password(new_password)
+    revoke_user_tokens(user.id, reason="password_reset")
 
     db.session.delete(reset_token)
     db.session.commit()
@@ -204,13 +267,20 @@ def change_password():
     if not user:
         return jsonify({"error": "User not found"}), 404
 
-    if not check_password_hash(user.password, current_password):
+    if not verify_password(user, current_password):
         return jsonify({"error": "Current password is incorrect"}), 401
 
-    user.password = generate_password_hash(new_password)
+    user.password = hash_password(new_password)
+    # Sign out every other session; this one carries on with a new pair
+    revoke_user_tokens(user.id, reason="password_change")
+    access_token, refresh_token = issue_tokens(user.id)
     db.session.commit()
 
-    return jsonify({"message": "Password updated successfully"}), 200
+    return jsonify({
+        "message": "Password updated successfully",
+        "access_token": access_token,
+        "refresh_token": refresh_token
+    }), 200
 
 
 
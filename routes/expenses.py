@@ -1,14 +1,32 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app as app
 from extensions import db
 from models import Expense, ExpenseHistory
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from config import ALLOWED_CATEGORIES, ALLOWED_CURRENCIES
 from datetime import datetime, timezone
+from budget import spend_deltas, month_key, apply_spend, reset_spend, enqueue_budget_alerts
+from analytics import invalidate_analytics
+from anomaly import record_expense, forget_expense, reset_stats
+from serializers import Rows, respond, select_fields
+from history import history_row, reconstruct_version, edit_count
+from sqlalchemy import insert
+from idempotency import idempotent, commit_response
+from bulk import bulk_filter, bulk_delete, bulk_update, BULK_UPDATE_FIELDS
 
 expenses_bp = Blueprint("expenses", __name__)
 
+EXPENSE_COLUMNS = (
+    Expense.id, Expense.title, Expense.currency, Expense.amount,
+    Expense.date, Expense.category, Expense.description
+)
+
+HISTORY_COLUMNS = (
+    ExpenseHistory.id, ExpenseHistory.changes, ExpenseHistory.timestamp
+)
+
 @expenses_bp.route("/expenses", methods=["POST"])
 @jwt_required()
+@idempotent
 def add_expense():
     user_id = int(get_jwt_identity())
 
@@ -71,9 +89,17 @@ def add_expense():
             )
             db.session.add(recurring)
 
-        db.session.commit()
+        anomaly = record_expense(user_id, data["category"], data["amount"])
 
-        return jsonify({
+        deltas = spend_deltas()
+        deltas[month_key(expense_date)] += float(data["amount"])
+        enqueue_budget_alerts(apply_spend(user_id, deltas))
+        invalidate_analytics(user_id)
+        # Answer with the stored values, as a reload after commit would
+        db.session.flush()
+        db.session.refresh(new_expense)
+
+        return commit_response((jsonify({
             "message": "Expense added successfully",
             "title": new_expense.title,
             "currency": new_expense.currency,
@@ -81,8 +107,9 @@ def add_expense():
             "date": new_expense.date.isoformat(),
             "category": new_expense.category,
             "description": new_expense.description,
-            "is_recurring": bool(data.get("is_recurring"))
-        }), 201
+            "is_recurring": bool(data.get("is_recurring")),
+            "anomaly": anomaly
+        }), 201))
 
     except Exception as e:
         db.session.rollback()
@@ -100,26 +127,24 @@ def get_expenses():
         per_page = int(request.args.get("per_page", 10))
     except ValueError:
         return jsonify({"error": "Page and per_page must be integers"}), 400
-    query = Expense.query.filter_by(user_id=user_id).order_by(Expense.date.desc())
+    try:
+        columns = select_fields(EXPENSE_COLUMNS, request.args.get("fields"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    query = db.session.query(*columns).filter(
+        Expense.user_id == user_id
+    ).order_by(Expense.date.desc())
     pagination = query.paginate(page=page, per_page=per_page, error_out=False)
-    expenses_list = [{
-        "id": e.id,
-        "title": e.title,
-        "currency": e.currency,
-        "amount": e.amount,
-        "date": e.date.isoformat(),
-        "category": e.category,
-        "description": e.description
-    } for e in pagination.items]
-    return jsonify({
-        "expenses": expenses_list,
+    return respond({
+        "expenses": Rows((c.key for c in columns), pagination.items),
         "page": pagination.page,
         "per_page": pagination.per_page,
         "total": pagination.total,
         "pages": pagination.pages,
         "has_next": pagination.has_next,
         "has_prev": pagination.has_prev
-    }), 200
+    }, 200)
 
 @expenses_bp.route("/expenses/<int:expense_id>", methods=["PUT"])
 @jwt_required()
@@ -136,6 +161,8 @@ def update_expense(expense_id):
             return jsonify({"error": "Invalid currency selected"}), 400
         if "category" in data and data["category"] not in ALLOWED_CATEGORIES:
             return jsonify({"error": "Invalid category selected"}), 400
+        old_date, old_amount, old_category = expense.date, expense.amount, expense.category
+        changes = {}
         for field in ["title", "currency", "amount", "date", "category", "description"]:
             if field in data:
                 old_value = getattr(expense, field)
@@ -146,18 +173,31 @@ def update_expense(expense_id):
                         new_value = new_value.replace(tzinfo=timezone.utc)
                     else:
                         new_value = new_value.astimezone(timezone.utc)
-                    old_value = old_value.date()
-                    new_value = new_value.date()
+                    # Only a change of day counts as an edit of the date
+                    if old_value.date() == new_value.date():
+                        continue
                 if old_value != new_value:
                     setattr(expense, field, new_value)
-                    history = ExpenseHistory(
-                        expense_id=expense.id,
-                        user_id=user_id,
-                        field=field,
-                        old_value=str(old_value),
-                        new_value=str(new_value)
-                    )
-                    db.session.add(history)
+                    changes[field] = (old_value, new_value)
+
+        alerts = []
+        if expense.date != old_date or expense.amount != old_amount:
+            deltas = spend_deltas()
+            deltas[month_key(old_date)] -= float(old_amount)
+            deltas[month_key(expense.date)] += float(expense.amount)
+            alerts = apply_spend(user_id, deltas)
+
+        if expense.amount != old_amount or expense.category != old_category:
+            forget_expense(user_id, old_category, old_amount)
+            record_expense(user_id, expense.category, expense.amount)
+
+        # Executing the insert flushes the edit, so it must come after
+        # apply_spend has seeded any new month from the stored rows
+        if changes:
+            db.session.execute(insert(ExpenseHistory), [history_row(expense.id, user_id, changes)])
+
+        enqueue_budget_alerts(alerts)
+        invalidate_analytics(user_id)
         db.session.commit()
         return jsonify({"message": "Expense updated successfully"}), 200
     except Exception as e:
@@ -171,21 +211,47 @@ def expense_history(expense_id):
 
     page = request.args.get("page", 1, type=int)
     per_page = request.args.get("per_page", 5, type=int)
-    query = ExpenseHistory.query.filter_by(expense_id=expense_id, user_id=user_id).order_by(ExpenseHistory.timestamp.desc())
+    try:
+        columns = select_fields(HISTORY_COLUMNS, request.args.get("fields"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    query = db.session.query(*columns).filter(
+        ExpenseHistory.expense_id == expense_id,
+        ExpenseHistory.user_id == user_id
+    ).order_by(ExpenseHistory.timestamp.desc(), ExpenseHistory.id.desc())
     pagination = query.paginate(page=page, per_page=per_page, error_out=False)
-    return jsonify({
-        "history": [{
-            "id": h.id,
-            "field": h.field,
-            "old_value": h.old_value,
-            "new_value": h.new_value,
-            "timestamp": h.timestamp.strftime("%Y-%m-%dT%H:%M:%S")
-        } for h in pagination.items],
+    return respond({
+        "history": Rows(
+            (c.key for c in columns),
+            pagination.items,
+            converters={"timestamp": lambda t: t.strftime("%Y-%m-%dT%H:%M:%S")}
+        ),
         "page": pagination.page,
         "pages": pagination.pages,
         "total": pagination.total
     })
 
+@expenses_bp.route("/expenses/<int:expense_id>/versions/<int:version>", methods=["GET"])
+@jwt_required()
+def expense_version(expense_id, version):
+    user_id = int(get_jwt_identity())
+
+    expense = Expense.query.filter_by(id=expense_id, user_id=user_id).first()
+    if not expense:
+        return jsonify({"error": "Expense not found"}), 404
+
+    versions = edit_count(expense_id)
+    if version > versions:
+        return jsonify({"error": f"Expense has {versions} edits, version must be at most {versions}"}), 404
+
+    return jsonify({
+        "id": expense.id,
+        "version": version,
+        "versions": versions,
+        "expense": reconstruct_version(expense, version)
+    })
+
 @expenses_bp.route("/expenses/<int:expense_id>", methods=["DELETE"])
 @jwt_required()
 def delete_expense(expense_id):
@@ -194,7 +260,12 @@ def delete_expense(expense_id):
 
     expense = Expense.query.filter_by(id=expense_id, user_id=user_id).first()
     if expense:
+        deltas = spend_deltas()
+        deltas[month_key(expense.date)] -= float(expense.amount)
+        apply_spend(user_id, deltas)
+        forget_expense(user_id, expense.category, expense.amount)
         db.session.delete(expense)
+        invalidate_analytics(user_id)
         db.session.commit()
         return jsonify({"message": "Expense deleted successfully"}), 200
     return jsonify({"error": "Expense not found"}), 404
@@ -206,10 +277,51 @@ def delete_expenses():
 
 
     deleted = Expense.query.filter_by(user_id=user_id).delete()
+    reset_spend(user_id)
+    reset_stats(user_id)
+    invalidate_analytics(user_id)
     db.session.commit()
     return jsonify({"message": f"Deleted {deleted} expenses"}), 200
 
 
+@expenses_bp.route("/expenses/bulk-delete", methods=["POST"])
+@jwt_required()
+def bulk_delete_expenses():
+    user_id = int(get_jwt_identity())
+
+    data = request.get_json() or {}
+    try:
+        conditions = bulk_filter(user_id, data.get("filter"))
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    deleted = bulk_delete(user_id, conditions, app.config.get("BULK_CHUNK_SIZE", 500))
+    return jsonify({"message": f"Deleted {deleted} expenses", "deleted": deleted}), 200
+
+
+@expenses_bp.route("/expenses/bulk-update", methods=["POST"])
+@jwt_required()
+def bulk_update_expenses():
+    user_id = int(get_jwt_identity())
+
+    data = request.get_json() or {}
+    values = data.get("set")
+    if not isinstance(values, dict) or not values:
+        return jsonify({"error": "set must be a non-empty object"}), 400
+    for field, value in values.items():
+        if field not in BULK_UPDATE_FIELDS:
+            return jsonify({"error": f"Only {', '.join(BULK_UPDATE_FIELDS)} can be bulk updated"}), 400
+        if value not in BULK_UPDATE_FIELDS[field]:
+            return jsonify({"error": f"Invalid {field} selected"}), 400
+    try:
+        conditions = bulk_filter(user_id, data.get("filter"))
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    updated = bulk_update(user_id, conditions, values, app.config.get("BULK_CHUNK_SIZE", 500))
+    return jsonify({"message": f"Updated {updated} expenses", "updated": updated}), 200
+
+
 @expenses_bp.route("/debug-jwt", methods=["GET"])
 @jwt_required()
 def debug_jwt():
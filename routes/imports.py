@@ -0,0 +1,103 @@
+import os
+import json
+import uuid
+from functools import partial
+from flask import Blueprint, request, jsonify, url_for, current_app as app
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from werkzeug.utils import secure_filename
+from extensions import db, scheduler
+from models import ImportJob
+from config import ALLOWED_CATEGORIES, ALLOWED_CURRENCIES
+from importer import (
+    run_import,
+    job_progress,
+    import_dir,
+    IMPORT_FORMATS,
+    DEFAULT_COLUMN_MAPPING
+)
+
+imports_bp = Blueprint("imports", __name__)
+
+
+@imports_bp.route("/expenses/import", methods=["POST"])
+@jwt_required()
+def import_expenses():
+    user_id = int(get_jwt_identity())
+
+    if "file" not in request.files:
+        return jsonify({"error": "No file uploaded"}), 400
+    file = request.files["file"]
+    if file.filename == "":
+        return jsonify({"error": "Empty filename"}), 400
+
+    file_format = request.form.get("format") or file.filename.rsplit(".", 1)[-1]
+    file_format = file_format.lower()
+    if file_format not in IMPORT_FORMATS:
+        return jsonify({"error": "Unsupported format, expected csv or ofx"}), 400
+
+    mapping = DEFAULT_COLUMN_MAPPING
+    if request.form.get("mapping"):
+        try:
+            mapping = json.loads(request.form["mapping"])
+        except ValueError:
+            return jsonify({"error": "mapping must be a JSON object"}), 400
+        if not isinstance(mapping, dict) or set(mapping) - set(DEFAULT_COLUMN_MAPPING):
+            return jsonify({"error": f"mapping keys must be among {sorted(DEFAULT_COLUMN_MAPPING)}"}), 400
+        # Fields left out keep their default column
+        mapping = {**DEFAULT_COLUMN_MAPPING, **mapping}
+
+    currency = request.form.get("currency")
+    if currency and currency not in ALLOWED_CURRENCIES:
+        return jsonify({"error": "Invalid currency selected"}), 400
+    category = request.form.get("category")
+    if category and category not in ALLOWED_CATEGORIES:
+        return jsonify({"error": "Invalid category selected"}), 400
+
+    # FileStorage.save copies in blocks, the upload never sits in memory whole
+    file_path = os.path.join(import_dir(), f"{user_id}_{uuid.uuid4().hex}.{file_format}")
+    file.save(file_path)
+
+    job = ImportJob(
+        user_id=user_id,
+        filename=secure_filename(file.filename) or f"import.{file_format}",
+        file_format=file_format,
+        status="pending",
+        bytes_total=os.path.getsize(file_path),
+        bytes_read=0,
+        processed_rows=0,
+        imported_rows=0,
+        duplicate_rows=0,
+        invalid_rows=0
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    options = {
+        "mapping": mapping,
+        "currency": currency,
+        "category": category,
+        "date_format": request.form.get("date_format")
+    }
+    scheduler.add_job(
+        partial(run_import, job.id, file_path, options, app=app._get_current_object()),
+        trigger="date",
+        id=f"expense_import_{job.id}",
+        replace_existing=True
+    )
+
+    return jsonify({
+        "message": "Import started",
+        "job": job_progress(job),
+        "status_url": url_for("imports.import_status", job_id=job.id)
+    }), 202
+
+
+@imports_bp.route("/expenses/import/<int:job_id>", methods=["GET"])
+@jwt_required()
+def import_status(job_id):
+    user_id = int(get_jwt_identity())
+
+    job = ImportJob.query.filter_by(id=job_id, user_id=user_id).first()
+    if not job:
+        return jsonify({"error": "Import not found"}), 404
+    return jsonify(job_progress(job)), 200
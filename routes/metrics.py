@@ -0,0 +1,15 @@
+import hmac
+from flask import Blueprint, request, jsonify, current_app as app
+from metrics import metrics
+from outbox import outbox_stats
+
+metrics_bp = Blueprint("metrics", __name__)
+
+
+@metrics_bp.route("/metrics", methods=["GET"])
+def metrics_snapshot():
+    """Counters, summaries and outbox queue depth, for whoever holds METRICS_TOKEN."""
+    token = app.config.get("METRICS_TOKEN")
+    if not token or not hmac.compare_digest(request.headers.get("X-Metrics-Token", ""), token):
+        return jsonify({"error": "Not found"}), 404
+    return jsonify({**metrics.snapshot(), "outbox": outbox_stats()})
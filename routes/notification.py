@@ -2,8 +2,8 @@ from flask import request, Blueprint, jsonify, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import NotificationSetting, User, FCMToken
 from scheduler import schedule_user_daily_push
-from extensions import db
-from datetime import datetime
+from extensions import db, upsert_insert
+from datetime import datetime, timezone
 
 notification_bp = Blueprint("notification", __name__)
 
@@ -40,6 +40,20 @@ def notification_setting():
 
     return jsonify({"message": "Notification setting saved"}), 200
 
+def upsert_fcm_token(user_id, token):
+    """
+    Register token for user_id in one statement: a new token is inserted, a
+    known one moves to this user (the device changed hands) and is marked
+    as seen now.
+    """
+    now = datetime.now(timezone.utc)
+    statement = upsert_insert(FCMToken).values(user_id=user_id, token=token, created_at=now, last_seen_at=now)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[FCMToken.token],
+        set_={"user_id": statement.excluded.user_id, "last_seen_at": statement.excluded.last_seen_at}
+    ))
+
+
 @notification_bp.route("/save-fcm-token", methods=["POST"])
 @jwt_required()
 def save_fcm_token():
@@ -52,19 +66,7 @@ def save_fcm_token():
     user_id = int(get_jwt_identity())
 
     try:
-        FCMToken.query.filter(
-            FCMToken.token == token,
-            FCMToken.user_id != user_id
-        ).delete(synchronize_session=False)
-
-        existing = FCMToken.query.filter_by(
-            user_id=user_id,
-            token=token
-        ).first()
-
-        if not existing:
-            db.session.add(FCMToken(user_id=user_id, token=token))
-
+        upsert_fcm_token(user_id, token)
         db.session.commit()
         return {"message": "FCM token registered to user"}, 200
 
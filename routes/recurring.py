@@ -4,11 +4,23 @@ from models import RecurringExpense, Expense
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from datetime import datetime, timezone
 from config import ALLOWED_RECURRING_FREQUENCIES
+from budget import spend_deltas, month_key, apply_spend, enqueue_budget_alerts
+from analytics import invalidate_analytics
+from anomaly import record_expense
+from serializers import Rows, respond, select_fields
+from idempotency import idempotent, commit_response
 
 recurring_bp = Blueprint("recurring", __name__)
 
+RECURRING_COLUMNS = (
+    RecurringExpense.id, RecurringExpense.name, RecurringExpense.currency, RecurringExpense.amount,
+    RecurringExpense.category, RecurringExpense.description, RecurringExpense.frequency,
+    RecurringExpense.next_run
+)
+
 @recurring_bp.route("/recurring", methods=["POST"])
 @jwt_required()
+@idempotent
 def create_recurring():
     user_id = int(get_jwt_identity())
     data = request.get_json()
@@ -37,25 +49,20 @@ def create_recurring():
         next_run=next_run
     )
     db.session.add(rec)
-    db.session.commit()
-    return jsonify({"message": "Recurring expense created"}), 201
+    return commit_response((jsonify({"message": "Recurring expense created"}), 201))
 
 
 @recurring_bp.route("/recurring", methods=["GET"])
 @jwt_required()
 def get_recurring():
     user_id = int(get_jwt_identity())
-    rec_list = RecurringExpense.query.filter_by(user_id=user_id).all()
-    return jsonify([{
-        "id": r.id,
-        "name": r.name,
-        "currency": r.currency,
-        "amount": r.amount,
-        "category": r.category,
-        "description": r.description,
-        "frequency": r.frequency,
-        "next_run": r.next_run.isoformat()
-    } for r in rec_list])
+    try:
+        columns = select_fields(RECURRING_COLUMNS, request.args.get("fields"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    rows = db.session.query(*columns).filter(RecurringExpense.user_id == user_id).all()
+    return respond(Rows((c.key for c in columns), rows))
 
 
 @recurring_bp.route("/recurring/run", methods=["POST"])
@@ -64,6 +71,7 @@ def run_recurring():
     user_id = int(get_jwt_identity())
     rec_list = RecurringExpense.query.filter_by(user_id=user_id).all()
     created_count = 0
+    deltas = spend_deltas()
 
     for r in rec_list:
         r_next_run = r.next_run
@@ -86,12 +94,16 @@ def run_recurring():
         )
         db.session.add(expense)
         created_count += 1
+        deltas[month_key(expense.date)] += float(r.amount)
+        record_expense(user_id, r.category, r.amount)
 
         freq = r.frequency.lower()
         if freq not in ALLOWED_RECURRING_FREQUENCIES:
             continue
         r.next_run = r_next_run + ALLOWED_RECURRING_FREQUENCIES[freq]
 
+    enqueue_budget_alerts(apply_spend(user_id, deltas))
+    invalidate_analytics(user_id)
     db.session.commit()
     return jsonify({
         "message": "Recurring expenses processed",
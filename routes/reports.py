@@ -1,8 +1,12 @@
-from flask import Blueprint, request, jsonify, url_for, current_app as app
+import os
+from flask import Blueprint, request, jsonify, url_for, send_file, redirect, current_app as app
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from extensions import db
 from models import User, Expense
 from utils import generate_pdf_or_csv, send_email, generate_csv, generate_pdf
+from report_cache import data_version, report_key, cached_report, store_report, REPORT_PREFIX
+from storage import get_storage, local_copy
 from datetime import datetime, timezone, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 
@@ -11,6 +15,78 @@ scheduler = BackgroundScheduler()
 scheduler.start()
 
 
+def build_report(user_id, file_format, start_date=None, end_date=None, version=None):
+    """
+    Return the reports storage key of a report for the range, reusing the
+    stored one if the data has not changed.
+    """
+    version = version or data_version(user_id, start_date, end_date)
+    key = report_key(user_id, start_date, end_date, file_format, version)
+
+    name = cached_report(user_id, key, file_format)
+    if name:
+        return name
+
+    query = Expense.query.filter(Expense.user_id == user_id)
+    if start_date is not None:
+        query = query.filter(Expense.date >= start_date)
+    if end_date is not None:
+        query = query.filter(Expense.date <= end_date)
+
+    file_path = generate_pdf_or_csv(query.all(), file_format, user_id)
+    return store_report(user_id, key, file_format, file_path)
+
+
+def _link_serializer():
+    return URLSafeTimedSerializer(app.config["JWT_SECRET_KEY"], salt="report-download")
+
+
+def report_download_link(user_id, name):
+    token = _link_serializer().dumps({"u": user_id, "f": name})
+    return url_for("reports.download_report", token=token, _external=True)
+
+
+PRESIGNED_URL_MAX_TTL = 7 * 24 * 3600
+# A signed /reports/download link is checked on every use, so the bucket URL
+# it redirects to only has to last long enough to be followed
+PRESIGNED_DOWNLOAD_TTL = 300
+
+
+def email_report_file(user, name):
+    """
+    Attach the report stored under name, or send a download link when it is
+    too big to be a comfortable attachment. With object storage the link is
+    a presigned URL straight to the bucket, otherwise a signed link to
+    /reports/download. Sent inline rather than through the outbox: the
+    caller reports the outcome to the user.
+    """
+    storage = get_storage("reports")
+    stat = storage.stat(name)
+    if stat is None:
+        raise FileNotFoundError(f"Report {name} is missing from storage")
+
+    limit = app.config.get("REPORT_ATTACHMENT_MAX_BYTES", 10 * 1024 * 1024)
+    if stat[0] <= limit:
+        with local_copy(storage, name) as path:
+            return send_email(user.email, path)
+
+    ttl = app.config.get("REPORT_LINK_TTL", 72 * 3600)
+    if storage.presigns:
+        # SigV4 presigned URLs are capped at seven days
+        ttl = min(ttl, PRESIGNED_URL_MAX_TTL)
+        link = storage.url(name, expires=ttl, download_name=name)
+    else:
+        link = report_download_link(user.id, name)
+    hours = ttl // 3600
+    send_email(
+        user.email,
+        contents=(
+            f"Your expense report is ready. It is too large to attach, "
+            f'<a href="{link}">download it here</a>. The link expires in {hours} hours.'
+        )
+    )
+
+
 @reports_bp.route("/email-report", methods=["POST"])
 @jwt_required()
 def email_report():
@@ -40,16 +116,9 @@ def email_report():
     except:
         return jsonify({"error": "Invalid date format"}), 400
 
-    expenses = Expense.query.filter(
-        Expense.user_id == user_id,
-        Expense.date >= start_date,
-        Expense.date <= end_date
-    ).all()
-
-    file_path = generate_pdf_or_csv(expenses, file_format, user_id)
-
     try:
-        send_email(user.email, file_path)
+        report = build_report(user_id, file_format, start_date, end_date)
+        email_report_file(user, report)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -83,15 +152,9 @@ def custom_report():
     except ValueError:
         return jsonify({"error": "Invalid date format"}), 400
 
-    expenses = Expense.query.filter(
-        Expense.user_id == user_id,
-        Expense.date >= start_date,
-        Expense.date <= end_date
-    ).all()
-
-    file_path = generate_pdf_or_csv(expenses, file_format, user_id)
     try:
-        send_email(user.email, file_path)
+        report = build_report(user_id, file_format, start_date, end_date)
+        email_report_file(user, report)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -124,19 +187,43 @@ def full_email_report():
 
     user = db.session.get(User, user_id)
 
-    expenses = Expense.query.filter_by(user_id=user_id).all()
-    if not expenses:
+    version = data_version(user_id)
+    if not version[0]:
         return jsonify({"error": "No expenses found"}), 404
 
-    file_path = generate_pdf_or_csv(expenses, "PDF", user_id)
     try:
-        send_email(user.email, file_path)
+        report = build_report(user_id, "PDF", version=version)
+        email_report_file(user, report)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
     return jsonify({"message": "Full expense report emailed successfully"}), 200
 
 
+@reports_bp.route("/reports/download/<token>", methods=["GET"])
+def download_report(token):
+    try:
+        data = _link_serializer().loads(token, max_age=app.config.get("REPORT_LINK_TTL", 72 * 3600))
+    except SignatureExpired:
+        return jsonify({"error": "Download link expired"}), 410
+    except BadSignature:
+        return jsonify({"error": "Invalid download link"}), 404
+
+    name = os.path.basename(data["f"])
+    storage = get_storage("reports")
+    if not name.startswith(f"{REPORT_PREFIX}{data['u']}_") or not storage.exists(name):
+        return jsonify({"error": "Download link expired"}), 410
+
+    if storage.presigns:
+        response = redirect(storage.url(name, expires=PRESIGNED_DOWNLOAD_TTL, download_name=name))
+        response.cache_control.private = True
+        response.cache_control.max_age = 0
+        return response
+
+    # send_file streams from disk in blocks rather than reading the report into memory
+    return send_file(storage.local_path(name), as_attachment=True, download_name=name, conditional=True)
+
+
 def scheduled_auto_reports():
     with app.app_context():
         today = datetime.now(timezone.utc).date()
@@ -152,17 +239,13 @@ def scheduled_auto_reports():
                 start_date = datetime(today.year, 1, 1)
 
             end_date = today
-            expenses = Expense.query.filter(
-                Expense.user_id == user.id,
-                Expense.date >= start_date,
-                Expense.date <= end_date
-            ).all()
-            if not expenses:
+            version = data_version(user.id, start_date, end_date)
+            if not version[0]:
                 continue
 
-            file_path = generate_pdf_or_csv(expenses, "PDF", user.id)
             try:
-                send_email(user.email, file_path)
+                report = build_report(user.id, "PDF", start_date, end_date, version)
+                email_report_file(user, report)
             except:
                 continue 
 
@@ -1,10 +1,13 @@
-from flask import Blueprint, request, jsonify, send_from_directory, current_app as app
+from flask import Blueprint, request, jsonify, current_app as app
 from werkzeug.utils import secure_filename
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import User
 from extensions import db
 from config import ALLOWED_EXTENSIONS
-import os
+from thumbnails import THUMBNAIL_SIZES, schedule_thumbnails, variant_key, pick_format
+from storage import get_storage
+from werkzeug.exceptions import RequestEntityTooLarge
+from media import save_upload, remove_previous_uploads, send_media, limit_upload_body, InvalidUpload
 
 uploads_bp = Blueprint("uploads", __name__)
 
@@ -14,6 +17,8 @@ def allowed_file(filename):
 @uploads_bp.route("/user/profile/upload", methods=["POST"])
 @jwt_required()
 def upload_profile_picture():
+    # Refuse an oversized body before Werkzeug spools it to parse the form
+    limit_upload_body(app.config.get("UPLOAD_MAX_BYTES"))
     if "image" not in request.files:
         return jsonify({"error": "No file uploaded"}), 400
     file = request.files["image"]
@@ -23,14 +28,45 @@ def upload_profile_picture():
         return jsonify({"error": "Invalid file type"}), 400
 
     user = User.query.get(get_jwt_identity())
-    filename = secure_filename(f"user_{user.id}_" + file.filename)
-    filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-    file.save(filepath)
+    storage = get_storage("uploads")
+    try:
+        # file.stream is Werkzeug's spooled temp file; copy it out in chunks
+        filename = save_upload(file.stream, storage, user.id, app.config.get("UPLOAD_MAX_BYTES"))
+    except InvalidUpload as e:
+        return jsonify({"error": str(e)}), 400
 
     user.profile_picture = filename
     db.session.commit()
+    remove_previous_uploads(storage, user.id, filename)
+    schedule_thumbnails(filename, app._get_current_object())
     return jsonify({"message": "Profile picture updated", "filename": filename})
 
+
+@uploads_bp.app_errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    return jsonify({"error": "File too large"}), 413
+
 @uploads_bp.route("/uploads/profile_pictures/<filename>")
 def profile_picture(filename):
-    return send_from_directory("uploads/profile_pictures", filename)
+    storage = get_storage("uploads")
+    filename = secure_filename(filename)
+    size = request.args.get("size", type=int)
+    if size is None:
+        return send_media(storage, filename)
+
+    if size not in THUMBNAIL_SIZES:
+        return jsonify({"error": f"size must be one of {sorted(THUMBNAIL_SIZES)}"}), 400
+    fmt = pick_format(request.args.get("format"), request.accept_mimetypes)
+    if fmt is None:
+        return jsonify({"error": "format must be webp or jpeg"}), 400
+
+    key = variant_key(filename, size, fmt)
+    if not storage.exists(key):
+        # Thumbnails are still being generated, the original is the best we
+        # have, but it must not be cached under the thumbnail URL
+        return send_media(storage, filename, cacheable=False)
+
+    response = send_media(storage, key)
+    if not request.args.get("format"):
+        response.vary.add("Accept")
+    return response
@@ -1,7 +1,9 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, url_for, current_app as app
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 from extensions import db
-from models import User
+from models import User, AccountDeletion
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from account_deletion import schedule_account_deletion, deletion_progress
 
 user_bp = Blueprint("user", __name__)
 
@@ -72,9 +74,45 @@ def update_profile():
 @jwt_required()
 def delete_account():
     user = User.query.get(get_jwt_identity())
-    db.session.delete(user)
-    db.session.commit()
-    return jsonify({"message": "Account deleted"})
+    if user is None:
+        return jsonify({"error": "User not found"}), 404
+
+    deletion = None
+    if user.disabled_at is not None:
+        deletion = AccountDeletion.query.filter(
+            AccountDeletion.user_id == user.id,
+            AccountDeletion.status.in_(("pending", "running"))
+        ).first()
+    if deletion is None:
+        # Disable now, the rows are removed in the background
+        deletion = schedule_account_deletion(user, app._get_current_object())
+
+    return jsonify({
+        "message": "Account scheduled for deletion",
+        "deletion": deletion_progress(deletion),
+        "status_url": url_for("user.account_deletion_status", token=_status_serializer().dumps({"d": deletion.id}))
+    }), 202
+
+
+def _status_serializer():
+    return URLSafeTimedSerializer(app.config["JWT_SECRET_KEY"], salt="account-deletion-status")
+
+
+# Deleting the account revokes every token its owner holds, so progress is
+# polled through a signed link rather than with a JWT
+@user_bp.route("/user/delete/status/<token>", methods=["GET"])
+def account_deletion_status(token):
+    try:
+        data = _status_serializer().loads(token, max_age=app.config.get("ACCOUNT_DELETION_STATUS_TTL", 7 * 24 * 3600))
+    except SignatureExpired:
+        return jsonify({"error": "Status link expired"}), 410
+    except BadSignature:
+        return jsonify({"error": "Deletion not found"}), 404
+
+    deletion = db.session.get(AccountDeletion, data["d"])
+    if deletion is None:
+        return jsonify({"error": "Deletion not found"}), 404
+    return jsonify(deletion_progress(deletion))
 
 
 @user_bp.route("/user/theme", methods=["PUT"])
@@ -4,11 +4,20 @@ from sqlalchemy import and_
 from functools import partial
 from extensions import db, scheduler
 from models import NotificationSetting, ReminderLog, Expense, FCMToken, User
-from utils import send_email
+from outbox import enqueue_email, enqueue_push, deliver_outbox
+from report_cache import cleanup_reports
+from importer import fail_orphaned_imports
+from retention import run_retention, retention_policies, stale_token_cutoff
 from firebase import firebase_messaging as messaging
+from firebase_admin.exceptions import InvalidArgumentError
+from firebase_admin.messaging import UnregisteredError, SenderIdMismatchError
 from flask import Flask
 
 
+# FCM errors meaning the token itself is dead; anything else may pass
+DEAD_TOKEN_ERRORS = (UnregisteredError, SenderIdMismatchError, InvalidArgumentError)
+
+
 async def send_single_push(token, title, body, app: Flask, click_action_url=None):
     """
     Send a push notification to a single device token.
@@ -51,22 +60,32 @@ async def send_single_push(token, title, body, app: Flask, click_action_url=None
 
     try:
         messaging.send(message)
-        return True, token
+        return True, token, None
     except Exception as e:
         print(f"Error sending push to token {token}: {e}")
-        return False, token
+        return False, token, e
 
 
 def send_push_notification(user_id: int, app: Flask, title="Expense Reminder", body="Time to add your expenses", click_action_url=None):
     """
     Send push notifications to all devices of a user.
     Uses app.config["FRONTEND_URL"] if click_action_url is not provided.
+    Tokens FCM reports as unregistered or invalid are deleted. Returns
+    (devices reached, errors that may pass on a retry).
     """
     with app.app_context():
-        tokens = [t.token for t in FCMToken.query.filter_by(user_id=user_id).all()]
+        # Tokens the app has not re-registered for a while are dead devices
+        # waiting to be pruned; sending to them only costs a failed call
+        cutoff = stale_token_cutoff(retention_policies(app)["fcm_tokens"], datetime.now(timezone.utc))
+        tokens = [
+            token for (token,) in db.session.query(FCMToken.token).filter(
+                FCMToken.user_id == user_id,
+                FCMToken.last_seen_at >= cutoff
+            )
+        ]
         if not tokens:
             print(f"No device tokens found for user {user_id}")
-            return
+            return 0, []
 
         async def send_all():
             tasks = [send_single_push(token, title, body, app, click_action_url) for token in tokens]
@@ -74,34 +93,27 @@ def send_push_notification(user_id: int, app: Flask, title="Expense Reminder", b
 
         results = asyncio.run(send_all())
 
-        success_count = sum(1 for success, _ in results if success)
-        failure_tokens = [token for success, token in results if not success]
+        success_count = sum(1 for success, _, _ in results if success)
+        dead_tokens = [token for success, token, error in results if isinstance(error, DEAD_TOKEN_ERRORS)]
+        transient = [error for success, _, error in results if not success and not isinstance(error, DEAD_TOKEN_ERRORS)]
 
-        if failure_tokens:
-            FCMToken.query.filter(FCMToken.token.in_(failure_tokens)).delete(synchronize_session=False)
+        if dead_tokens:
+            FCMToken.query.filter(FCMToken.token.in_(dead_tokens)).delete(synchronize_session=False)
             db.session.commit()
 
-        print(f"Push notification sent to user {user_id}: {success_count} success, {len(failure_tokens)} failed")
-
-
-def send_email_reminder(user_id: int, app: Flask):
-    with app.app_context():
-        user = User.query.get(user_id)
-        if not user or not user.email:
-            print(f"No email found for user {user_id}")
-            return
-        try:
-            send_email(user_email=user.email, file_path=None)
-            print(f"Email reminder sent to {user.email}")
-        except Exception as e:
-            print(f"Failed to send email to {user.email}: {e}")
+        print(
+            f"Push notification sent to user {user_id}: {success_count} success, "
+            f"{len(dead_tokens)} dead tokens, {len(transient)} failed"
+        )
+        return success_count, transient
 
 
 def send_daily_push(user_id: int, app):
     with app.app_context():
         now = datetime.now(timezone.utc)
-        send_push_notification(user_id, app)
-
+        # The push and its log row are saved together, so a crash cannot
+        # send one without the other
+        enqueue_push(user_id, "Expense Reminder", "Time to add your expenses")
         reminder = ReminderLog(user_id=user_id, push_sent_at=now)
         db.session.add(reminder)
         db.session.commit()
@@ -133,7 +145,9 @@ def check_and_send_email(reminder_id: int, app):
         ).first()
 
         if not expense_exists:
-            send_email_reminder(reminder.user_id, app)
+            user = db.session.get(User, reminder.user_id)
+            if user and user.email:
+                enqueue_email(user.email, "Your Expense Report", "Reminder: Add your expenses today!", user.id)
             reminder.email_sent = True
             db.session.commit()
 
@@ -157,3 +171,38 @@ def load_all_user_jobs(app):
         settings = NotificationSetting.query.filter_by(enabled=True).all()
         for setting in settings:
             schedule_user_daily_push(setting, app)
+
+
+def schedule_maintenance_jobs(app):
+    scheduler.add_job(
+        partial(cleanup_reports, app),
+        trigger="interval",
+        hours=6,
+        id="report_cache_cleanup",
+        replace_existing=True
+    )
+    scheduler.add_job(
+        partial(run_retention, app),
+        trigger="cron",
+        hour=3,
+        minute=30,
+        id="retention",
+        replace_existing=True
+    )
+    scheduler.add_job(
+        partial(fail_orphaned_imports, app),
+        trigger="interval",
+        minutes=5,
+        id="orphaned_imports",
+        replace_existing=True
+    )
+    # One run at a time per process; other processes claim disjoint rows
+    scheduler.add_job(
+        partial(deliver_outbox, app),
+        trigger="interval",
+        seconds=app.config.get("OUTBOX_POLL_INTERVAL", 5),
+        id="outbox_delivery",
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
@@ -0,0 +1,115 @@
+from datetime import date, datetime
+from flask import request, jsonify, current_app
+import msgpack
+
+
+MSGPACK_MIMETYPE = "application/msgpack"
+
+
+class Rows:
+    """
+    Query result tuples plus their column names. Encoded as a list of objects
+    without ever building a dict per row. converters maps a column name to a
+    callable applied to that column's values on output.
+    """
+
+    __slots__ = ("columns", "rows", "converters")
+
+    def __init__(self, columns, rows, converters=None):
+        self.columns = tuple(columns)
+        self.rows = rows
+        self.converters = converters or {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _convert(self):
+        if not self.converters:
+            return self.rows
+        funcs = [self.converters.get(c) for c in self.columns]
+        return (
+            tuple(f(v) if f and v is not None else v for f, v in zip(funcs, row))
+            for row in self.rows
+        )
+
+    def to_json(self):
+        """List of objects for the JSON provider, which encodes the dates itself."""
+        columns = self.columns
+        return [dict(zip(columns, row)) for row in self._convert()]
+
+
+def select_fields(columns, requested):
+    """
+    Narrow columns to those named in a comma separated fields= value, keeping
+    the requested order. Raises ValueError for unknown names.
+    """
+    if not requested:
+        return columns
+    by_name = {column.key: column for column in columns}
+    names = list(dict.fromkeys(name.strip() for name in requested.split(",") if name.strip()))
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return tuple(by_name[name] for name in names) or columns
+
+
+def _default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _pack_rows(packer, rows, out):
+    keys = rows.columns
+    n = len(keys)
+    map_header = packer.pack_map_header(n)
+    # Each row is packed as one flat [k1, v1, k2, v2, ...] array in a single
+    # C call; swapping its array header for a map header gives the object
+    skip = len(packer.pack_array_header(2 * n))
+    out.append(packer.pack_array_header(len(rows)))
+    for row in rows._convert():
+        flat = [None] * (2 * n)
+        flat[::2] = keys
+        flat[1::2] = row
+        out.append(map_header)
+        out.append(packer.pack(flat)[skip:])
+
+
+def _pack(packer, value, out):
+    if isinstance(value, Rows):
+        _pack_rows(packer, value, out)
+    elif isinstance(value, dict):
+        out.append(packer.pack_map_header(len(value)))
+        for key, item in value.items():
+            out.append(packer.pack(key))
+            _pack(packer, item, out)
+    elif isinstance(value, (list, tuple)):
+        out.append(packer.pack_array_header(len(value)))
+        for item in value:
+            _pack(packer, item, out)
+    else:
+        out.append(packer.pack(value))
+
+
+def to_msgpack(payload):
+    packer = msgpack.Packer(default=_default, datetime=False)
+    out = []
+    _pack(packer, payload, out)
+    return b"".join(out)
+
+
+def wants_msgpack():
+    best = request.accept_mimetypes.best_match(["application/json", MSGPACK_MIMETYPE])
+    return best == MSGPACK_MIMETYPE
+
+
+def respond(payload, status=200):
+    """jsonify, or MessagePack when the client asks for it with Accept."""
+    if wants_msgpack():
+        response = current_app.response_class(to_msgpack(payload), status=status, mimetype=MSGPACK_MIMETYPE)
+    else:
+        # The app's JSON provider knows how to encode Rows
+        response = jsonify(payload)
+        response.status_code = status
+    response.vary.add("Accept")
+    return response
@@ -0,0 +1,247 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from flask import current_app
+from config import UPLOAD_FOLDER
+
+try:
+    import boto3
+except ImportError:  # boto3 is only needed for the S3 backend
+    boto3 = None
+
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class LocalStorage:
+    """Objects as files under a root directory. Keys may contain '/'."""
+
+    presigns = False
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise ValueError(f"Key escapes storage root: {key}")
+        return path
+
+    def local_path(self, key):
+        """Filesystem path for send_file and friends, None if not stored locally."""
+        path = self.path(key)
+        return path if os.path.isfile(path) else None
+
+    def temp_dir(self):
+        # Same filesystem as the objects, so put_file(move=True) is a rename
+        return self.root
+
+    def put_file(self, source_path, key, move=False):
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if move:
+            os.replace(source_path, target)
+            return
+        tmp_path = f"{target}.part"
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, target)
+
+    def put_stream(self, stream, key):
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f"{target}.part"
+        with open(tmp_path, "wb") as out:
+            shutil.copyfileobj(stream, out, COPY_CHUNK_SIZE)
+        os.replace(tmp_path, target)
+
+    def open(self, key):
+        return open(self.path(key), "rb")
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def stat(self, key):
+        """(size in bytes, modification time as epoch seconds), or None if missing."""
+        try:
+            st = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def touch(self, key):
+        os.utime(self.path(key), None)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def list(self, prefix=""):
+        directory, _, name_prefix = prefix.rpartition("/")
+        folder = self.path(directory)
+        if not os.path.isdir(folder):
+            return []
+        with os.scandir(folder) as it:
+            return [
+                f"{directory}/{entry.name}" if directory else entry.name
+                for entry in it
+                if entry.is_file() and entry.name.startswith(name_prefix) and not entry.name.endswith(".part")
+            ]
+
+    def scan(self, prefix=""):
+        """(key, size, mtime) for every object under prefix."""
+        entries = []
+        for key in self.list(prefix):
+            stat = self.stat(key)
+            if stat is not None:
+                entries.append((key, *stat))
+        return entries
+
+    def url(self, key, expires=3600, download_name=None):
+        return None
+
+
+class S3Storage:
+    """
+    Objects in an S3 compatible bucket (AWS, MinIO, R2...). Transfers go
+    through boto3's managed multipart upload/download, so large files are
+    streamed rather than held in memory, and reads are handed to clients as
+    presigned URLs.
+    """
+
+    presigns = True
+
+    def __init__(self, bucket, prefix="", client=None, **client_options):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("The S3 storage backend requires boto3")
+            client = boto3.client("s3", **client_options)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def local_path(self, key):
+        return None
+
+    def temp_dir(self):
+        return None
+
+    def put_file(self, source_path, key, move=False):
+        self.client.upload_file(source_path, self.bucket, self._key(key))
+        if move:
+            os.remove(source_path)
+
+    def put_stream(self, stream, key):
+        self.client.upload_fileobj(stream, self.bucket, self._key(key))
+
+    def open(self, key):
+        # StreamingBody: read() / iter_chunks() pull from the socket on demand
+        return self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"]
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except self.client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def stat(self, key):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except self.client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return head["ContentLength"], head["LastModified"].timestamp()
+
+    def touch(self, key):
+        # Objects cannot be touched in place and a self-copy costs a full
+        # rewrite, so recency on S3 is the upload time
+        pass
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+        return True
+
+    def list(self, prefix=""):
+        keys = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            keys.extend(obj["Key"][len(self.prefix):] for obj in page.get("Contents", []))
+        return keys
+
+    def scan(self, prefix=""):
+        # The listing already carries size and date, no HEAD per object
+        entries = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            entries.extend(
+                (obj["Key"][len(self.prefix):], obj["Size"], obj["LastModified"].timestamp())
+                for obj in page.get("Contents", [])
+            )
+        return entries
+
+    def url(self, key, expires=3600, download_name=None):
+        params = {"Bucket": self.bucket, "Key": self._key(key)}
+        if download_name:
+            params["ResponseContentDisposition"] = f'attachment; filename="{download_name}"'
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=expires)
+
+
+@contextmanager
+def local_copy(storage, key):
+    """Yield a filesystem path for key, downloading to a temp file if needed."""
+    path = storage.local_path(key)
+    if path is not None:
+        yield path
+        return
+
+    fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+    try:
+        with os.fdopen(fd, "wb") as out:
+            shutil.copyfileobj(storage.open(key), out, COPY_CHUNK_SIZE)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
+
+
+def _build(app, name, local_root):
+    if app.config.get("STORAGE_BACKEND", "local") != "s3":
+        return LocalStorage(local_root)
+
+    options = {
+        "endpoint_url": app.config.get("S3_ENDPOINT_URL"),
+        "region_name": app.config.get("S3_REGION"),
+    }
+    return S3Storage(
+        app.config["S3_BUCKET"],
+        prefix=name,
+        **{k: v for k, v in options.items() if v}
+    )
+
+
+def reports_root(app):
+    """Local directory for report artifacts when reports are not in a bucket."""
+    return app.config.get("REPORT_CACHE_DIR") or os.path.join(app.root_path, "static", "reports", "cache")
+
+
+def get_storage(name, app=None):
+    """
+    The app's storage for "uploads" or "reports". Backends are built once per
+    app from STORAGE_BACKEND ("local" or "s3") and kept in app.extensions.
+    """
+    app = app or current_app._get_current_object()
+    stores = app.extensions.setdefault("storage", {})
+    if name not in stores:
+        local_root = app.config.get("UPLOAD_FOLDER", UPLOAD_FOLDER) if name == "uploads" else reports_root(app)
+        stores[name] = _build(app, name, local_root)
+    return stores[name]
@@ -176,7 +176,7 @@ def test_expense_history(client):
     data = response.get_json()
     assert response.status_code == 200
     assert len(data["history"]) == 1
-    assert data["history"][0]["field"] == "amount"
+    assert data["history"][0]["changes"] == {"amount": [3, 4]}
 
 def test_set_and_get_budget(client):
     token = create_auth_user(client)
@@ -361,8 +361,12 @@ def test_expenses_pagination(client, auth_headers):
 
 @patch("utils.yagmail.SMTP")
 @patch("utils.generate_pdf")
-def test_email_report(mock_generate_pdf, mock_smtp, client, auth_headers):
-    mock_generate_pdf.return_value = "/tmp/report.pdf"
+def test_email_report(mock_generate_pdf, mock_smtp, app, client, auth_headers, tmp_path):
+    app.config["REPORT_CACHE_DIR"] = str(tmp_path / "cache")
+    # Reports now go through the reports storage, so the stand-in must exist
+    generated = tmp_path / "report.pdf"
+    generated.write_bytes(b"%PDF-1.4 report")
+    mock_generate_pdf.return_value = str(generated)
 
     smtp_instance = MagicMock()
     mock_smtp.return_value = smtp_instance
@@ -385,6 +389,8 @@ def test_email_report(mock_generate_pdf, mock_smtp, client, auth_headers):
 
     mock_generate_pdf.assert_called_once()
     smtp_instance.send.assert_called_once()
+    # A path outside the report scratch directory is copied, not taken
+    assert generated.exists()
 
 @patch("routes.reports.generate_pdf_or_csv")
 def test_custom_report_csv(mock_generate_csv, client, auth_headers):
@@ -424,8 +430,11 @@ def test_custom_report_pdf(mock_generate_pdf, client, auth_headers):
 
 @patch("routes.reports.generate_pdf_or_csv")
 @patch("routes.reports.send_email")
-def test_full_email_report(mock_send_email, mock_generate, client, auth_headers):
-    mock_generate.return_value = "/tmp/full.pdf"
+def test_full_email_report(mock_send_email, mock_generate, app, client, auth_headers, tmp_path):
+    app.config["REPORT_CACHE_DIR"] = str(tmp_path / "cache")
+    generated = tmp_path / "full.pdf"
+    generated.write_bytes(b"%PDF-1.4 full")
+    mock_generate.return_value = str(generated)
     mock_send_email.return_value = None
 
     client.post(
@@ -467,3 +476,1345 @@ def test_set_auto_report_invalid_frequency(client, auth_headers):
     )
     assert response.status_code == 400
 
+
+def test_budget_alert_on_threshold(app, client, auth_headers):
+    from models import MonthlySpend, OutboxMessage
+
+    def alert_titles():
+        with app.app_context():
+            return [m.payload["title"] for m in OutboxMessage.query.filter_by(channel="push").order_by(OutboxMessage.id)]
+
+    client.post("/user/budget", json={"monthly_budget": 100}, headers=auth_headers)
+    expense = {
+        "title": "Groceries",
+        "currency": "USD",
+        "amount": 85,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "category": "Groceries"
+    }
+    client.post("/expenses", json=expense, headers=auth_headers)
+    assert alert_titles() == ["80% of monthly budget used"]
+
+    # Same threshold is not alerted twice in a month
+    client.post("/expenses", json={**expense, "amount": 5}, headers=auth_headers)
+    assert len(alert_titles()) == 1
+
+    client.post("/expenses", json={**expense, "amount": 20}, headers=auth_headers)
+    assert alert_titles() == ["80% of monthly budget used", "Monthly budget exceeded"]
+
+    with app.app_context():
+        spend = MonthlySpend.query.one()
+        assert spend.total == 110
+        assert spend.alert_level == 100
+
+def test_monthly_spend_tracks_updates_and_deletes(app, client, auth_headers):
+    from models import MonthlySpend, OutboxMessage
+
+    def january_total():
+        with app.app_context():
+            return MonthlySpend.query.filter_by(month="2024-01").one().total
+
+    client.post("/expenses", json={
+        "title": "Old",
+        "currency": "USD",
+        "amount": 40,
+        "date": "2024-01-15",
+        "category": "Food"
+    }, headers=auth_headers)
+    client.post("/expenses", json={
+        "title": "Older",
+        "currency": "USD",
+        "amount": 10,
+        "date": "2024-01-20",
+        "category": "Food"
+    }, headers=auth_headers)
+    assert january_total() == 50
+
+    client.put("/expenses/1", json={"amount": 30}, headers=auth_headers)
+    assert january_total() == 40
+
+    client.delete("/expenses/2", headers=auth_headers)
+    assert january_total() == 30
+
+    # Historical months never trigger alerts
+    with app.app_context():
+        assert OutboxMessage.query.count() == 0
+
+def test_monthly_spend_edit_across_months_and_seeding_race(app, client, auth_headers):
+    import budget
+    from models import MonthlySpend
+
+    def totals():
+        with app.app_context():
+            return {s.month: s.total for s in MonthlySpend.query.all()}
+
+    expense = {"title": "Rent", "currency": "USD", "amount": 40, "date": "2024-01-15", "category": "Bills"}
+    client.post("/expenses", json=expense, headers=auth_headers)
+    # Moving it into a month with no totals yet must not count it twice
+    client.put("/expenses/1", json={"date": "2024-03-10"}, headers=auth_headers)
+    assert totals() == {"2024-01": 0, "2024-03": 40}
+
+    # Another request seeds 2024-05 after our increment found no row
+    with app.app_context():
+        db.session.add(MonthlySpend(user_id=1, month="2024-05", total=15, alert_level=0))
+        db.session.commit()
+    real_increment = budget._increment_month
+    calls = []
+
+    def lose_race(user_id, month, delta):
+        calls.append(month)
+        return 0 if len(calls) == 1 else real_increment(user_id, month, delta)
+
+    with patch("budget._increment_month", side_effect=lose_race):
+        response = client.post("/expenses", json={**expense, "amount": 5, "date": "2024-05-02"}, headers=auth_headers)
+    assert response.status_code == 201
+    assert calls == ["2024-05", "2024-05"]
+    assert totals()["2024-05"] == 20
+
+def test_analytics_trends_and_cache_invalidation(client, auth_headers):
+    today = datetime.now(timezone.utc)
+    client.post("/expenses", json={
+        "title": "Bus",
+        "currency": "USD",
+        "amount": 12.5,
+        "date": today.isoformat(),
+        "category": "Transportation"
+    }, headers=auth_headers)
+
+    data = client.get("/analytics/trends?months=3", headers=auth_headers).get_json()
+    assert data["months"][-1] == today.strftime("%Y-%m")
+    assert data["categories"]["Transportation"][-1] == 12.5
+    assert data["totals"][-1] == 12.5
+
+    client.post("/expenses", json={
+        "title": "Lunch",
+        "currency": "USD",
+        "amount": 7.5,
+        "date": today.isoformat(),
+        "category": "Food"
+    }, headers=auth_headers)
+
+    data = client.get("/analytics/trends?months=3", headers=auth_headers).get_json()
+    assert data["totals"][-1] == 20
+
+def test_analytics_trends_ignore_future_months_and_see_other_workers_writes(app, client, auth_headers):
+    from models import User
+    client.post("/expenses", json={
+        "title": "Deposit",
+        "currency": "USD",
+        "amount": 300,
+        "date": (datetime.now(timezone.utc) + timedelta(days=400)).isoformat(),
+        "category": "Bills"
+    }, headers=auth_headers)
+    response = client.get("/analytics/trends?months=3", headers=auth_headers)
+    assert response.status_code == 200
+    assert response.get_json()["totals"] == [0.0, 0.0, 0.0]
+
+    # Another worker adds an expense: it commits the row and bumps the
+    # version, this worker's cache never hears about it directly
+    with app.app_context():
+        db.session.add(Expense(
+            user_id=1, title="Bus", amount=5, currency="USD",
+            category="Transportation", date=datetime.now(timezone.utc)
+        ))
+        User.query.get(1).analytics_version += 1
+        db.session.commit()
+    data = client.get("/analytics/trends?months=3", headers=auth_headers).get_json()
+    assert data["totals"][-1] == 5
+
+def test_expense_write_and_analytics_version_share_one_transaction(app, client, auth_headers):
+    from sqlalchemy import event
+    commits = []
+    count = lambda conn: commits.append(conn)
+    with app.app_context():
+        event.listen(db.engine, "commit", count)
+        try:
+            response = client.post("/expenses", json={
+                "title": "Lunch", "currency": "USD", "amount": 12,
+                "date": "2024-05-01", "category": "Food"
+            }, headers=auth_headers)
+        finally:
+            event.remove(db.engine, "commit", count)
+        assert response.status_code == 201
+        assert len(commits) == 1
+        assert db.session.get(User, 1).analytics_version == 1
+
+def test_analytics_heatmap_and_compare(client, auth_headers):
+    when = datetime(2024, 1, 3, 14, 30, tzinfo=timezone.utc)  # Wednesday
+    client.post("/expenses", json={
+        "title": "Coffee",
+        "currency": "USD",
+        "amount": 4,
+        "date": when.isoformat(),
+        "category": "Food"
+    }, headers=auth_headers)
+    client.post("/expenses", json={
+        "title": "Taxi",
+        "currency": "USD",
+        "amount": 9,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "category": "Transportation"
+    }, headers=auth_headers)
+
+    heatmap = client.get("/analytics/heatmap", headers=auth_headers).get_json()
+    assert heatmap["amounts"][3][14] == 4
+    assert heatmap["counts"][3][14] == 1
+
+    compare = client.get("/analytics/compare?period=month", headers=auth_headers).get_json()
+    assert compare["current"]["by_category"] == {"Transportation": 9}
+    assert compare["current"]["total"] == 9
+
+    response = client.get("/analytics/compare?period=decade", headers=auth_headers)
+    assert response.status_code == 400
+
+def test_add_expense_flags_anomaly(client, auth_headers):
+    def add(amount):
+        return client.post("/expenses", json={
+            "title": "Lunch",
+            "currency": "USD",
+            "amount": amount,
+            "date": "2024-02-01",
+            "category": "Food"
+        }, headers=auth_headers).get_json()
+
+    for amount in [10, 12, 11, 9, 10, 11]:
+        assert add(amount)["anomaly"]["flagged"] is False
+
+    data = add(95)
+    assert data["anomaly"]["flagged"] is True
+    assert data["anomaly"]["z_score"] > 3
+
+def test_backfill_category_stats_matches_incremental(app, client, auth_headers):
+    from models import CategoryStats
+    from anomaly import backfill_category_stats
+
+    for amount in [5, 7, 20, 3]:
+        client.post("/expenses", json={
+            "title": "Ride",
+            "currency": "USD",
+            "amount": amount,
+            "date": "2024-02-01",
+            "category": "Transportation"
+        }, headers=auth_headers)
+    client.put("/expenses/3", json={"amount": 9}, headers=auth_headers)
+    client.delete("/expenses/1", headers=auth_headers)
+
+    with app.app_context():
+        incremental = CategoryStats.query.one()
+        expected = (incremental.count, incremental.mean, incremental.m2)
+
+        assert backfill_category_stats() == 1
+        rebuilt = CategoryStats.query.one()
+        assert rebuilt.count == expected[0] == 3
+        assert rebuilt.mean == pytest.approx(expected[1])
+        assert rebuilt.m2 == pytest.approx(expected[2])
+
+def test_first_expense_in_category_race_shares_the_stats_row(app, client, auth_headers):
+    import anomaly
+    from models import CategoryStats
+    real_insert = anomaly.upsert_insert
+
+    # Another request's first Food expense commits its stats row just as we seed ours
+    def lose_race(model):
+        db.session.execute(real_insert(model).values(user_id=1, category="Food", count=1, mean=20.0, m2=0.0))
+        return real_insert(model)
+
+    with patch("anomaly.upsert_insert", side_effect=lose_race):
+        response = client.post("/expenses", json={
+            "title": "Lunch", "currency": "USD", "amount": 10, "date": "2024-02-01", "category": "Food"
+        }, headers=auth_headers)
+    assert response.status_code == 201
+    with app.app_context():
+        stats = CategoryStats.query.one()
+        assert (stats.count, stats.mean) == (2, 15.0)
+
+def test_report_renderer_paginates_with_subtotals(tmp_path):
+    from report_renderer import render_pdf, summarise
+
+    rows = [
+        (datetime(2024, 1, 1 + i % 28).date(), f"Item {i}", "Food" if i % 2 else "Travel", 10.0, "USD", "x" * 300)
+        for i in range(200)
+    ]
+    by_category, by_currency = summarise(rows)
+    assert by_category == {"Food": 1000.0, "Travel": 1000.0}
+    assert by_currency == {"USD": 2000.0}
+
+    path = render_pdf(rows, str(tmp_path / "report.pdf"))
+    with open(path, "rb") as f:
+        content = f.read()
+    assert content.startswith(b"%PDF")
+    assert b"/Count 1" not in content
+
+    # Without the PyFPDF 1.7 hooks rows go through cell() and paginate the same
+    with patch("report_renderer.FPDF_INTERNALS", False):
+        path = render_pdf(rows, str(tmp_path / "plain.pdf"))
+    with open(path, "rb") as f:
+        assert f.read().count(b"/Type /Page\n") == content.count(b"/Type /Page\n")
+
+def test_isolated_render_times_out_cleanly(tmp_path):
+    from report_renderer import render_pdf_isolated, _reset_pool
+
+    rows = [(datetime(2024, 1, 1).date(), f"Item {i}", "Food", 1.0, "USD", "note") for i in range(100000)]
+    path = tmp_path / "slow.pdf"
+    try:
+        with pytest.raises(RuntimeError, match="too long"):
+            render_pdf_isolated(rows, str(path), workers=1, timeout=0.2)
+        assert not path.exists()
+        # The worker gave up on its own and takes the next report
+        assert render_pdf_isolated(rows[:10], str(path), workers=1, timeout=30) == str(path)
+    finally:
+        _reset_pool()
+
+@patch("routes.reports.send_email")
+@patch("routes.reports.generate_pdf_or_csv")
+def test_report_cache_reuses_until_data_changes(mock_generate, mock_send_email, app, client, auth_headers, tmp_path):
+    app.config["REPORT_CACHE_DIR"] = str(tmp_path / "cache")
+
+    def fake_generate(expenses, file_format, user_id):
+        path = tmp_path / f"generated_{mock_generate.call_count}.pdf"
+        path.write_bytes(b"%PDF-1.4 " + str(len(expenses)).encode())
+        return str(path)
+    mock_generate.side_effect = fake_generate
+
+    expense = {
+        "title": "Rent",
+        "currency": "USD",
+        "amount": 900,
+        "date": "2024-03-01",
+        "category": "Bills"
+    }
+    report = {"start_date": "2024-03-01", "end_date": "2024-03-31", "format": "pdf"}
+    client.post("/expenses", json=expense, headers=auth_headers)
+
+    assert client.post("/reports/custom", json=report, headers=auth_headers).status_code == 200
+    assert client.post("/reports/custom", json=report, headers=auth_headers).status_code == 200
+    assert mock_generate.call_count == 1
+    first_path = mock_send_email.call_args_list[0].args[1]
+    assert mock_send_email.call_args_list[1].args[1] == first_path
+    assert os.path.dirname(first_path) == str(tmp_path / "cache")
+
+    client.put("/expenses/1", json={"amount": 950}, headers=auth_headers)
+    client.post("/reports/custom", json=report, headers=auth_headers)
+    assert mock_generate.call_count == 2
+
+def test_report_cache_evicts_least_recently_used(app, tmp_path):
+    from report_cache import evict_reports
+
+    app.config["REPORT_CACHE_DIR"] = str(tmp_path)
+    for i, name in enumerate(["old.pdf", "mid.pdf", "new.pdf"]):
+        path = tmp_path / name
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (1000 + i, 1000 + i))
+
+    with app.app_context():
+        assert evict_reports(200) == 1
+    assert sorted(os.listdir(tmp_path)) == ["mid.pdf", "new.pdf"]
+
+def test_generate_csv_streams_gzip_and_records_metrics(app):
+    import gzip
+    from metrics import metrics
+
+    expenses = [
+        Expense(title=f"Coffee {i}", amount=3.5, currency="USD", category="Food",
+                date=datetime(2024, 3, 1, tzinfo=timezone.utc), description="Morning")
+        for i in range(200)
+    ]
+    before = metrics.snapshot()["summaries"].get("report.size_bytes", {}).get("count", 0)
+
+    with app.test_request_context():
+        path = utils.generate_csv(expenses, 1)
+
+    assert path.endswith(".csv.gz")
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    os.remove(path)
+    assert lines[0] == "Title,Amount,Currency,Category,Date,Description"
+    assert len(lines) == 201
+
+    summaries = metrics.snapshot()["summaries"]
+    assert summaries["report.size_bytes"]["count"] == before + 1
+    assert summaries["report.compression_ratio"]["last"] > 1
+
+@patch("routes.reports.send_email")
+@patch("routes.reports.generate_pdf_or_csv")
+def test_large_report_is_emailed_as_download_link(mock_generate, mock_send_email, app, client, auth_headers, tmp_path):
+    app.config["REPORT_CACHE_DIR"] = str(tmp_path / "cache")
+    app.config["REPORT_ATTACHMENT_MAX_BYTES"] = 64
+
+    def fake_generate(expenses, file_format, user_id):
+        path = tmp_path / "generated.pdf"
+        path.write_bytes(b"%PDF-1.4 " + b"x" * 256)
+        return str(path)
+    mock_generate.side_effect = fake_generate
+
+    report = {"start_date": "2024-03-01", "end_date": "2024-03-31", "format": "pdf"}
+    assert client.post("/reports/custom", json=report, headers=auth_headers).status_code == 200
+
+    kwargs = mock_send_email.call_args.kwargs
+    assert len(mock_send_email.call_args.args) == 1
+    link = kwargs["contents"].split('href="')[1].split('"')[0]
+    download = client.get(link)
+    assert download.status_code == 200
+    assert download.data.startswith(b"%PDF-1.4")
+
+    assert client.get("/reports/download/not-a-token").status_code == 404
+
+@patch("routes.imports.scheduler")
+def test_import_csv_in_chunks_with_dedupe(mock_scheduler, app, client, auth_headers, tmp_path):
+    from models import ImportJob, MonthlySpend
+
+    app.config["IMPORT_UPLOAD_DIR"] = str(tmp_path)
+    app.config["IMPORT_CHUNK_SIZE"] = 2
+    client.post("/expenses", json={
+        "title": "Rent", "currency": "USD", "amount": 900,
+        "date": "2024-03-01", "category": "Bills"
+    }, headers=auth_headers)
+
+    statement = (
+        "Booked,Payee,Value,Note\n"
+        "2024-03-01,Rent,900.00,already there\n"
+        "2024-03-02,Coffee,-3.50,\n"
+        "2024-03-02,Coffee,-3.50,same again\n"
+        "2024-03-05,Groceries,\"1,024.10\",weekly shop\n"
+        "not a date,Broken,5,\n"
+    )
+    response = client.post("/expenses/import", data={
+        "file": (io.BytesIO(statement.encode()), "bank.csv"),
+        "mapping": '{"date": "Booked", "title": "Payee", "amount": "Value", "description": "Note"}',
+        "currency": "USD"
+    }, headers=auth_headers, content_type="multipart/form-data")
+    assert response.status_code == 202
+    job_id = response.get_json()["job"]["id"]
+
+    mock_scheduler.add_job.call_args.args[0]()
+
+    status = client.get(f"/expenses/import/{job_id}", headers=auth_headers).get_json()
+    assert status["status"] == "completed"
+    assert status["progress"] == 100.0
+    assert status["processed_rows"] == 5
+    assert status["imported_rows"] == 2
+    assert status["duplicate_rows"] == 2
+    assert status["invalid_rows"] == 1
+    assert status["errors"][0].startswith("line 6: invalid date")
+    assert os.listdir(tmp_path) == []
+
+    with app.app_context():
+        titles = sorted(e.title for e in Expense.query.all())
+        assert titles == ["Coffee", "Groceries", "Rent"]
+        spend = MonthlySpend.query.filter_by(month="2024-03").one()
+        assert spend.total == pytest.approx(900 + 3.5 + 1024.1)
+
+@patch("routes.imports.scheduler")
+def test_import_partial_mapping_and_orphaned_jobs(mock_scheduler, app, client, auth_headers, tmp_path):
+    from models import ImportJob
+    from importer import fail_orphaned_imports
+
+    app.config["IMPORT_UPLOAD_DIR"] = str(tmp_path)
+    statement = "Booked,Payee,Value,currency,category\n2024-03-02,Taxi,12.00,EUR,Transportation\n"
+    response = client.post("/expenses/import", data={
+        "file": (io.BytesIO(statement.encode()), "bank.csv"),
+        "mapping": '{"date": "Booked", "title": "Payee", "amount": "Value"}',
+        "currency": "USD"
+    }, headers=auth_headers, content_type="multipart/form-data")
+    job_id = response.get_json()["job"]["id"]
+    mock_scheduler.add_job.call_args.args[0]()
+    assert client.get(f"/expenses/import/{job_id}", headers=auth_headers).get_json()["imported_rows"] == 1
+    with app.app_context():
+        # Unmapped fields still come from their default columns
+        expense = Expense.query.filter_by(title="Taxi").one()
+        assert (expense.currency, expense.category) == ("EUR", "Transportation")
+
+        # Jobs whose process restarted mid-import never finish on their own
+        now = datetime.now(timezone.utc)
+        for status, age in (("running", 3600), ("pending", 3600), ("running", 5)):
+            db.session.add(ImportJob(user_id=1, filename="bank.csv", file_format="csv", status=status,
+                                     created_at=now - timedelta(seconds=age)))
+        db.session.commit()
+
+    app.config["IMPORT_STALE_AFTER"] = 600
+    assert fail_orphaned_imports(app) == 2
+    with app.app_context():
+        statuses = [job.status for job in ImportJob.query.order_by(ImportJob.id)]
+        assert statuses == ["completed", "failed", "failed", "running"]
+        orphan = db.session.get(ImportJob, 2)
+        assert orphan.finished_at is not None
+        assert "upload the file again" in orphan.errors
+
+@patch("routes.imports.scheduler")
+def test_import_ofx_keeps_debits_only(mock_scheduler, app, client, auth_headers, tmp_path):
+    app.config["IMPORT_UPLOAD_DIR"] = str(tmp_path)
+    statement = (
+        "OFXHEADER:100\nDATA:OFXSGML\n\n<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS>\n"
+        "<CURDEF>EUR\n<BANKTRANLIST>\n"
+        "<STMTTRN>\n<TRNTYPE>DEBIT\n<DTPOSTED>20240310120000[0:GMT]\n<TRNAMT>-12.40\n<NAME>Bakery\n</STMTTRN>\n"
+        "<STMTTRN>\n<TRNTYPE>CREDIT\n<DTPOSTED>20240311\n<TRNAMT>1500.00\n<NAME>Salary\n</STMTTRN>\n"
+        "</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>\n"
+    )
+    response = client.post("/expenses/import", data={
+        "file": (io.BytesIO(statement.encode()), "statement.ofx"),
+        "category": "Food"
+    }, headers=auth_headers, content_type="multipart/form-data")
+    job_id = response.get_json()["job"]["id"]
+    mock_scheduler.add_job.call_args.args[0]()
+
+    status = client.get(f"/expenses/import/{job_id}", headers=auth_headers).get_json()
+    assert (status["imported_rows"], status["invalid_rows"]) == (1, 1)
+    with app.app_context():
+        expense = Expense.query.one()
+        assert (expense.title, expense.amount, expense.currency, expense.category) == ("Bakery", 12.4, "EUR", "Food")
+
+def test_list_endpoints_negotiate_msgpack(client, auth_headers):
+    import msgpack
+
+    client.post("/expenses", json={
+        "title": "Lunch", "currency": "USD", "amount": 12.5,
+        "date": "2024-03-01T12:30:00", "category": "Food"
+    }, headers=auth_headers)
+    client.put("/expenses/1", json={"amount": 14}, headers=auth_headers)
+
+    as_json = client.get("/expenses", headers=auth_headers)
+    packed = client.get("/expenses", headers={**auth_headers, "Accept": "application/msgpack"})
+    assert packed.mimetype == "application/msgpack"
+    assert "Accept" in packed.headers["Vary"]
+    assert msgpack.unpackb(packed.data) == as_json.get_json()
+    assert as_json.get_json()["expenses"][0]["date"].startswith("2024-03-01T12:30:00")
+
+    for path in ["/expenses/1/history", "/recurring", "/analytics/heatmap"]:
+        as_json = client.get(path, headers=auth_headers).get_json()
+        packed = client.get(path, headers={**auth_headers, "Accept": "application/msgpack"})
+        assert msgpack.unpackb(packed.data) == as_json
+
+def test_list_endpoints_project_fields(app, client, auth_headers):
+    from json_provider import FastJSONProvider
+
+    assert isinstance(app.json, FastJSONProvider)
+    client.post("/expenses", json={
+        "title": "Lunch", "currency": "USD", "amount": 12.5,
+        "date": "2024-03-01T12:30:00", "category": "Food"
+    }, headers=auth_headers)
+
+    response = client.get("/expenses?fields=date,amount", headers=auth_headers)
+    assert response.get_json()["expenses"] == [{"amount": 12.5, "date": "2024-03-01T12:30:00"}]
+
+    response = client.get("/recurring?fields=name", headers=auth_headers)
+    assert response.status_code == 200 and response.get_json() == []
+
+    response = client.get("/expenses?fields=amount,user_id", headers=auth_headers)
+    assert response.status_code == 400
+    assert "user_id" in response.get_json()["error"]
+
+def test_responses_compressed_when_accepted(app, client, auth_headers):
+    import gzip
+    from flask import Response
+
+    for i in range(30):
+        client.post("/expenses", json={
+            "title": f"Lunch {i}", "currency": "USD", "amount": 12.5,
+            "date": "2024-03-01", "category": "Food"
+        }, headers=auth_headers)
+
+    plain = client.get("/expenses?per_page=30", headers=auth_headers)
+    packed = client.get("/expenses?per_page=30", headers={**auth_headers, "Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in plain.headers
+    assert packed.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in packed.headers["Vary"]
+    assert len(packed.data) < len(plain.data)
+    assert gzip.decompress(packed.data) == plain.data
+
+    small = client.get("/expenses/99/history", headers={**auth_headers, "Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
+
+    from compression import compress_response
+    with app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+        response = Response((f"row {i}\n" for i in range(1000)), mimetype="text/csv")
+        response = compress_response(response, request, app.config)
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(b"".join(response.response)).decode().count("\n") == 1000
+
+@patch("thumbnails.scheduler")
+def test_profile_picture_thumbnails(mock_scheduler, app, client, auth_headers, tmp_path):
+    from PIL import Image
+
+    app.config["UPLOAD_FOLDER"] = str(tmp_path)
+    exif = Image.Exif()
+    exif[0x010F] = "CameraMaker"
+    source = io.BytesIO()
+    Image.new("RGB", (1600, 1200), (200, 40, 40)).save(source, "JPEG", quality=95, exif=exif)
+    source.seek(0)
+
+    response = client.post("/user/profile/upload", data={"image": (source, "me.jpg")},
+                           headers=auth_headers, content_type="multipart/form-data")
+    assert response.status_code == 200
+    filename = response.get_json()["filename"]
+
+    mock_scheduler.add_job.call_args.args[0]()
+    thumbs = tmp_path / "thumbnails"
+    assert len(os.listdir(thumbs)) == 6
+
+    small = Image.open(thumbs / filename.replace(".jpg", "_64.webp"))
+    assert small.size == (64, 64)
+    assert not small.getexif()
+    assert not Image.open(thumbs / filename.replace(".jpg", "_512.jpg")).getexif()
+
+    response = client.get(f"/uploads/profile_pictures/{filename}?size=128",
+                          headers={"Accept": "image/avif,image/webp,*/*"})
+    assert response.mimetype == "image/webp"
+    assert "Accept" in response.headers["Vary"]
+    assert len(response.data) < 2048
+    response.close()
+
+    response = client.get(f"/uploads/profile_pictures/{filename}?size=64&format=jpeg")
+    assert response.mimetype == "image/jpeg"
+    response.close()
+    assert client.get(f"/uploads/profile_pictures/{filename}?size=100").status_code == 400
+
+@patch("thumbnails.scheduler")
+def test_profile_picture_urls_are_content_hashed_and_cacheable(mock_scheduler, app, client, auth_headers, tmp_path):
+    app.config["UPLOAD_FOLDER"] = str(tmp_path)
+    upload = lambda: client.post("/user/profile/upload", data={"image": (io.BytesIO(b"\xff\xd8\xff" + b"a" * 64), "me.jpg")},
+                                 headers=auth_headers, content_type="multipart/form-data")
+    filename = upload().get_json()["filename"]
+    assert filename.startswith("user_1_") and filename.endswith(".jpg")
+    assert upload().get_json()["filename"] == filename
+    assert os.listdir(tmp_path) == [filename]
+
+    response = client.get(f"/uploads/profile_pictures/{filename}")
+    assert "immutable" in response.headers["Cache-Control"]
+    assert "max-age=31536000" in response.headers["Cache-Control"]
+    etag = response.headers["ETag"]
+    assert response.headers["Last-Modified"]
+    response.close()
+
+    response = client.get(f"/uploads/profile_pictures/{filename}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    # No thumbnails yet: the original stands in but must not be cached as one
+    response = client.get(f"/uploads/profile_pictures/{filename}?size=64")
+    assert response.status_code == 200
+    assert "no-cache" in response.headers["Cache-Control"]
+    response.close()
+
+    app.config["MEDIA_ACCEL_REDIRECT_PREFIX"] = "/protected/"
+    response = client.get(f"/uploads/profile_pictures/{filename}")
+    assert response.headers["X-Accel-Redirect"] == f"/protected/{filename}"
+    assert response.data == b""
+    assert client.get("/uploads/profile_pictures/missing.jpg").status_code == 404
+
+@patch("thumbnails.scheduler")
+def test_profile_upload_sniffs_caps_and_replaces(mock_scheduler, app, client, auth_headers, tmp_path):
+    app.config["UPLOAD_FOLDER"] = str(tmp_path)
+    app.config["UPLOAD_MAX_BYTES"] = 1024
+    upload = lambda data, name="me.png": client.post(
+        "/user/profile/upload", data={"image": (io.BytesIO(data), name)},
+        headers=auth_headers, content_type="multipart/form-data"
+    )
+
+    response = upload(b"GIF89a" + b"x" * 32)
+    assert response.status_code == 400
+
+    response = upload(b"\x89PNG\r\n\x1a\n" + b"x" * 4096)
+    assert response.status_code == 413
+    assert os.listdir(tmp_path) == []
+
+    first = upload(b"\x89PNG\r\n\x1a\n" + b"a" * 100).get_json()["filename"]
+    assert first.endswith(".png")
+    thumbs = tmp_path / "thumbnails"
+    thumbs.mkdir(exist_ok=True)
+    (thumbs / first.replace(".png", "_64.webp")).write_bytes(b"thumb")
+
+    second = upload(b"\xff\xd8\xff" + b"b" * 100, "other.jpg").get_json()["filename"]
+    assert second.endswith(".jpg")
+    assert sorted(os.listdir(tmp_path)) == ["thumbnails", second]
+    assert os.listdir(thumbs) == []
+
+    app.config["MAX_CONTENT_LENGTH"] = 2048
+    assert upload(b"\x89PNG\r\n\x1a\n" + b"x" * 4096).status_code == 413
+
+    # The picture cap is applied to the whole body before the form is parsed
+    app.config["MAX_CONTENT_LENGTH"] = 60 * 1024 * 1024
+    with patch("routes.uploads.save_upload") as save:
+        assert upload(b"\x89PNG\r\n\x1a\n" + b"x" * 200 * 1024).status_code == 413
+    save.assert_not_called()
+
+def test_local_storage_backend(app, tmp_path):
+    from storage import get_storage, local_copy
+    app.config["UPLOAD_FOLDER"] = str(tmp_path)
+    with app.app_context():
+        storage = get_storage("uploads")
+        assert get_storage("uploads") is storage
+        assert not storage.presigns
+
+        storage.put_stream(io.BytesIO(b"one"), "thumbnails/user_1_a_64.webp")
+        storage.put_stream(io.BytesIO(b"two"), "user_1_a.png")
+        storage.put_stream(io.BytesIO(b"three"), "user_2_b.png")
+        assert storage.list("user_1_") == ["user_1_a.png"]
+        assert storage.list("thumbnails/user_1_") == ["thumbnails/user_1_a_64.webp"]
+        with local_copy(storage, "user_1_a.png") as path, open(path, "rb") as f:
+            assert f.read() == b"two"
+
+        assert storage.delete("user_1_a.png")
+        assert not storage.exists("user_1_a.png")
+        assert not storage.delete("user_1_a.png")
+        with pytest.raises(ValueError):
+            storage.path("../outside.png")
+
+def test_s3_storage_with_fake_client(tmp_path):
+    from storage import S3Storage, local_copy
+
+    class ClientError(Exception):
+        def __init__(self, code):
+            self.response = {"Error": {"Code": code}}
+
+    class FakeS3:
+        exceptions = MagicMock(ClientError=ClientError)
+
+        def __init__(self):
+            self.objects = {}
+
+        def upload_file(self, path, bucket, key):
+            with open(path, "rb") as f:
+                self.objects[(bucket, key)] = (f.read(), datetime.now(timezone.utc))
+
+        def upload_fileobj(self, stream, bucket, key):
+            self.objects[(bucket, key)] = (stream.read(), datetime.now(timezone.utc))
+
+        def get_object(self, Bucket, Key):
+            return {"Body": io.BytesIO(self.objects[(Bucket, Key)][0])}
+
+        def head_object(self, Bucket, Key):
+            if (Bucket, Key) not in self.objects:
+                raise ClientError("404")
+            body, modified = self.objects[(Bucket, Key)]
+            return {"ContentLength": len(body), "LastModified": modified}
+
+        def delete_object(self, Bucket, Key):
+            self.objects.pop((Bucket, Key), None)
+
+        def get_paginator(self, name):
+            assert name == "list_objects_v2"
+            paginator = MagicMock()
+            paginator.paginate.side_effect = lambda Bucket, Prefix: [{"Contents": [
+                {"Key": key, "Size": len(body), "LastModified": modified}
+                for (bucket, key), (body, modified) in sorted(self.objects.items())
+                if bucket == Bucket and key.startswith(Prefix)
+            ]}]
+            return paginator
+
+        def generate_presigned_url(self, operation, Params, ExpiresIn):
+            return f"https://s3.test/{Params['Bucket']}/{Params['Key']}?expires={ExpiresIn}&{Params.get('ResponseContentDisposition', '')}"
+
+    client = FakeS3()
+    storage = S3Storage("bucket", prefix="/reports/", client=client)
+    assert storage.presigns and storage.local_path("a.pdf") is None
+
+    source = tmp_path / "report.pdf"
+    source.write_bytes(b"%PDF-1.4 report")
+    storage.put_file(str(source), "expenses_1_a.pdf", move=True)
+    assert not source.exists()
+    assert ("bucket", "reports/expenses_1_a.pdf") in client.objects
+    storage.put_stream(io.BytesIO(b"other"), "expenses_2_b.pdf")
+
+    assert storage.open("expenses_1_a.pdf").read() == b"%PDF-1.4 report"
+    with local_copy(storage, "expenses_1_a.pdf") as path, open(path, "rb") as f:
+        assert f.read() == b"%PDF-1.4 report"
+    assert not os.path.exists(path)
+
+    assert storage.exists("expenses_1_a.pdf")
+    assert not storage.exists("missing.pdf")
+    assert storage.stat("missing.pdf") is None
+    assert storage.stat("expenses_1_a.pdf")[0] == len(b"%PDF-1.4 report")
+    assert storage.list("expenses_1_") == ["expenses_1_a.pdf"]
+    assert [key for key, _, _ in storage.scan()] == ["expenses_1_a.pdf", "expenses_2_b.pdf"]
+
+    url = storage.url("expenses_1_a.pdf", expires=60, download_name="expenses_1_a.pdf")
+    assert url.startswith("https://s3.test/bucket/reports/expenses_1_a.pdf?expires=60")
+    assert 'filename="expenses_1_a.pdf"' in url
+
+    storage.delete("expenses_1_a.pdf")
+    assert not storage.exists("expenses_1_a.pdf")
+
+@patch("account_deletion.scheduler")
+def test_delete_account_in_background(mock_scheduler, app, client, auth_headers, tmp_path):
+    from models import ExpenseHistory, AccountDeletion
+    app.config["UPLOAD_FOLDER"] = str(tmp_path)
+    (tmp_path / "user_1_0123456789abcdef.png").write_bytes(b"pic")
+    app.config["ACCOUNT_DELETE_CHUNK_SIZE"] = 2
+    for i in range(5):
+        client.post("/expenses", json={"title": f"E{i}", "amount": 10 + i, "category": "Food",
+                                       "currency": "USD", "date": "2024-01-0{}".format(i + 1)}, headers=auth_headers)
+    client.put("/expenses/1", json={"amount": 99}, headers=auth_headers)
+
+    response = client.delete("/user/delete", headers=auth_headers)
+    assert response.status_code == 202
+    deletion_id = response.get_json()["deletion"]["id"]
+    status_url = response.get_json()["status_url"]
+    assert response.get_json()["deletion"]["status"] == "pending"
+
+    # Disabled at once, the data is still there until the job runs
+    assert client.post("/login", json={"name": "testuser", "password": "password123"}).status_code == 403
+    with app.app_context():
+        assert User.query.count() == 1
+        assert Expense.query.count() == 5
+
+    mock_scheduler.add_job.call_args.args[0]()
+
+    # The user's tokens are revoked; the signed status link needs none
+    progress = client.get(status_url).get_json()
+    assert progress["status"] == "completed"
+    assert progress["deleted_rows"] >= 6
+    with app.app_context():
+        assert User.query.count() == 0
+        assert Expense.query.count() == 0
+        assert ExpenseHistory.query.count() == 0
+        assert db.session.get(AccountDeletion, deletion_id).finished_at is not None
+    assert os.listdir(tmp_path) == []
+    assert client.get(status_url[:-2] + "xx").status_code == 404
+
+def test_unfinished_account_deletions_resume_after_restart(app, client, auth_headers):
+    from models import AccountDeletion
+    from account_deletion import resume_account_deletions
+    with patch("account_deletion.scheduler"):
+        deletion_id = client.delete("/user/delete", headers=auth_headers).get_json()["deletion"]["id"]
+    with app.app_context():
+        # A second one stopped half way when the process died
+        db.session.add(AccountDeletion(user_id=99, status="running"))
+        db.session.add(AccountDeletion(user_id=98, status="completed"))
+        db.session.commit()
+
+    # The queued job died with the old process; startup queues it again
+    with patch("account_deletion.scheduler") as mock_scheduler:
+        assert resume_account_deletions(app) == 2
+    ids = [c.kwargs["id"] for c in mock_scheduler.add_job.call_args_list]
+    assert ids == [f"account_deletion_{deletion_id}", f"account_deletion_{deletion_id + 1}"]
+
+    mock_scheduler.add_job.call_args_list[0].args[0]()
+    with app.app_context():
+        assert db.session.get(AccountDeletion, deletion_id).status == "completed"
+        assert User.query.count() == 0
+
+def test_bulk_delete_and_recategorize(app, client, auth_headers):
+    from models import ExpenseHistory
+    from budget import month_key
+    from models import MonthlySpend
+    app.config["BULK_CHUNK_SIZE"] = 2
+    for i, category in enumerate(["Travel", "Travel", "Travel", "Food", "Travel"]):
+        year = 2023 if i < 4 else 2024
+        client.post("/expenses", json={"title": f"E{i}", "amount": 10, "category": category,
+                                       "currency": "USD", "date": f"{year}-03-0{i + 1}"}, headers=auth_headers)
+
+    response = client.post("/expenses/bulk-update", json={
+        "filter": {"ids": [1, 2, 4]}, "set": {"category": "Groceries"}
+    }, headers=auth_headers)
+    assert response.get_json()["updated"] == 3
+    with app.app_context():
+        assert [h.changes for h in ExpenseHistory.query.order_by(ExpenseHistory.id)] == [
+            {"category": ["Travel", "Groceries"]},
+            {"category": ["Travel", "Groceries"]},
+            {"category": ["Food", "Groceries"]},
+        ]
+        assert Expense.query.filter_by(category="Groceries").count() == 3
+
+    assert client.post("/expenses/bulk-delete", json={"filter": {}}, headers=auth_headers).status_code == 400
+    assert client.post("/expenses/bulk-update", json={"filter": {"ids": [1]}, "set": {"amount": 1}},
+                       headers=auth_headers).status_code == 400
+
+    response = client.post("/expenses/bulk-delete", json={
+        "filter": {"category": "Groceries", "start_date": "2023-01-01", "end_date": "2023-12-31"}
+    }, headers=auth_headers)
+    assert response.get_json()["deleted"] == 3
+    with app.app_context():
+        assert sorted(e.title for e in Expense.query.all()) == ["E2", "E4"]
+        assert ExpenseHistory.query.count() == 0
+        assert MonthlySpend.query.filter_by(month="2023-03").one().total == 10
+
+def test_expense_history_diffs_and_versions(client, auth_headers):
+    client.post("/expenses", json={"title": "Taxi", "amount": 12, "category": "Travel",
+                                   "currency": "USD", "date": "2024-05-01T08:00:00"}, headers=auth_headers)
+    client.put("/expenses/1", json={"amount": 15, "title": "Cab"}, headers=auth_headers)
+    client.put("/expenses/1", json={"category": "Others", "date": "2024-05-01T09:00:00"}, headers=auth_headers)
+    client.put("/expenses/1", json={"amount": 18}, headers=auth_headers)
+
+    history = client.get("/expenses/1/history", headers=auth_headers).get_json()
+    assert history["total"] == 3
+    assert history["history"][-1]["changes"] == {"amount": [12, 15], "title": ["Taxi", "Cab"]}
+    # Same day, different time is not an edit of the date
+    assert history["history"][1]["changes"] == {"category": ["Travel", "Others"]}
+
+    original = client.get("/expenses/1/versions/0", headers=auth_headers).get_json()
+    assert original["versions"] == 3
+    assert original["expense"]["title"] == "Taxi"
+    assert original["expense"]["amount"] == 12
+    assert original["expense"]["category"] == "Travel"
+
+    second = client.get("/expenses/1/versions/2", headers=auth_headers).get_json()["expense"]
+    assert (second["title"], second["amount"], second["category"]) == ("Cab", 15, "Others")
+    latest = client.get("/expenses/1/versions/3", headers=auth_headers).get_json()["expense"]
+    assert latest["amount"] == 18
+    assert client.get("/expenses/1/versions/4", headers=auth_headers).status_code == 404
+
+def test_retention_policies(app, client, auth_headers):
+    from models import PasswordResetToken, ReminderLog, ReminderMonthlyCount, ExpenseHistory, ExpenseHistoryArchive
+    from retention import run_retention
+    from metrics import metrics
+    app.config["RETENTION_CHUNK_SIZE"] = 2
+    client.post("/expenses", json={"title": "Rent", "amount": 100, "category": "Bills",
+                                   "currency": "USD", "date": "2024-01-01"}, headers=auth_headers)
+    for amount in (110, 120, 130):
+        client.put("/expenses/1", json={"amount": amount}, headers=auth_headers)
+
+    now = datetime.now(timezone.utc)
+    old = now - timedelta(days=800)
+    with app.app_context():
+        db.session.add_all([
+            PasswordResetToken(user_id=1, token="old", expires_at=now - timedelta(days=2)),
+            PasswordResetToken(user_id=1, token="fresh", expires_at=now + timedelta(hours=1)),
+            ReminderLog(user_id=1, push_sent_at=old, email_sent=True),
+            ReminderLog(user_id=1, push_sent_at=old + timedelta(days=1), email_sent=False),
+            ReminderLog(user_id=1, push_sent_at=old + timedelta(days=2), email_sent=False),
+            ReminderLog(user_id=1, push_sent_at=now),
+        ])
+        # The first two edits are old enough to be archived
+        for row in ExpenseHistory.query.order_by(ExpenseHistory.id).limit(2):
+            row.timestamp = old
+        db.session.commit()
+
+    reclaimed = run_retention(app)
+    assert reclaimed == {"password_reset_tokens": 1, "reminder_logs": 3, "expense_history": 2, "idempotency_keys": 0,
+                        "revoked_tokens": 0, "refresh_tokens": 0, "fcm_tokens": 0,
+                        "outbox_messages": 0}
+    assert metrics.snapshot()["counters"]["retention.reminder_logs.reclaimed"] >= 3
+
+    with app.app_context():
+        assert [t.token for t in PasswordResetToken.query.all()] == ["fresh"]
+        assert ReminderLog.query.count() == 1
+        counter = ReminderMonthlyCount.query.one()
+        assert (counter.pushes_sent, counter.emails_sent) == (3, 1)
+        assert ExpenseHistory.query.count() == 1
+        assert ExpenseHistoryArchive.query.one().row_count == 2
+
+    # Versions still resolve across archived and live edits
+    versions = [client.get(f"/expenses/1/versions/{n}", headers=auth_headers).get_json() for n in range(4)]
+    assert [v["expense"]["amount"] for v in versions] == [100, 110, 120, 130]
+    assert versions[0]["versions"] == 3
+    assert set(run_retention(app).values()) == {0}
+
+def test_idempotency_key_replays_writes(app, client, auth_headers):
+    from models import IdempotencyRecord
+    from retention import run_retention
+    expense = {"title": "Lunch", "amount": 9, "category": "Food", "currency": "USD", "date": "2024-06-01"}
+    headers = {**auth_headers, "Idempotency-Key": "retry-1"}
+
+    first = client.post("/expenses", json=expense, headers=headers)
+    retry = client.post("/expenses", json=expense, headers=headers)
+    assert first.status_code == retry.status_code == 201
+    assert retry.get_json() == first.get_json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert client.post("/expenses", json={**expense, "amount": 10}, headers=headers).status_code == 422
+    with app.app_context():
+        assert Expense.query.count() == 1
+
+    recurring = {"title": "Gym", "currency": "USD", "amount": 30, "category": "Health",
+                 "description": None, "frequency": "monthly"}
+    client.post("/recurring", json=recurring, headers={**auth_headers, "Idempotency-Key": "gym"})
+    client.post("/recurring", json=recurring, headers={**auth_headers, "Idempotency-Key": "gym"})
+    client.post("/expenses", json=expense, headers=auth_headers)
+    with app.app_context():
+        assert RecurringExpense.query.count() == 1
+        assert Expense.query.count() == 2
+        for record in IdempotencyRecord.query:
+            record.expires_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+        db.session.commit()
+
+    assert run_retention(app, ["idempotency_keys"]) == {"idempotency_keys": 2}
+
+def test_idempotency_claim_abandoned_by_crashed_worker_is_reclaimed(app, client, auth_headers):
+    import hashlib
+    from models import IdempotencyRecord
+    body = b'{"title": "Lunch", "amount": 9, "category": "Food", "currency": "USD", "date": "2024-06-01"}'
+    headers = {**auth_headers, "Idempotency-Key": "crashed", "Content-Type": "application/json"}
+    retry = lambda: client.post("/expenses", data=body, headers=headers)
+
+    # The worker handling the first attempt died after claiming the key
+    now = datetime.now(timezone.utc)
+    with app.app_context():
+        db.session.add(IdempotencyRecord(
+            user_id=1, key="crashed",
+            request_hash=hashlib.sha256(b"POST /expenses\n" + body).hexdigest(),
+            created_at=now - timedelta(seconds=30), expires_at=now + timedelta(hours=24)
+        ))
+        db.session.commit()
+
+    app.config["IDEMPOTENCY_LOCK_TIMEOUT"] = 60
+    assert retry().status_code == 409
+
+    app.config["IDEMPOTENCY_LOCK_TIMEOUT"] = 10
+    reclaimed = retry()
+    assert reclaimed.status_code == 201
+    replayed = retry()
+    assert replayed.headers["Idempotent-Replayed"] == "true"
+    assert replayed.get_json() == reclaimed.get_json()
+    with app.app_context():
+        assert Expense.query.count() == 1
+        assert IdempotencyRecord.query.one().status_code == 201
+
+def test_idempotent_response_commits_with_the_write(app, client, auth_headers):
+    from flask import g
+    from models import IdempotencyRecord
+    expense = {"title": "Lunch", "amount": 9, "category": "Food", "currency": "USD", "date": "2024-06-01"}
+    headers = {**auth_headers, "Idempotency-Key": "once"}
+
+    # The worker dies right after committing the expense; the first commit
+    # is the claim
+    commit = db.session.commit
+    commits = []
+    def crash():
+        commit()
+        commits.append(1)
+        if len(commits) == 2:
+            raise RuntimeError("worker died")
+    with patch.object(db.session, "commit", side_effect=crash):
+        client.post("/expenses", json=expense, headers=headers)
+    with app.app_context():
+        assert Expense.query.count() == 1
+        assert IdempotencyRecord.query.one().status_code == 201
+
+    # Even once the claim is stale the retry replays instead of writing again
+    app.config["IDEMPOTENCY_LOCK_TIMEOUT"] = 0
+    retry = client.post("/expenses", json=expense, headers=headers)
+    assert retry.status_code == 201
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+    # A request whose claim was taken over while it ran drops its write
+    def taken_over(*args):
+        user_id, key, claimed_at = g.idempotency_claim
+        g.idempotency_claim = (user_id, key, claimed_at + timedelta(seconds=1))
+    with patch("routes.expenses.invalidate_analytics", side_effect=taken_over):
+        response = client.post("/expenses", json=expense, headers={**auth_headers, "Idempotency-Key": "slow"})
+    assert response.status_code == 409
+    with app.app_context():
+        assert Expense.query.count() == 1
+        assert IdempotencyRecord.query.filter_by(key="slow").one().status_code is None
+
+def test_login_rate_limited_per_user_and_ip(app, client):
+    app.config["RATELIMIT_RULES"] = {"login": {"ip": (7, 60), "user": (3, 60)}}
+    attempt = lambda name: client.post("/login", json={"name": name, "password": "wrong-password"})
+
+    assert [attempt("victim").status_code for _ in range(3)] == [401, 401, 401]
+    refused = attempt("Victim ")
+    assert refused.status_code == 429
+    assert 1 <= int(refused.headers["Retry-After"]) <= 60
+
+    # Other accounts still work from this address until the per IP budget runs out
+    assert [attempt(f"user{i}").status_code for i in range(3)] == [401, 401, 401]
+    assert attempt("someone-else").status_code == 429
+
+def test_shared_rate_limit_window():
+    from ratelimit import SharedWindow
+
+    class StandIn:
+        """Just enough of the Redis command set for SharedWindow."""
+        def __init__(self):
+            self.data = {}
+        def pipeline(self):
+            calls = []
+            pipe = MagicMock()
+            pipe.incr.side_effect = lambda k: calls.append(lambda: self.incr(k))
+            pipe.expire.side_effect = lambda k, t: calls.append(lambda: True)
+            pipe.get.side_effect = lambda k: calls.append(lambda: self.data.get(k))
+            pipe.execute.side_effect = lambda: [call() for call in calls]
+            return pipe
+        def incr(self, key):
+            self.data[key] = self.data.get(key, 0) + 1
+            return self.data[key]
+        def decr(self, key):
+            self.data[key] -= 1
+            return self.data[key]
+
+    now = [1000.0]
+    store = StandIn()
+    # Two workers sharing one budget of 4 per 100 seconds
+    workers = [SharedWindow(store, clock=lambda: now[0]) for _ in range(2)]
+    key = ("login", "ip", "10.0.0.1", 100)
+    assert [workers[i % 2].hit(key, 4, 100)[0] for i in range(5)] == [True, True, True, True, False]
+
+    # Half way through the next window half of the previous one still counts
+    now[0] = 1150.0
+    assert [workers[0].hit(key, 4, 100)[0] for _ in range(3)] == [True, True, False]
+
+def test_rate_limit_keys_on_forwarded_client_and_syncs_refusals():
+    from ratelimit import RateLimiter
+
+    proxied = create_app({
+        "TESTING": True,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
+        "JWT_SECRET_KEY": "test-secret",
+        "FRONTEND_URL": "http://localhost:3000",
+        "PROXY_FIX_X_FOR": 1,
+        "RATELIMIT_RULES": {"login": {"ip": (2, 60)}},
+    })
+    with proxied.app_context():
+        db.create_all()
+    proxied_client = proxied.test_client()
+    attempt = lambda ip: proxied_client.post(
+        "/login", json={"name": "nobody", "password": "wrong-password"},
+        headers={"X-Forwarded-For": f"203.0.113.9, {ip}"}
+    )
+    # Each client behind the router has its own budget; only the last hop is trusted
+    assert [attempt("198.51.100.1").status_code for _ in range(3)] == [401, 401, 429]
+    assert attempt("198.51.100.2").status_code == 401
+
+    shared = MagicMock()
+    shared.hit.side_effect = [(True, 0), (False, 30), (False, 30)]
+    limiter = RateLimiter({"login": {"ip": (2, 60)}}, shared)
+    assert [limiter.hit("login", "ip", "10.0.0.1")[0] for _ in range(3)] == [True, False, False]
+    # The refusals were taken back, so the local count stays at the one shared hit
+    assert limiter.local.hit(("login", "ip", "10.0.0.1", 60), 2, 60) == (True, 0)
+
+def test_password_hashing_pool_limits_and_rehash(app, client):
+    from hashing import get_hasher
+    from werkzeug.security import generate_password_hash
+    app.config.update(PASSWORD_HASH_WORKERS=0, PASSWORD_HASH_METHOD="pbkdf2:sha256:1000")
+    client.post("/register", json={"name": "old", "email": "old@example.com", "password": "password123",
+                                   "number": "555"})
+    with app.app_context():
+        user = User.query.filter_by(name="old").one()
+        assert user.password.startswith("pbkdf2:sha256:1000$")
+        user.password = generate_password_hash("password123", "pbkdf2:sha256:500")
+        db.session.commit()
+
+    assert client.post("/login", json={"name": "old", "password": "password123"}).status_code == 200
+    with app.app_context():
+        assert User.query.filter_by(name="old").one().password.startswith("pbkdf2:sha256:1000$")
+
+    hasher = get_hasher(app)
+    for _ in range(32):
+        hasher._slots.acquire()
+    response = client.post("/login", json={"name": "old", "password": "password123"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+def test_register_reports_all_conflicts_and_lost_races(app, client):
+    import routes.auth as auth
+    from sqlalchemy.exc import IntegrityError
+    app.config["PASSWORD_HASH_WORKERS"] = 0
+    first = {"name": "alice", "email": "alice@example.com", "password": "password123", "number": "111"}
+    assert client.post("/register", json=first).status_code == 201
+
+    response = client.post("/register", json={**first, "name": "bob"})
+    assert response.get_json()["errors"] == {
+        "email": "Email already registered",
+        "number": "Phone number already registered",
+    }
+
+    # Another signup commits between our check and our insert
+    with app.app_context():
+        conflicts = auth.registration_conflicts("alice", "other@example.com", "111")
+    with patch("routes.auth.registration_conflicts", side_effect=[{}, conflicts]) as check:
+        response = client.post("/register", json={**first, "email": "other@example.com"})
+    assert check.call_count == 2
+    assert response.status_code == 400
+    assert response.get_json()["errors"] == {
+        "name": "Username already exists",
+        "number": "Phone number already registered",
+    }
+    with app.app_context():
+        assert User.query.count() == 1
+
+    # An integrity failure the check can't attribute blames no field
+    with patch("routes.auth.registration_conflicts", return_value={}), \
+            patch("routes.auth.db.session.commit", side_effect=IntegrityError("INSERT", {}, Exception("constraint"))):
+        response = client.post("/register", json={**first, "name": "carol", "email": "c@example.com", "number": "3"})
+    assert response.status_code == 409
+    assert response.get_json() == {"error": "Registration conflicts with an existing account"}
+
+def test_refresh_rotation_detects_reuse(app, client):
+    app.config["PASSWORD_HASH_WORKERS"] = 0
+    client.post("/register", json={"name": "rot", "email": "rot@example.com", "password": "password123", "number": "5"})
+    tokens = client.post("/login", json={"name": "rot", "password": "password123"}).get_json()
+    first = {"Authorization": f"Bearer {tokens['refresh_token']}"}
+
+    rotated = client.post("/refresh", headers=first)
+    assert rotated.status_code == 200
+    second = {"Authorization": f"Bearer {rotated.get_json()['refresh_token']}"}
+    access = {"Authorization": f"Bearer {rotated.get_json()['access_token']}"}
+    assert client.get("/user/profile", headers=access).status_code == 200
+
+    # The old token coming back means it leaked: the whole session ends
+    assert client.post("/refresh", headers=first).status_code == 401
+    assert client.post("/refresh", headers=second).status_code == 401
+    assert client.get("/user/profile", headers=access).status_code == 401
+
+    # Other sessions are untouched, and logging out ends just that one
+    other = client.post("/login", json={"name": "rot", "password": "password123"}).get_json()
+    other_access = {"Authorization": f"Bearer {other['access_token']}"}
+    assert client.get("/user/profile", headers=other_access).status_code == 200
+    assert client.post("/logout", headers=other_access).status_code == 200
+    assert client.post("/refresh", headers={"Authorization": f"Bearer {other['refresh_token']}"}).status_code == 401
+
+def test_password_hash_timeouts_keep_slots_until_work_ends():
+    import time
+    from hashing import PasswordHasher, HashingBusy
+    hasher = PasswordHasher("pbkdf2:sha256:1000", workers=1, queue_limit=4, timeout=0.2)
+    try:
+        # Running, or already handed to the worker process (which prefetches
+        # a couple of calls), after the caller gave up: their slots stay
+        # taken until the work ends
+        for free in (3, 2, 1):
+            with pytest.raises(HashingBusy):
+                hasher._run(time.sleep, 1)
+            assert hasher._slots._value == free
+        # Still waiting in the executor when it times out: cancelled, slot back
+        with pytest.raises(HashingBusy):
+            hasher._run(time.sleep, 1)
+        assert hasher._slots._value == 1
+        deadline = time.monotonic() + 5
+        while hasher._slots._value < 4 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert hasher._slots._value == 4
+    finally:
+        hasher.shutdown()
+
+def test_password_change_revokes_tokens_without_queries(app, client):
+    from sqlalchemy import event
+    from revocation import Blocklist, get_blocklist
+    app.config["PASSWORD_HASH_WORKERS"] = 0
+    client.post("/register", json={"name": "pw", "email": "pw@example.com", "password": "password123", "number": "6"})
+    with app.app_context():
+        user_id = User.query.filter_by(name="pw").one().id
+        # Issued a minute ago, on another device
+        old = create_access_token(
+            identity=str(user_id),
+            additional_claims={"iat": datetime.now(timezone.utc) - timedelta(minutes=1)}
+        )
+    old_headers = {"Authorization": f"Bearer {old}"}
+    assert client.get("/user/profile", headers=old_headers).status_code == 200
+
+    response = client.post("/change-password", headers=old_headers, json={
+        "current_password": "password123", "new_password": "password456"
+    })
+    assert response.status_code == 200
+    assert client.get("/user/profile", headers=old_headers).status_code == 401
+    fresh = {"Authorization": f"Bearer {response.get_json()['access_token']}"}
+    assert client.get("/user/profile", headers=fresh).status_code == 200
+
+    with app.app_context():
+        # A worker that did not see the change picks it up on its next sync
+        other_worker = Blocklist(sync_interval=60)
+        payload = {"sub": str(user_id), "jti": "x", "iat": int(datetime.now(timezone.utc).timestamp()) - 60}
+        assert other_worker.is_revoked(payload)
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            for _ in range(100):
+                assert get_blocklist().is_revoked(payload)
+                assert other_worker.is_revoked(payload)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        assert statements == []
+
+def test_fcm_token_upsert_and_stale_pruning(app, client, auth_headers):
+    from models import FCMToken
+    from retention import run_retention
+    from scheduler import send_push_notification
+    from sqlalchemy import event
+    client.post("/register", json={"name": "other", "email": "o@example.com", "password": "password123", "number": "7"})
+    other = client.post("/login", json={"name": "other", "password": "password123"}).get_json()
+    other_headers = {"Authorization": f"Bearer {other['access_token']}"}
+
+    with app.app_context():
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            assert client.post("/save-fcm-token", headers=auth_headers, json={"token": "phone"}).status_code == 200
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        assert [s for s in statements if "fcm_tokens" in s] == [statements[-1]]
+        assert "ON CONFLICT" in statements[-1]
+
+    # The same device signing in to another account moves the token
+    assert client.post("/save-fcm-token", headers=other_headers, json={"token": "phone"}).status_code == 200
+    assert client.post("/save-fcm-token", headers=auth_headers, json={"token": "tablet"}).status_code == 200
+    with app.app_context():
+        other_id = User.query.filter_by(name="other").one().id
+        user_id = User.query.filter_by(name="testuser").one().id
+        assert FCMToken.query.filter_by(token="phone").one().user_id == other_id
+        assert FCMToken.query.count() == 2
+        FCMToken.query.filter_by(token="tablet").one().last_seen_at = datetime.now(timezone.utc) - timedelta(days=61)
+        db.session.commit()
+
+    with patch("scheduler.messaging") as messaging:
+        send_push_notification(user_id, app)
+    messaging.send.assert_not_called()
+
+    assert run_retention(app, ["fcm_tokens"]) == {"fcm_tokens": 1}
+    with app.app_context():
+        assert [t.token for t in FCMToken.query.all()] == ["phone"]
+
+def test_outbox_delivery_retries_and_dead_letters(app, client, auth_headers):
+    from models import OutboxMessage, PasswordResetToken
+    from outbox import deliver_outbox, enqueue_push
+    app.config.update({"OUTBOX_MAX_ATTEMPTS": 2, "METRICS_TOKEN": "secret"})
+
+    # The email is queued with the reset token, not sent by the request
+    with patch("outbox.send_email") as send_email:
+        assert client.post("/forgot-password", json={"email": "test@example.com"}).status_code == 200
+        send_email.assert_not_called()
+    with app.app_context():
+        token = PasswordResetToken.query.one().token
+        enqueue_push(1, "Hi", "There")
+        db.session.commit()
+
+    with patch("outbox.send_email", side_effect=RuntimeError("smtp down")) as send_email, \
+            patch("scheduler.send_push_notification", return_value=(1, [])) as send_push:
+        assert deliver_outbox(app) == {"sent": 1, "failed": 1}
+    assert token in send_email.call_args.kwargs["contents"]
+    send_push.assert_called_once_with(1, app, title="Hi", body="There")
+    with app.app_context():
+        email = OutboxMessage.query.filter_by(channel="email").one()
+        assert (email.status, email.attempts, email.last_error) == ("pending", 1, "smtp down")
+        # Backed off, so the next run skips it
+        assert deliver_outbox(app) == {"sent": 0, "failed": 0}
+        email.next_attempt_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+        db.session.commit()
+
+    with patch("outbox.send_email", side_effect=RuntimeError("smtp down")):
+        assert deliver_outbox(app) == {"sent": 0, "failed": 1}
+    with app.app_context():
+        assert OutboxMessage.query.filter_by(channel="email").one().status == "dead"
+
+    assert client.get("/metrics").status_code == 404
+    stats = client.get("/metrics", headers={"X-Metrics-Token": "secret"}).get_json()
+    assert stats["outbox"]["dead"] == 1 and stats["outbox"]["sent"] == 1 and stats["outbox"]["due"] == 0
+    assert stats["summaries"]["outbox.push.latency_seconds"]["count"] >= 1
+
+def test_outbox_push_retries_transient_fcm_errors(app, client, auth_headers):
+    from firebase_admin.messaging import UnregisteredError
+    from models import FCMToken, OutboxMessage
+    from outbox import deliver_outbox, enqueue_push
+    assert client.post("/save-fcm-token", headers=auth_headers, json={"token": "phone"}).status_code == 200
+    with app.app_context():
+        enqueue_push(1, "Hi", "There")
+        db.session.commit()
+
+    # A 503 says nothing about the device: keep the token, retry the message
+    with patch("scheduler.messaging") as messaging:
+        messaging.send.side_effect = RuntimeError("FCM 503")
+        assert deliver_outbox(app) == {"sent": 0, "failed": 1}
+    with app.app_context():
+        message = OutboxMessage.query.one()
+        assert (message.status, message.attempts) == ("pending", 1)
+        assert "FCM 503" in message.last_error
+        assert FCMToken.query.count() == 1
+        message.next_attempt_at = datetime.now(timezone.utc) - timedelta(seconds=1)
+        db.session.commit()
+
+    # An unregistered token is pruned; with no devices left there is nothing to retry
+    with patch("scheduler.messaging") as messaging:
+        messaging.send.side_effect = UnregisteredError("Requested entity was not found.")
+        assert deliver_outbox(app) == {"sent": 1, "failed": 0}
+    with app.app_context():
+        assert OutboxMessage.query.one().status == "sent"
+        assert FCMToken.query.count() == 0
@@ -0,0 +1,106 @@
+import os
+import tempfile
+from functools import partial
+from PIL import Image, ImageOps
+from extensions import scheduler
+from storage import get_storage, local_copy
+
+
+THUMBNAIL_SIZES = (512, 128, 64)
+# format name -> (Pillow format, extension, save options)
+THUMBNAIL_FORMATS = {
+    "webp": ("WEBP", ".webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", ".jpg", {"quality": 82, "optimize": True, "progressive": True}),
+}
+
+
+THUMBNAIL_PREFIX = "thumbnails/"
+
+
+def variant_name(filename, size, fmt):
+    stem = os.path.splitext(filename)[0]
+    return f"{stem}_{size}{THUMBNAIL_FORMATS[fmt][1]}"
+
+
+def variant_key(filename, size, fmt):
+    return THUMBNAIL_PREFIX + variant_name(filename, size, fmt)
+
+
+def variant_names(filename):
+    return [variant_name(filename, size, fmt) for size in THUMBNAIL_SIZES for fmt in THUMBNAIL_FORMATS]
+
+
+def _load(source_path):
+    image = Image.open(source_path)
+    # Let the JPEG decoder scale down while decoding instead of inflating a
+    # full resolution camera image only to throw most of it away
+    image.draft("RGB", (THUMBNAIL_SIZES[0] * 2, THUMBNAIL_SIZES[0] * 2))
+    # Apply the EXIF orientation before the metadata is dropped
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        rgba = image.convert("RGBA")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        image = background
+    image.info = {}
+    return image
+
+
+def _save(image, storage, key, fmt):
+    pil_format, extension, options = THUMBNAIL_FORMATS[fmt]
+    fd, tmp_path = tempfile.mkstemp(suffix=extension, dir=storage.temp_dir())
+    try:
+        with os.fdopen(fd, "wb") as out:
+            image.save(out, pil_format, **options)
+        storage.put_file(tmp_path, key, move=True)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def generate_thumbnails(source_path, storage, filename):
+    """
+    Store square, metadata free variants of an uploaded picture for every
+    size in THUMBNAIL_SIZES and format in THUMBNAIL_FORMATS. Each size is
+    resampled from the previous, larger one. Returns the written keys.
+    """
+    written = []
+    image = _load(source_path)
+    for size in THUMBNAIL_SIZES:
+        image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        for fmt in THUMBNAIL_FORMATS:
+            key = variant_key(filename, size, fmt)
+            _save(image, storage, key, fmt)
+            written.append(key)
+    return written
+
+
+def build_thumbnails(filename, app):
+    with app.app_context():
+        storage = get_storage("uploads")
+        try:
+            with local_copy(storage, filename) as source_path:
+                written = generate_thumbnails(source_path, storage, filename)
+            print(f"Generated {len(written)} thumbnails for {filename}")
+        except (OSError, Image.DecompressionBombError) as e:
+            print(f"Failed to generate thumbnails for {filename}: {e}")
+
+
+def schedule_thumbnails(filename, app):
+    """Queue thumbnail generation so the upload request returns immediately."""
+    scheduler.add_job(
+        partial(build_thumbnails, filename, app),
+        trigger="date",
+        id=f"thumbnails_{filename}",
+        replace_existing=True
+    )
+
+
+def pick_format(requested, accept_mimetypes):
+    """Explicit format= wins, otherwise WebP for clients that list it in Accept."""
+    if requested:
+        requested = "jpeg" if requested.lower() == "jpg" else requested.lower()
+        return requested if requested in THUMBNAIL_FORMATS else None
+    if any(mimetype == "image/webp" and quality > 0 for mimetype, quality in accept_mimetypes):
+        return "webp"
+    return "jpeg"
@@ -1,10 +1,15 @@
 import os
+import io
 import csv
-from fpdf import FPDF
+import gzip
+import struct
+import zipfile
 from flask import url_for, current_app as app
 import yagmail
 from datetime import datetime, timezone
 from config import ALLOWED_EXTENSIONS
+from report_renderer import render_pdf_isolated
+from metrics import metrics
 
 
 def allowed_file(filename):
@@ -12,15 +17,57 @@ def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def _open_csv_stream(file_path, compression):
+    """Open a text stream that compresses rows as they are written."""
+    if compression == "gzip":
+        return gzip.open(file_path, mode="wt", newline="", encoding="utf-8")
+    if compression == "zip":
+        archive = zipfile.ZipFile(file_path, mode="w", compression=zipfile.ZIP_DEFLATED)
+        member = archive.open(os.path.basename(file_path)[:-len(".zip")], mode="w")
+        stream = io.TextIOWrapper(member, newline="", encoding="utf-8")
+        stream.archive = archive
+        return stream
+    return open(file_path, mode="w", newline="", encoding="utf-8")
+
+
+def _uncompressed_size(file_path, compression):
+    if compression == "gzip":
+        # ISIZE trailer: uncompressed length mod 2**32
+        with open(file_path, "rb") as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack("<I", f.read(4))[0]
+    if compression == "zip":
+        with zipfile.ZipFile(file_path) as archive:
+            return sum(info.file_size for info in archive.infolist())
+    return os.path.getsize(file_path)
+
+
+def csv_extension(compression):
+    return {"gzip": ".csv.gz", "zip": ".csv.zip"}.get(compression, ".csv")
+
+
+def record_report_metrics(file_path, compression=None):
+    """Log and aggregate the size and compression ratio of a generated report."""
+    size = os.path.getsize(file_path)
+    raw_size = _uncompressed_size(file_path, compression)
+    ratio = raw_size / size if size else 1.0
+    metrics.observe("report.size_bytes", size)
+    metrics.observe("report.compression_ratio", ratio)
+    app.logger.info(f"Report {os.path.basename(file_path)}: {size} bytes ({raw_size} uncompressed, ratio {ratio:.2f})")
+    return size, ratio
+
+
 def generate_csv(expenses, user_id):
-    """Generate a CSV file for the given expenses."""
+    """Generate a CSV file for the given expenses, compressed while it is written."""
     reports_dir = os.path.join(app.root_path, "static", "reports")
     os.makedirs(reports_dir, exist_ok=True)
 
-    filename = f"expenses_{user_id}_{int(datetime.now(timezone.utc).timestamp())}.csv"
+    compression = app.config.get("REPORT_CSV_COMPRESSION", "gzip")
+    filename = f"expenses_{user_id}_{int(datetime.now(timezone.utc).timestamp())}{csv_extension(compression)}"
     file_path = os.path.join(reports_dir, filename)
 
-    with open(file_path, mode='w', newline='', encoding='utf-8') as file:
+    file = _open_csv_stream(file_path, compression)
+    try:
         writer = csv.writer(file)
         writer.writerow(["Title", "Amount", "Currency", "Category", "Date", "Description"])
         for exp in expenses:
@@ -32,12 +79,26 @@ def generate_csv(expenses, user_id):
                 exp.date.isoformat(),
                 exp.description or ""
             ])
+    finally:
+        file.close()
+        if hasattr(file, "archive"):
+            file.archive.close()
+
+    record_report_metrics(file_path, compression)
 
     # URL for frontend (optional)
     _ = url_for('static', filename=f"reports/{filename}", _external=True)
     return file_path
 
 
+def expense_rows(expenses):
+    """Flatten expenses into the row tuples the report renderer expects."""
+    return [
+        (exp.date.date(), exp.title, exp.category, exp.amount, exp.currency, exp.description)
+        for exp in expenses
+    ]
+
+
 def generate_pdf(expenses, user_id):
     """Generate a PDF file for the given expenses."""
     reports_dir = os.path.join(app.root_path, "static", "reports")
@@ -46,19 +107,14 @@ def generate_pdf(expenses, user_id):
     filename = f"expenses_{user_id}_{int(datetime.now(timezone.utc).timestamp())}.pdf"
     file_path = os.path.join(reports_dir, filename)
 
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 10, "Expense Report", ln=True, align="C")
-    pdf.ln(10)
-
-    pdf.set_font("Arial", "", 10)
-    for exp in expenses:
-        pdf.cell(0, 6, f"{exp.date.date()} | {exp.title} | {exp.category} | {exp.amount} {exp.currency}", ln=True)
-        if exp.description:
-            pdf.multi_cell(0, 6, f"Description: {exp.description}")
-
-    pdf.output(file_path)
+    render_pdf_isolated(
+        expense_rows(expenses),
+        file_path,
+        workers=app.config.get("REPORT_RENDER_WORKERS", 2),
+        memory_mb=app.config.get("REPORT_RENDER_MEMORY_MB", 512),
+        timeout=app.config.get("REPORT_RENDER_TIMEOUT", 120)
+    )
+    record_report_metrics(file_path)
 
     # URL for frontend (optional)
     _ = url_for('static', filename=f"reports/{filename}", _external=True)
@@ -76,7 +132,7 @@ def generate_pdf_or_csv(expenses, file_format, user_id):
         raise ValueError("Invalid format. Use PDF or CSV.")
 
 
-def send_email(user_email, file_path=None):
+def send_email(user_email, file_path=None, subject="Your Expense Report", contents=None):
     sender_email = os.environ.get("EMAIL")
     sender_password = os.environ.get("EMAIL_PASSWORD")
     if not sender_email or not sender_password:
@@ -85,26 +141,22 @@ def send_email(user_email, file_path=None):
     yag = yagmail.SMTP(sender_email, sender_password)
     
     attachments = [file_path] if file_path else None
+
+    if contents is None:
+        contents = "Attached is your expense report." if file_path else "Reminder: Add your expenses today!"
     
     yag.send(
         to=user_email,
-        subject="Your Expense Report",
-        contents="Attached is your expense report." if file_path else "Reminder: Add your expenses today!",
+        subject=subject,
+        contents=contents,
         attachments=attachments
     )
 
 
 
-def send_link(user_email, link, username, subject="Reset Your Password"):
-    """Send a password reset link to the user as clickable HTML, including their username."""
-    sender_email = os.environ.get("EMAIL")
-    sender_password = os.environ.get("EMAIL_PASSWORD")
-    if not sender_email or not sender_password:
-        raise ValueError("Email credentials not configured")
-
-    yag = yagmail.SMTP(sender_email, sender_password)
-
-    html_content = f"""
+def reset_link_contents(link, username):
+    """The password reset email as clickable HTML, including the username."""
+    return f"""
     <p>Hello {username},</p>
     <p>Click the link below to reset your password:</p>
     <p><a href="{link}">Reset Password</a></p>
@@ -112,9 +164,4 @@ def send_link(user_email, link, username, subject="Reset Your Password"):
     <p>If you did not request this, please ignore this email.</p>
     """
 
-    yag.send(
-        to=user_email,
-        subject=subject,
-        contents=html_content
-    )
 